@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+import threading
+import time
+from collections import OrderedDict
+
+import grpc
+
+from metrics import replace_behavior
+
+# Trailing metadata key telling a rejected client how long to back off
+RETRY_AFTER_KEY = "retry-after-ms"
+
+# Suggested back-off when a method is at its in-flight limit (there is no refill time to report)
+IN_FLIGHT_RETRY_AFTER = 0.1
+
+# Upper bound on per-user buckets kept; the least recently used are dropped beyond it
+DEFAULT_MAX_USERS = 100000
+
+
+class TokenBucket:
+    """Classic token bucket: rate tokens per second, holding at most burst"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "_clock", "_lock")
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._clock = clock
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take one token; return 0.0 if one was available, else seconds until one will be"""
+        with self._lock:
+            now = self._clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+class KeyedTokenBuckets:
+    """One TokenBucket per key (user id), created on first use.
+
+    At most max_keys buckets are kept, dropping the least recently used. A
+    dropped key starts again with a full bucket, which only matters for
+    users idle long enough to have refilled anyway.
+    """
+
+    def __init__(self, rate, burst, max_keys=DEFAULT_MAX_USERS, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, self._clock)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        return bucket.try_acquire()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buckets)
+
+
+class Rejection:
+    """Why a call was not admitted and how long the client should wait before retrying"""
+
+    __slots__ = ("reason", "retry_after")
+
+    def __init__(self, reason, retry_after):
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def details(self):
+        return f"Server overloaded ({self.reason}), retry after {self.retry_after * 1000:.0f}ms"
+
+    def retry_after_ms(self):
+        return max(1, round(self.retry_after * 1000))
+
+    def metadata(self):
+        return ((RETRY_AFTER_KEY, str(self.retry_after_ms())),)
+
+
+class AdmissionController:
+    """Decides whether to start an RPC or a ChatSession turn.
+
+    Every RPC takes a token from the global bucket (rate requests per
+    second, burst) and a slot under its method's in-flight limit. Every
+    ChatSession message also takes a token from its user's bucket. Calls
+    that do not fit are rejected immediately with RESOURCE_EXHAUSTED and a
+    retry-after hint instead of queueing, so admitted calls keep their
+    latency under overload.
+
+    Limits left as None (or 0) are not enforced.
+    """
+
+    def __init__(self, rate=None, burst=None, user_rate=None, user_burst=None, max_in_flight=None,
+                 default_max_in_flight=None, metrics=None):
+        self.global_bucket = TokenBucket(rate, burst or max(1, rate)) if rate else None
+        self.user_buckets = KeyedTokenBuckets(user_rate, user_burst or max(1, user_rate)) if user_rate else None
+        self.max_in_flight = dict(max_in_flight or {})
+        self.default_max_in_flight = default_max_in_flight
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.rejected = None
+        if metrics is not None:
+            self.rejected = metrics.counter(
+                "admission_rejected_total", "Calls rejected by admission control, by method and reason",
+                ("method", "reason"))
+            metrics.callback_gauge("admission_in_flight", "Admitted calls in flight, by method",
+                                   self._in_flight_counts, ("method",))
+
+    def _in_flight_counts(self):
+        with self._lock:
+            return {(method,): count for method, count in self._in_flight.items()}
+
+    def _reject(self, method, reason, retry_after):
+        if self.rejected is not None:
+            self.rejected.inc(method, reason)
+        return Rejection(reason, retry_after)
+
+    def start_call(self, method):
+        """Admit a call to method, returning None if admitted (call finish_call later) or a Rejection"""
+        limit = self.max_in_flight.get(method, self.default_max_in_flight)
+        with self._lock:
+            count = self._in_flight.get(method, 0)
+            if limit and count >= limit:
+                return self._reject(method, "in_flight", IN_FLIGHT_RETRY_AFTER)
+            self._in_flight[method] = count + 1
+        if self.global_bucket is not None:
+            wait = self.global_bucket.try_acquire()
+            if wait:
+                self.finish_call(method)
+                return self._reject(method, "rate", wait)
+        return None
+
+    def finish_call(self, method):
+        with self._lock:
+            self._in_flight[method] -= 1
+
+    def admit_turn(self, user):
+        """Admit one ChatSession message from user (as told apart by scheduler.request_user, so anonymous
+        clients do not share one bucket), returning None or a Rejection"""
+        if self.user_buckets is None:
+            return None
+        wait = self.user_buckets.try_acquire(user)
+        if wait:
+            return self._reject("ChatSession", "user_rate", wait)
+        return None
+
+
+def parse_limits(specs, what="in-flight limit"):
+    """Parse METHOD=N strings ("*" sets the default) into (limits dict, default limit)"""
+    limits = {}
+    default = None
+    for spec in specs or ():
+        method, _, value = spec.partition("=")
+        try:
+            limit = int(value)
+        except ValueError:
+            raise ValueError(f"Invalid {what} {spec!r}, expected METHOD=N") from None
+        if method == "*":
+            default = limit
+        else:
+            limits[method] = limit
+    return limits, default
+
+
+class _AdmissionWrapper:
+    """Shared handler wrapping of the sync and asyncio admission interceptors"""
+
+    def __init__(self, admission):
+        self.admission = admission
+
+    def _admit(self, handler, handler_call_details):
+        if handler is None:
+            return None
+        method = handler_call_details.method.rsplit("/", 1)[-1]
+        if handler.response_streaming:
+            behavior = self._wrap_stream(method, handler.unary_stream or handler.stream_stream)
+        else:
+            behavior = self._wrap_unary(method, handler.unary_unary or handler.stream_unary)
+        return replace_behavior(handler, behavior)
+
+
+class AdmissionInterceptor(_AdmissionWrapper, grpc.ServerInterceptor):
+    """Applies an AdmissionController to every RPC of a grpc.server"""
+
+    def intercept_service(self, continuation, handler_call_details):
+        return self._admit(continuation(handler_call_details), handler_call_details)
+
+    def _wrap_unary(self, method, behavior):
+        admission = self.admission
+
+        def handle(request, context):
+            rejection = admission.start_call(method)
+            if rejection is not None:
+                context.set_trailing_metadata(rejection.metadata())
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, rejection.details())
+            try:
+                return behavior(request, context)
+            finally:
+                admission.finish_call(method)
+        return handle
+
+    def _wrap_stream(self, method, behavior):
+        admission = self.admission
+
+        def handle(request, context):
+            rejection = admission.start_call(method)
+            if rejection is not None:
+                context.set_trailing_metadata(rejection.metadata())
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, rejection.details())
+            try:
+                yield from behavior(request, context)
+            finally:
+                admission.finish_call(method)
+        return handle
+
+
+class AsyncAdmissionInterceptor(_AdmissionWrapper, grpc.aio.ServerInterceptor):
+    """AdmissionInterceptor for a grpc.aio server"""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        return self._admit(await continuation(handler_call_details), handler_call_details)
+
+    def _wrap_unary(self, method, behavior):
+        admission = self.admission
+
+        async def handle(request, context):
+            rejection = admission.start_call(method)
+            if rejection is not None:
+                context.set_trailing_metadata(rejection.metadata())
+                await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, rejection.details())
+            try:
+                return await behavior(request, context)
+            finally:
+                admission.finish_call(method)
+        return handle
+
+    def _wrap_stream(self, method, behavior):
+        admission = self.admission
+
+        async def handle(request, context):
+            rejection = admission.start_call(method)
+            if rejection is not None:
+                context.set_trailing_metadata(rejection.metadata())
+                await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, rejection.details())
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            finally:
+                admission.finish_call(method)
+        return handle
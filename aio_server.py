@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+import asyncio
+import functools
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+import logging
+import signal
+import time
+import uuid
+from datetime import datetime
+
+from admission import AsyncAdmissionInterceptor
+from backends import BackendError
+from grpc_config import server_options, aapply_response_compression
+from metrics import AsyncMetricsInterceptor, start_http_server, DEFAULT_METRICS_HOST
+from resilience import CallCancelled, Deadline, DeadlineExceeded
+from scheduler import method_class, request_user, BULK
+from server import (ChatServicer, condense_messages, rate_limited_message, replay_chunks, summary_request,
+                    upstream_error_status, web_result_messages, web_search_prompt, CHAT_SESSION_PROMPT,
+                    STREAM_CHUNK_MAX_BYTES, STREAM_CHUNK_MAX_DELAY, DEFAULT_PORT)
+from singleflight import AsyncSingleFlight, SharedCallAbandoned
+from supervisor import notify_ready, DEFAULT_SHUTDOWN_GRACE
+from structured_logging import rpc_log, payload
+
+
+async def acoalesce_tokens(tokens, max_bytes=STREAM_CHUNK_MAX_BYTES, max_delay=STREAM_CHUNK_MAX_DELAY):
+    """Async counterpart of server.coalesce_tokens.
+
+    The next token is awaited in a task with a timeout instead of on a reader thread.
+    The task is not cancelled by a timed-out wait, only when this generator is closed.
+    """
+    buffer = []
+    size = 0
+    last_flush = float("-inf")
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(tokens.__anext__())
+            timeout = max(0.0, last_flush + max_delay - time.monotonic()) if buffer else None
+            done, _ = await asyncio.wait((pending,), timeout=timeout)
+            if not done:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                last_flush = time.monotonic()
+                continue
+            next_token, pending = pending, None
+            try:
+                token = next_token.result()
+            except StopAsyncIteration:
+                break
+            buffer.append(token)
+            size += len(token.encode("utf-8"))
+            now = time.monotonic()
+            if size >= max_bytes or now - last_flush >= max_delay:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                last_flush = now
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            # The caller closes tokens next, which fails while they are still running in the task
+            pending.cancel()
+            await asyncio.wait((pending,))
+
+
+class AsyncChatServicer(ChatServicer):
+    """asyncio variant of ChatServicer for use with a grpc.aio server.
+
+    Handlers await the LLM backend instead of blocking a worker thread, so a
+    single event loop can hold many concurrent calls and chat streams.
+    Session storage and eviction are shared with the threaded servicer.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Bounds concurrent BulkSummarize URLs in place of the threaded servicer's pool
+        self.summary_semaphore = asyncio.Semaphore(self.bulk_concurrency)
+        self.single_flight = AsyncSingleFlight(leader_errors=(CallCancelled, DeadlineExceeded))
+        # Strong references to fire-and-forget tasks so they are not garbage collected
+        self.background_tasks = set()
+
+    @staticmethod
+    def _summary_pool(bulk_concurrency):
+        # Summaries run on the event loop, so no thread pool is started
+        return None
+
+    async def GetReply(self, request, context):
+        """Unary RPC - Summarize 1 URL or respond to 1 question"""
+        log = rpc_log("GetReply")
+        log.info("Received message: %s", payload(request.user_message))
+        # Client cancellation arrives as CancelledError; the deadline bounds upstream calls
+        deadline = Deadline.from_context(context)
+
+        try:
+            results = await self._aweb_search(request, log)
+            system_prompt = web_search_prompt(results)
+
+            cache_key, ai_response = self._cache_lookup(request.user_message, system_prompt)
+            if ai_response is not None:
+                log.info("Serving cached response")
+                return chatbot_pb2.ChatReply(ai_response=ai_response, web_results=web_result_messages(results))
+
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": request.user_message}
+            ]
+            ai_response = await self._shared_complete(cache_key, messages, "GetReply", deadline,
+                                                      request_user(context))
+            log.info("Generated response: %s", payload(ai_response))
+
+            self._cache_store(cache_key, ai_response)
+
+            return chatbot_pb2.ChatReply(ai_response=ai_response, web_results=web_result_messages(results))
+
+        except Exception as e:
+            log.error("Error calling LLM backend: %s", e)
+            context.set_code(upstream_error_status(e))
+            context.set_details(f"Error processing request: {str(e)}")
+            return chatbot_pb2.ChatReply(ai_response="Sorry, I encountered an error processing your request.")
+
+    async def StreamResponse(self, request, context):
+        """Server Streaming RPC - Stream chatbot response in parts"""
+        log = rpc_log("StreamResponse")
+        log.info("Received stream request: %s", payload(request.user_message))
+        deadline = Deadline.from_context(context)
+
+        try:
+            system_prompt = web_search_prompt(await self._aweb_search(request, log))
+            cache_key, ai_response = self._cache_lookup(request.user_message, system_prompt)
+            if ai_response is not None:
+                # Replay the cached answer without touching the backend
+                log.info("Streaming cached response")
+                for text in replay_chunks(ai_response):
+                    yield chatbot_pb2.ResponseChunk(content=text, is_final=False)
+                yield chatbot_pb2.ResponseChunk(content="", is_final=True)
+                return
+
+            stream = self._schedule_stream(self.backend.astream, "StreamResponse", request_user(context), deadline)
+            tokens = self.resilience.astream("StreamResponse", stream, self.model, [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": request.user_message}
+            ], deadline=deadline)
+
+            parts = []
+            try:
+                async for text in acoalesce_tokens(tokens):
+                    if deadline.done():
+                        log.info("Deadline passed, stopping stream")
+                        return
+                    parts.append(text)
+                    yield chatbot_pb2.ResponseChunk(content=text, is_final=False)
+            finally:
+                # Closes the upstream stream if we stopped early or were cancelled
+                await tokens.aclose()
+
+            ai_response = "".join(parts)
+            log.info("Generated response for streaming: %s", payload(ai_response))
+
+            self._cache_store(cache_key, ai_response)
+
+            # Empty final chunk marks the end of the response
+            yield chatbot_pb2.ResponseChunk(content="", is_final=True)
+
+        except Exception as e:
+            log.error("Error in streaming response: %s", e)
+            context.set_code(upstream_error_status(e))
+            context.set_details(f"Error processing streaming request: {str(e)}")
+            yield chatbot_pb2.ResponseChunk(
+                content=f"Sorry, I encountered an error processing your request: {str(e)}",
+                is_final=True
+            )
+
+    async def _aweb_search(self, request, log):
+        """_web_search off the event loop, since a query may page in parts of the index from disk"""
+        if not request.enable_web_access or self.search is None:
+            return ()
+        return await asyncio.to_thread(self._web_search, request, log)
+
+    def _schedule(self, fn, method, user, deadline, priority=None):
+        if self.scheduler is None:
+            return fn
+        return self.scheduler.ascheduled(fn, priority or method_class(method), user, deadline)
+
+    def _schedule_stream(self, fn, method, user, deadline):
+        if self.scheduler is None:
+            return fn
+        return self.scheduler.ascheduled_stream(fn, method_class(method), user, deadline)
+
+    def _scheduled_batch(self, priority, user):
+        """Async counterpart of ChatServicer._scheduled_batch"""
+        if self.scheduler is None:
+            return self.backend.abatch
+        scheduled = self.scheduler.ascheduled
+        batch = self.backend.abatch
+
+        async def call(model, message_lists, timeout=None):
+            try:
+                return await scheduled(batch, priority, user, Deadline(timeout))(model, message_lists, timeout=timeout)
+            except DeadlineExceeded:
+                raise BackendError("Batch timed out waiting for an upstream slot", retryable=True) from None
+        return call
+
+    async def _complete(self, messages, method, deadline=None, user="", priority=None):
+        """Run one chat completion for an RPC method under its retry policy and return the response text"""
+        if self.batcher is not None:
+            priority = priority or method_class(method)
+            group = priority if self.scheduler is not None else None
+            return await self.resilience.acall(method, functools.partial(self.batcher.acomplete, group=group),
+                                               self._scheduled_batch(priority, user), self.model, messages,
+                                               deadline=deadline)
+        complete = self._schedule(self.backend.acomplete, method, user, deadline, priority)
+        return await self.resilience.acall(method, complete, self.model, messages, deadline=deadline)
+
+    async def _shared_complete(self, key, messages, method, deadline, user=""):
+        """Async counterpart of ChatServicer._shared_complete"""
+        while True:
+            try:
+                return await self.single_flight.do(key, self._complete, messages, method, deadline, user)
+            except SharedCallAbandoned:
+                error = deadline.error()
+                if error is not None:
+                    raise error
+
+    async def _condense_history(self, session):
+        """Fold messages trimmed from a session into its rolling summary"""
+        claimed = session.begin_summary()
+        if claimed is None:
+            return
+        summary = None
+        try:
+            summary = await self._complete(condense_messages(*claimed), "ChatSession", user=session.user_id,
+                                           priority=BULK)
+        except Exception:
+            logging.exception("Error condensing history of session %s", session.session_id)
+        finally:
+            session.finish_summary(summary)
+
+    async def BulkSummarize(self, request_iterator, context):
+        """Client Streaming RPC - Send multiple URLs to summarize in bulk"""
+        log = rpc_log("BulkSummarize")
+        log.info("Started bulk URL summarization process")
+        await aapply_response_compression(context)
+
+        pending = []
+        count = 0
+        deadline = Deadline.from_context(context)
+        user = request_user(context)
+
+        try:
+            # Start summarizing each URL as soon as it arrives off the client stream
+            async for request in request_iterator:
+                count += 1
+                max_length = request.max_length if request.max_length > 0 else 100  # Default length
+
+                log.info("Queueing URL %d: %s", count, request.url)
+                pending.append(asyncio.ensure_future(
+                    self._summarize_url(count - 1, request.url, max_length, "BulkSummarize", log, deadline, user)))
+
+            # gather keeps results in input order
+            summaries = await asyncio.gather(*pending)
+        finally:
+            # Stop outstanding work if the client goes away; URLs still waiting for a slot are dropped
+            for task in pending:
+                task.cancel()
+
+        log.info("Completed processing %d URLs", count)
+        return chatbot_pb2.BulkSummaryResponse(
+            summaries=summaries,
+            total_processed=count
+        )
+
+    async def BulkSummarizeStream(self, request_iterator, context):
+        """Bidirectional Streaming RPC - Stream each URL summary back as soon as it completes"""
+        log = rpc_log("BulkSummarizeStream")
+        log.info("Started streaming bulk URL summarization process")
+        await aapply_response_compression(context)
+
+        # Completed summaries, plus a final (None, count) marker from the dispatcher
+        results = asyncio.Queue()
+        # Caps summaries in flight or waiting to be sent, so memory stays constant per call
+        slots = asyncio.Semaphore(self.bulk_concurrency)
+
+        deadline = Deadline.from_context(context)
+        user = request_user(context)
+
+        async def summarize(index, url, max_length):
+            await results.put((await self._summarize_url(index, url, max_length, "BulkSummarizeStream", log,
+                                                         deadline, user), None))
+
+        async def dispatch():
+            count = 0
+            try:
+                async for request in request_iterator:
+                    await slots.acquire()
+                    max_length = request.max_length if request.max_length > 0 else 100  # Default length
+                    task = asyncio.ensure_future(summarize(count, request.url, max_length))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    count += 1
+            except Exception as e:
+                log.error("Error reading bulk summarization stream: %s", e)
+            finally:
+                await results.put((None, count))
+
+        tasks = set()
+        dispatcher = asyncio.ensure_future(dispatch())
+
+        sent = 0
+        total = None
+        try:
+            while total is None or sent < total:
+                summary, count = await results.get()
+                if summary is None:
+                    total = count
+                    continue
+                yield summary
+                sent += 1
+                slots.release()
+        finally:
+            # Stop outstanding work if the client goes away mid-stream
+            dispatcher.cancel()
+            for task in tasks:
+                task.cancel()
+
+        log.info("Completed streaming %d URL summaries", sent)
+
+    async def _summarize_url(self, index, url, max_length, method, log, deadline, user=""):
+        """Summarize a single URL, reporting failures in the returned UrlSummary.
+
+        The page is fetched before taking a summary slot, so slots are only held while the model works.
+        """
+        page = fetch_error = None
+        try:
+            if self.fetcher is not None:
+                try:
+                    page = await asyncio.wrap_future(self._start_fetch(url, deadline))
+                except Exception as e:
+                    fetch_error = e
+            await self.summary_semaphore.acquire()
+        except asyncio.CancelledError:
+            # The call was cancelled before this URL got a slot
+            if self.metrics is not None:
+                self.metrics.bulk_dropped.inc(method)
+            raise
+        try:
+            log.info("Processing URL: %s", url)
+
+            try:
+                if fetch_error is not None:
+                    raise fetch_error
+
+                key, messages = summary_request(self.model, url, max_length, page)
+                summary = await self._shared_complete(key, messages, method, deadline, user)
+
+                return chatbot_pb2.UrlSummary(
+                    url=url,
+                    summary=summary,
+                    success=True,
+                    error_message="",
+                    index=index
+                )
+
+            except Exception as e:
+                if deadline.done():
+                    log.info("Stopped summarizing URL %s: %s", url, e)
+                else:
+                    log.error("Error summarizing URL %s: %s", url, e)
+                return chatbot_pb2.UrlSummary(
+                    url=url,
+                    summary="",
+                    success=False,
+                    error_message=str(e),
+                    index=index
+                )
+        finally:
+            self.summary_semaphore.release()
+
+    async def ChatSession(self, request_iterator, context):
+        """Bidirectional Streaming RPC - Real-time chatbot with history"""
+        log = rpc_log("ChatSession")
+        log.info("Started bidirectional chat session")
+
+        session_id = None
+        user_id = None
+        session = None
+        deadline = Deadline.from_context(context)
+
+        try:
+            async for request in request_iterator:
+                # Get or create session for this conversation
+                if session_id is None:
+                    session_id = request.session_id if request.session_id else str(uuid.uuid4())
+                    user_id = request.user_id if request.user_id else "anonymous"
+                    user = request_user(context, request.user_id)
+
+                    # Session store locks are never held across an await, so the
+                    # store is safe to share with the event loop. Opening a session
+                    # may read from the persistent backend, so it runs in a thread.
+                    session, created = await asyncio.to_thread(
+                        self.sessions.get_or_create, session_id, user_id, CHAT_SESSION_PROMPT)
+                    if created:
+                        log.info("Creating new session %s for user %s", session_id, user_id)
+                    else:
+                        log.info("Resuming existing session %s for user %s", session_id, user_id)
+
+                timestamp = datetime.now().isoformat()
+
+                if self.admission is not None:
+                    rejection = self.admission.admit_turn(user)
+                    if rejection is not None:
+                        log.warning("Rate limiting user %s in session %s", user_id, session_id)
+                        yield rate_limited_message(request, rejection, timestamp, session_id, user_id)
+                        continue
+
+                log.info("Received chat message in session %s: %s", session_id, payload(request.text))
+
+                session.append("user", request.text)
+
+                response_id = str(uuid.uuid4())
+
+                try:
+                    messages = session.snapshot()
+
+                    ai_response = await self._complete(messages, "ChatSession", deadline, user)
+
+                    session.append("assistant", ai_response)
+
+                    # Condense trimmed history off the response path (rolling summary mode only)
+                    if session.evicted:
+                        task = asyncio.ensure_future(self._condense_history(session))
+                        self.background_tasks.add(task)
+                        task.add_done_callback(self.background_tasks.discard)
+
+                    yield chatbot_pb2.ChatMessage(
+                        text=ai_response,
+                        sender="ai",
+                        timestamp=timestamp,
+                        message_id=response_id,
+                        reply_to=request.message_id,
+                        session_id=session_id,
+                        user_id=user_id
+                    )
+
+                except Exception as e:
+                    log.error("Error generating AI response: %s", e)
+                    error_message = f"Sorry, I encountered an error: {str(e)}"
+
+                    yield chatbot_pb2.ChatMessage(
+                        text=error_message,
+                        sender="ai",
+                        timestamp=timestamp,
+                        message_id=response_id,
+                        reply_to=request.message_id,
+                        session_id=session_id,
+                        user_id=user_id
+                    )
+
+            log.info("Chat session %s ended normally", session_id)
+
+        except Exception as e:
+            log.error("Error in chat session %s: %s", session_id, e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(f"Chat session error: {str(e)}")
+        finally:
+            if session is not None:
+                # May flush the session's writes for other processes to see
+                await asyncio.to_thread(self.sessions.release, session)
+
+
+async def serve(servicer=None, port=DEFAULT_PORT, metrics_port=0, grace=DEFAULT_SHUTDOWN_GRACE, worker=False,
+                ready_fd=None, options=None, compression=None, max_concurrent_rpcs=None,
+                metrics_host=DEFAULT_METRICS_HOST):
+    """Async counterpart of server.serve"""
+    servicer = servicer or AsyncChatServicer()
+    interceptors = []
+    if servicer.metrics is not None:
+        interceptors.append(AsyncMetricsInterceptor(servicer.metrics))
+        if metrics_port:
+            start_http_server(servicer.metrics, metrics_port, metrics_host, reuse_port=worker)
+    if servicer.admission is not None:
+        interceptors.append(AsyncAdmissionInterceptor(servicer.admission))
+    if options is None:
+        options = server_options(reuse_port=worker)
+    server = grpc.aio.server(interceptors=interceptors, options=options, compression=compression,
+                             maximum_concurrent_rpcs=max_concurrent_rpcs)
+    chatbot_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    server_address = f'[::]:{port}'
+    server.add_insecure_port(server_address)
+    await server.start()
+    logging.info("Async server started, listening on %s", server_address)
+
+    def stop():
+        logging.info("Stopping, giving in-flight calls %ss to finish", grace)
+        task = asyncio.ensure_future(server.stop(grace))
+        servicer.background_tasks.add(task)
+        task.add_done_callback(servicer.background_tasks.discard)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop)
+    if ready_fd is not None:
+        notify_ready(ready_fd)
+    await server.wait_for_termination()
+    await asyncio.to_thread(servicer.sessions.close)
+
+
+if __name__ == '__main__':
+    asyncio.run(serve())
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import abc
+import asyncio
+import contextlib
+import hashlib
+import os
+import random
+import threading
+import time
+
+# Model used when none is configured
+DEFAULT_MODEL = "llama-3.1-8b-instant"
+
+
+class BackendError(Exception):
+    """Raised by a backend when a completion fails.
+
+    retryable is True for failures that may succeed on another attempt
+    (timeouts, connection errors, rate limiting, upstream 5xx).
+    """
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class LLMBackend(abc.ABC):
+    """Interface between ChatServicer and a chat completion provider.
+
+    Every call takes a model name and an OpenAI-style list of
+    {"role", "content"} messages. complete() returns the response text,
+    stream() yields text pieces as they are generated, and batch() returns
+    one response per message list. The a-prefixed methods are the asyncio
+    versions used by the grpc.aio server. timeout, when given, is the
+    number of seconds the caller can still wait (the RPC's remaining
+    deadline); a call that takes longer raises a retryable BackendError.
+
+    Subclasses must implement complete() and stream(); batch() defaults to
+    one complete() per message list, and backends that are only served by
+    the threaded server may leave the asyncio methods out.
+    """
+
+    @abc.abstractmethod
+    def complete(self, model, messages, timeout=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stream(self, model, messages, timeout=None):
+        raise NotImplementedError
+
+    def batch(self, model, message_lists, timeout=None):
+        return [self.complete(model, messages, timeout) for messages in message_lists]
+
+    async def acomplete(self, model, messages, timeout=None):
+        raise NotImplementedError
+
+    async def astream(self, model, messages, timeout=None):
+        raise NotImplementedError
+        yield  # pragma: no cover - marks this as an async generator
+
+    async def abatch(self, model, message_lists, timeout=None):
+        return await asyncio.gather(*(self.acomplete(model, messages, timeout) for messages in message_lists))
+
+
+class GroqBackend(LLMBackend):
+    """Chat completions from the Groq API"""
+
+    def __init__(self, api_key=None):
+        # Imported here so the fake backend works without the groq package
+        import groq
+
+        api_key = api_key or os.environ.get("GROQ_API_KEY")
+        if not api_key:
+            raise ValueError("GROQ_API_KEY environment variable is not set")
+        # Retries are left to the servicer's resilience layer, which also backs off and hedges
+        self.client = groq.Groq(api_key=api_key, max_retries=0)
+        self.async_client = groq.AsyncGroq(api_key=api_key, max_retries=0)
+        self._api_error = groq.APIError
+        self._retryable_errors = (groq.APIConnectionError, groq.RateLimitError, groq.InternalServerError)
+
+    def _translate(self, e):
+        """Convert a groq exception into a BackendError"""
+        return BackendError(str(e), retryable=isinstance(e, self._retryable_errors))
+
+    @staticmethod
+    def _options(timeout):
+        # An explicit timeout=None would disable the client's default timeout, so leave it out
+        return {} if timeout is None else {"timeout": timeout}
+
+    def complete(self, model, messages, timeout=None):
+        try:
+            chat_completion = self.client.chat.completions.create(model=model, messages=messages,
+                                                                  **self._options(timeout))
+        except self._api_error as e:
+            raise self._translate(e) from e
+        return chat_completion.choices[0].message.content
+
+    def stream(self, model, messages, timeout=None):
+        try:
+            # Closing this generator early closes the HTTP response, which stops generation upstream
+            with self.client.chat.completions.create(model=model, messages=messages, stream=True,
+                                                     **self._options(timeout)) as stream:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        except self._api_error as e:
+            raise self._translate(e) from e
+
+    async def acomplete(self, model, messages, timeout=None):
+        try:
+            chat_completion = await self.async_client.chat.completions.create(model=model, messages=messages,
+                                                                              **self._options(timeout))
+        except self._api_error as e:
+            raise self._translate(e) from e
+        return chat_completion.choices[0].message.content
+
+    async def astream(self, model, messages, timeout=None):
+        try:
+            stream = await self.async_client.chat.completions.create(model=model, messages=messages, stream=True,
+                                                                     **self._options(timeout))
+            async with stream:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        except self._api_error as e:
+            raise self._translate(e) from e
+
+
+class FakeBackend(LLMBackend):
+    """Deterministic local stand-in for load testing without a network.
+
+    Responses are derived from a hash of the model and messages, so the same
+    prompt always gets the same answer. Timing is simulated: time to first
+    token is drawn from a log-normal distribution around latency (spread
+    set by latency_jitter), then tokens arrive at tokens_per_second. A
+    batch pays the time-to-first-token once for all its prompts. A fraction
+    error_rate of calls raise BackendError, as do calls that would run past
+    their timeout (after waiting it out, like a real client). With
+    concurrency, at most that many calls (a batch counts as one) run at a
+    time and the rest queue, like a local model server with that many slots;
+    time spent queued counts against the timeout.
+    """
+
+    _WORDS = ("the", "server", "stream", "request", "session", "model", "answer", "latency",
+              "token", "cache", "batch", "client", "message", "context", "summary", "result")
+
+    def __init__(self, latency=0.2, latency_jitter=0.25, tokens_per_second=200.0,
+                 response_tokens=60, error_rate=0.0, seed=None, concurrency=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self.concurrency = concurrency
+        self._random = random.Random(seed)
+        self._slots = threading.Semaphore(concurrency) if concurrency > 0 else None
+        self._aslots = None  # created on first use, in the event loop that uses it
+
+    @staticmethod
+    def _until(expires):
+        return None if expires is None else max(0.0, expires - time.monotonic())
+
+    @contextlib.contextmanager
+    def _slot(self, expires):
+        """Hold one of the backend's slots, timing out at expires"""
+        if self._slots is None:
+            yield
+            return
+        if not self._slots.acquire(timeout=self._until(expires)):
+            raise BackendError("Fake backend request timed out waiting for a slot", retryable=True)
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    @contextlib.asynccontextmanager
+    async def _aslot(self, expires):
+        if self.concurrency <= 0:
+            yield
+            return
+        if self._aslots is None:
+            self._aslots = asyncio.Semaphore(self.concurrency)
+        try:
+            await asyncio.wait_for(self._aslots.acquire(), self._until(expires))
+        except asyncio.TimeoutError:
+            raise BackendError("Fake backend request timed out waiting for a slot", retryable=True) from None
+        try:
+            yield
+        finally:
+            self._aslots.release()
+
+    def _tokens(self, model, messages):
+        """Deterministic response tokens for a prompt"""
+        digest = hashlib.sha256(repr((model, messages)).encode("utf-8")).digest()
+        count = max(1, self.response_tokens // 2 + digest[0] % max(1, self.response_tokens))
+        return [self._WORDS[digest[i % len(digest)] % len(self._WORDS)] + " " for i in range(count)]
+
+    def _first_token_delay(self):
+        if self.latency <= 0:
+            return 0.0
+        return self.latency * self._random.lognormvariate(0.0, self.latency_jitter)
+
+    def _token_delay(self, count=1):
+        return count / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _maybe_fail(self):
+        if self.error_rate > 0 and self._random.random() < self.error_rate:
+            raise BackendError("Injected failure from fake backend", retryable=True)
+
+    @staticmethod
+    def _expiry(timeout):
+        return None if timeout is None else time.monotonic() + timeout
+
+    @staticmethod
+    def _check_expiry(delay, expires):
+        """Return how long to wait before failing if delay would run past expires, else None"""
+        if expires is None:
+            return None
+        remaining = expires - time.monotonic()
+        return max(0.0, remaining) if delay > remaining else None
+
+    def _sleep(self, delay, expires):
+        """Simulate delay seconds of upstream work, timing out at expires (a time.monotonic() value)"""
+        cut_short = self._check_expiry(delay, expires)
+        if cut_short is not None:
+            time.sleep(cut_short)
+            raise BackendError("Fake backend request timed out", retryable=True)
+        time.sleep(delay)
+
+    async def _asleep(self, delay, expires):
+        cut_short = self._check_expiry(delay, expires)
+        if cut_short is not None:
+            await asyncio.sleep(cut_short)
+            raise BackendError("Fake backend request timed out", retryable=True)
+        await asyncio.sleep(delay)
+
+    def complete(self, model, messages, timeout=None):
+        expires = self._expiry(timeout)
+        tokens = self._tokens(model, messages)
+        with self._slot(expires):
+            self._sleep(self._first_token_delay() + self._token_delay(len(tokens)), expires)
+        self._maybe_fail()
+        return "".join(tokens).strip()
+
+    def stream(self, model, messages, timeout=None):
+        expires = self._expiry(timeout)
+        tokens = self._tokens(model, messages)
+        with self._slot(expires):
+            self._sleep(self._first_token_delay(), expires)
+            self._maybe_fail()
+            for token in tokens:
+                self._sleep(self._token_delay(), expires)
+                yield token
+
+    def batch(self, model, message_lists, timeout=None):
+        expires = self._expiry(timeout)
+        responses = [self._tokens(model, messages) for messages in message_lists]
+        longest = max((len(tokens) for tokens in responses), default=0)
+        with self._slot(expires):
+            self._sleep(self._first_token_delay() + self._token_delay(longest), expires)
+        self._maybe_fail()
+        return ["".join(tokens).strip() for tokens in responses]
+
+    async def acomplete(self, model, messages, timeout=None):
+        expires = self._expiry(timeout)
+        tokens = self._tokens(model, messages)
+        async with self._aslot(expires):
+            await self._asleep(self._first_token_delay() + self._token_delay(len(tokens)), expires)
+        self._maybe_fail()
+        return "".join(tokens).strip()
+
+    async def astream(self, model, messages, timeout=None):
+        expires = self._expiry(timeout)
+        tokens = self._tokens(model, messages)
+        async with self._aslot(expires):
+            await self._asleep(self._first_token_delay(), expires)
+            self._maybe_fail()
+            for token in tokens:
+                await self._asleep(self._token_delay(), expires)
+                yield token
+
+    async def abatch(self, model, message_lists, timeout=None):
+        expires = self._expiry(timeout)
+        responses = [self._tokens(model, messages) for messages in message_lists]
+        longest = max((len(tokens) for tokens in responses), default=0)
+        async with self._aslot(expires):
+            await self._asleep(self._first_token_delay() + self._token_delay(longest), expires)
+        self._maybe_fail()
+        return ["".join(tokens).strip() for tokens in responses]
+
+
+def build_backend(name, **options):
+    """Create a backend by name ("groq" or "fake"); options go to the backend constructor"""
+    if name == "groq":
+        return GroqBackend(**options)
+    if name == "fake":
+        return FakeBackend(**options)
+    raise ValueError(f"Unknown backend: {name}")
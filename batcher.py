@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+import time
+from concurrent import futures
+
+from backends import BackendError
+
+# Longest a completion waits for others to join its batch, and the most prompts per batch
+DEFAULT_MAX_WAIT = 0.01
+DEFAULT_MAX_SIZE = 8
+
+# Histogram bucket upper bounds for prompts per batch
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class _Batch:
+    """Completions for one model waiting to be sent together"""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.items = []  # (messages, expires, queued at, Future)
+        self.full = threading.Event()
+        self.task = None
+
+
+class MicroBatcher:
+    """Groups concurrent completions for the same model into batched backend calls.
+
+    The first completion for a model (and group, such as a priority class)
+    opens a batch; the batch is sent as one fn(model, message_lists,
+    timeout) call (the fn of the completion that opened it) once it
+    holds max_size prompts or max_wait seconds after it opened, whichever
+    comes first, so batching adds at most max_wait to any completion. Each
+    caller gets its own response back. complete() is for threads: the
+    caller that opened the batch makes the backend call. acomplete() is for
+    asyncio: the batch runs in its own task, and callers that are cancelled
+    leave it. The batch's timeout is the shortest of its callers' remaining
+    time, so the caller making the call is never held past its deadline;
+    a caller that runs out of time gets a retryable BackendError like any
+    other upstream timeout. A failed batch (including one that timed out
+    for its most hurried caller) fails every caller in it, and each
+    retries on its own within its own deadline.
+    """
+
+    def __init__(self, max_wait=DEFAULT_MAX_WAIT, max_size=DEFAULT_MAX_SIZE, metrics=None):
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._open = {}   # (model, group) -> _Batch collecting completions from threads
+        self._aopen = {}  # (model, group) -> _Batch collecting completions from the event loop
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+        self.sizes = self.queue_wait = None
+        if metrics is not None:
+            self.sizes = metrics.histogram("llm_batch_size", "Prompts per batched upstream call",
+                                           buckets=BATCH_SIZE_BUCKETS)
+            self.queue_wait = metrics.histogram("llm_batch_queue_seconds",
+                                                "Time completions waited for their batch to be sent")
+
+    @staticmethod
+    def _expiry(timeout):
+        return None if timeout is None else time.monotonic() + timeout
+
+    def complete(self, fn, model, messages, timeout=None, group=None):
+        """Return the response to messages, sent to fn in a batch with concurrent completions of the same group"""
+        expires = self._expiry(timeout)
+        result = futures.Future()
+        key = (model, group)
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _Batch(fn)
+            batch.items.append((messages, expires, time.monotonic(), result))
+            if len(batch.items) >= self.max_size:
+                del self._open[key]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            self._run(model, batch)
+        try:
+            return result.result(None if expires is None else max(0.0, expires - time.monotonic()))
+        except futures.TimeoutError:
+            raise BackendError("Batched request timed out", retryable=True) from None
+
+    async def acomplete(self, fn, model, messages, timeout=None, group=None):
+        """asyncio counterpart of complete(); fn is a coroutine function such as a backend's abatch()"""
+        expires = self._expiry(timeout)
+        result = asyncio.get_running_loop().create_future()
+        key = (model, group)
+        batch = self._aopen.get(key)
+        if batch is None:
+            batch = self._aopen[key] = _Batch(fn)
+            asyncio.get_running_loop().call_later(self.max_wait, self._adispatch, key, batch)
+        batch.items.append((messages, expires, time.monotonic(), result))
+        if len(batch.items) >= self.max_size:
+            self._adispatch(key, batch)
+        try:
+            return await asyncio.wait_for(result, timeout)
+        except asyncio.TimeoutError:
+            raise BackendError("Batched request timed out", retryable=True) from None
+        finally:
+            # Once every caller has gone, nobody needs the batch's responses
+            if batch.task is not None and all(item[3].done() for item in batch.items):
+                batch.task.cancel()
+
+    def _adispatch(self, key, batch):
+        if self._aopen.get(key) is not batch:
+            return
+        del self._aopen[key]
+        batch.task = asyncio.get_running_loop().create_task(self._arun(key[0], batch))
+        self._tasks.add(batch.task)
+        batch.task.add_done_callback(self._tasks.discard)
+
+    def _start(self, batch):
+        """Fail the batch's expired completions; returns the rest and the batch timeout"""
+        now = time.monotonic()
+        items = []
+        deadlines = []
+        for messages, expires, queued_at, result in batch.items:
+            if result.done():
+                continue
+            if expires is not None and expires <= now:
+                result.set_exception(BackendError("Batched request timed out", retryable=True))
+                continue
+            items.append((messages, result))
+            deadlines.append(expires)
+            if self.queue_wait is not None:
+                self.queue_wait.observe(now - queued_at)
+        if not items:
+            return items, None
+        with self._lock:
+            self.batches += 1
+            self.items += len(items)
+        if self.sizes is not None:
+            self.sizes.observe(len(items))
+        deadlines = [expires for expires in deadlines if expires is not None]
+        timeout = min(deadlines) - now if deadlines else None
+        return items, timeout
+
+    @staticmethod
+    def _finish(items, responses):
+        if len(responses) != len(items):
+            raise BackendError(f"Backend returned {len(responses)} responses for a batch of {len(items)}")
+        for (_, result), response in zip(items, responses):
+            if not result.done():
+                result.set_result(response)
+
+    @staticmethod
+    def _fail(items, error):
+        for _, result in items:
+            if not result.done():
+                result.set_exception(error)
+
+    def _run(self, model, batch):
+        items, timeout = self._start(batch)
+        if not items:
+            return
+        try:
+            self._finish(items, batch.fn(model, [messages for messages, _ in items], timeout))
+        except BaseException as e:
+            self._fail(items, e)
+
+    async def _arun(self, model, batch):
+        items, timeout = self._start(batch)
+        if not items:
+            return
+        try:
+            self._finish(items, await batch.fn(model, [messages for messages, _ in items], timeout))
+        except asyncio.CancelledError:
+            self._fail(items, BackendError("Batch cancelled", retryable=True))
+            raise
+        except Exception as e:
+            self._fail(items, e)
+
+    def stats(self):
+        with self._lock:
+            return {"batches": self.batches, "items": self.items, "open": len(self._open) + len(self._aopen)}
@@ -0,0 +1,4 @@
+"""Benchmark scripts for the Mira gRPC server.
+
+Run them from the repository root, e.g. ``python -m benchmarks.stream_latency``.
+"""
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Measure BulkSummarize wall-clock time for a batch of URLs.
+
+Start a server first, allowing it to fetch from the local page stand-in
+(python server.py --bulk-concurrency 8 --fetch-allow-private), then run:
+
+    python -m benchmarks.bulk_summarize --batch-size 50
+
+The URLs point at a local page stand-in (benchmarks/page_server.py) started
+in-process, so the server's fetch stage is part of the measurement; use
+--page-base-url to summarize other pages. Each round sends the same batch,
+so later rounds show the effect of the fetch cache. The stand-in reports
+how many requests and connections it served.
+"""
+import argparse
+import time
+
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+
+from benchmarks.page_server import start_page_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", default="localhost:50051")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--max-length", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--page-base-url", default=None,
+                        help="Summarize pages under this URL instead of starting the local stand-in")
+    parser.add_argument("--page-latency", type=float, default=0.05,
+                        help="Seconds the local stand-in takes to answer each page request")
+    args = parser.parse_args()
+
+    pages = None
+    base_url = args.page_base_url
+    if base_url is None:
+        pages, base_url = start_page_server(latency=args.page_latency)
+    requests = [chatbot_pb2.UrlRequest(url=f"{base_url}/page/{i}", max_length=args.max_length)
+                for i in range(args.batch_size)]
+
+    print(f"BulkSummarize of {args.batch_size} URLs under {base_url} against {args.target}")
+    print(f"{'round':>5} {'wall clock':>11} {'per URL':>9} {'failed':>7}"
+          + (f" {'page requests':>14} {'304s':>5} {'connections':>12}" if pages else ""))
+    with grpc.insecure_channel(args.target) as channel:
+        stub = chatbot_pb2_grpc.ChatServiceStub(channel)
+        for round_number in range(1, args.rounds + 1):
+            before = dict(pages.counts) if pages else None
+            start = time.perf_counter()
+            response = stub.BulkSummarize(iter(requests))
+            elapsed = time.perf_counter() - start
+            failed = sum(1 for summary in response.summaries if not summary.success)
+            line = (f"{round_number:>5} {elapsed * 1000:9.1f}ms "
+                    f"{elapsed * 1000 / max(1, response.total_processed):7.1f}ms {failed:>7}")
+            if pages:
+                counts = {name: pages.counts[name] - before[name] for name in before}
+                line += f" {counts['requests']:>14} {counts['not_modified']:>5} {counts['connections']:>12}"
+            print(line)
+            if failed and round_number == 1:
+                print(f"      first error: {next(s.error_message for s in response.summaries if not s.success)}")
+
+    if pages:
+        pages.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Compare the previous threaded ChatSession client with ChatClient.
+
+The previous client ran each conversation on its own thread, feeding the
+stream from a generator that polled a queue every 100ms. This runs the same
+number of conversations both ways and reports turn latency, CPU used while
+the conversations sit idle, the time to close them all, and the threads the
+process needs; then it runs ChatClient alone with many more conversations on
+its one channel:
+
+    python -m benchmarks.chat_client --spawn-server --aio --conversations 200 --many 2000
+"""
+import argparse
+import asyncio
+import queue
+import threading
+import time
+import uuid
+
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+
+from benchmarks.load import spawn_server
+from benchmarks.stream_latency import percentile
+from chat_client import ChatClient
+
+
+def chat_message(text, session_id):
+    return chatbot_pb2.ChatMessage(text=text, sender="user", message_id=str(uuid.uuid4()),
+                                   session_id=session_id, user_id="bench")
+
+
+class PollingConversation:
+    """One conversation the way client.py used to hold it: a thread and a polling generator"""
+
+    def __init__(self, stub):
+        self.session_id = str(uuid.uuid4())
+        self.outgoing = queue.Queue()
+        self.replies = queue.Queue()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._receive, args=(stub,), daemon=True)
+        self.thread.start()
+
+    def _messages(self):
+        while not self.stop_event.is_set():
+            try:
+                yield self.outgoing.get(block=True, timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def _receive(self, stub):
+        try:
+            for response in stub.ChatSession(self._messages()):
+                self.replies.put(response)
+        except grpc.RpcError as e:
+            if not self.stop_event.is_set():
+                self.replies.put(e)
+
+    def send(self, text):
+        self.outgoing.put(chat_message(text, self.session_id))
+        reply = self.replies.get()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+def run_polling(target, args):
+    with grpc.insecure_channel(target) as channel:
+        stub = chatbot_pb2_grpc.ChatServiceStub(channel)
+        conversations = [PollingConversation(stub) for _ in range(args.conversations)]
+        latencies = []
+        lock = threading.Lock()
+
+        def talk(conversation):
+            for turn in range(args.turns):
+                start = time.perf_counter()
+                conversation.send(f"turn {turn}")
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=talk, args=(conversation,)) for conversation in conversations]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        threads = threading.active_count()
+        start = time.process_time()
+        time.sleep(args.idle)
+        idle_cpu = time.process_time() - start
+        start = time.perf_counter()
+        for conversation in conversations:
+            conversation.stop_event.set()
+        for conversation in conversations:
+            conversation.thread.join()
+        return latencies, idle_cpu, time.perf_counter() - start, threads
+
+
+async def run_chat_client(target, conversation_count, args):
+    # Streams stay open through the idle period, as the polling client's do
+    async with ChatClient(target, idle_timeout=args.idle + 60) as client:
+        conversations = [client.conversation("bench") for _ in range(conversation_count)]
+        latencies = []
+
+        async def talk(conversation):
+            for turn in range(args.turns):
+                start = time.perf_counter()
+                await conversation.send(f"turn {turn}")
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(talk(conversation) for conversation in conversations))
+        reconnects = sum(conversation.reconnects for conversation in conversations)
+        threads = threading.active_count()
+        start = time.process_time()
+        await asyncio.sleep(args.idle)
+        idle_cpu = time.process_time() - start
+        start = time.perf_counter()
+        await asyncio.gather(*(conversation.close() for conversation in conversations))
+        return latencies, idle_cpu, time.perf_counter() - start, threads, reconnects
+
+
+def report(name, latencies, idle_cpu, close_seconds, threads, args, extra=""):
+    print(f"{name:<34} turn p50={percentile(latencies, 50) * 1000:6.2f}ms p99={percentile(latencies, 99) * 1000:7.2f}ms  "
+          f"idle CPU={idle_cpu / args.idle * 100:5.1f}%  close={close_seconds * 1000:7.1f}ms  threads={threads}{extra}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", default="localhost:50051")
+    parser.add_argument("--conversations", type=int, default=200, help="Conversations for the comparison")
+    parser.add_argument("--many", type=int, default=2000, help="Conversations for the ChatClient-only run (0 to skip)")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per conversation")
+    parser.add_argument("--idle", type=float, default=3.0, help="Seconds the open conversations sit idle")
+    parser.add_argument("--spawn-server", action="store_true",
+                        help="Start a local server with the fake backend instead of using --target")
+    parser.add_argument("--aio", action="store_true", help="Spawn the asyncio server")
+    parser.add_argument("--fake-latency", type=float, default=0.0)
+    parser.add_argument("--fake-tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--fake-error-rate", type=float, default=0.0)
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument for the spawned server (repeatable)")
+    args = parser.parse_args()
+
+    process = None
+    target = args.target
+    if args.spawn_server:
+        process, target = spawn_server(args)
+    try:
+        *results, _ = asyncio.run(run_chat_client(target, args.conversations, args))
+        report(f"ChatClient, {args.conversations} conversations", *results, args)
+        report(f"polling threads, {args.conversations} conversations", *run_polling(target, args), args)
+        if args.many:
+            *results, reconnects = asyncio.run(run_chat_client(target, args.many, args))
+            report(f"ChatClient, {args.many} conversations", *results, args, f"  reconnects={reconnects}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Compare ChatSession prompt sizes: fixed 20-message window vs token budget vs rolling summary.
+
+Replays a long synthetic conversation (mostly short turns with occasional
+long pastes) in-process and reports estimated prompt tokens per turn:
+
+    python -m benchmarks.context_window --turns 300 --budget 4000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from session_store import Session, estimate_tokens
+
+SYSTEM_PROMPT = "You are mira, a helpful assistant. Maintain conversation context and provide relevant, coherent responses."
+SUMMARY = "word " * 150
+
+
+def conversation(turns, seed=7):
+    rng = random.Random(seed)
+    for i in range(turns):
+        if rng.random() < 0.1:
+            user = "pasted log line with details\n" * rng.randint(50, 400)
+        else:
+            user = "short question " * rng.randint(1, 15)
+        yield user, "assistant answer sentence. " * rng.randint(5, 60)
+
+
+def fixed_window(turns):
+    """The previous design: system prompt plus the last 20 messages, whatever their size"""
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    sizes = []
+    for user, reply in conversation(turns):
+        messages.append({"role": "user", "content": user})
+        if len(messages) > 21:
+            messages = [messages[0]] + messages[-19:]
+        sizes.append(sum(estimate_tokens(m["content"]) for m in messages))
+        messages.append({"role": "assistant", "content": reply})
+    return sizes
+
+
+def budgeted(turns, budget, rolling_summary):
+    session = Session("bench", "bench", SYSTEM_PROMPT, token_budget=budget, rolling_summary=rolling_summary)
+    sizes = []
+    for user, reply in conversation(turns):
+        session.append("user", user)
+        sizes.append(session.prompt_tokens())
+        session.append("assistant", reply)
+        # Stand-in for the background condense call
+        claimed = session.begin_summary()
+        if claimed is not None:
+            session.finish_summary(SUMMARY)
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=300)
+    parser.add_argument("--budget", type=int, default=4000)
+    args = parser.parse_args()
+
+    print(f"{args.turns} turns, token budget {args.budget} (estimated tokens per prompt)")
+    runs = (
+        ("fixed 20 messages", lambda: fixed_window(args.turns)),
+        ("token budget", lambda: budgeted(args.turns, args.budget, False)),
+        ("budget + summary", lambda: budgeted(args.turns, args.budget, True)),
+    )
+    for name, run in runs:
+        start = time.perf_counter()
+        sizes = run()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<20} mean={statistics.mean(sizes):8.0f}  max={max(sizes):8.0f}  "
+              f"total={sum(sizes):10,}  bookkeeping={elapsed / args.turns * 1e6:7.1f}us/turn")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Measure wire bytes and connection costs of the grpc_config options.
+
+Runs a server with the fake backend behind a TCP relay that counts the bytes
+and connections passing through it, then compares:
+
+- a new channel per call (what client.py did on every menu), a new connection
+  per call, and one pooled channel;
+- BulkSummarize responses without compression, gzip and deflate;
+- keepalive off vs on, by the bytes an idle connection costs and by how long
+  a call on a connection that silently stopped delivering packets takes to
+  fail.
+
+    python -m benchmarks.grpc_options --spawn-server
+
+The fake backend's text comes from a small vocabulary and compresses better
+than real summaries would.
+"""
+import argparse
+import socket
+import statistics
+import threading
+import time
+import uuid
+
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+
+from benchmarks.load import spawn_server
+from grpc_config import ChannelPool, channel_options, response_compression, COMPRESSION
+
+
+class CountingRelay:
+    """TCP relay to upstream that counts bytes each way; blackhole() makes it swallow traffic silently"""
+
+    def __init__(self, upstream):
+        host, _, port = upstream.rpartition(":")
+        self.upstream = (host, int(port))
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.target = f"127.0.0.1:{self.listener.getsockname()[1]}"
+        self.lock = threading.Lock()
+        self.dropping = False
+        self.reset()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def reset(self):
+        with self.lock:
+            self.to_server = self.to_client = self.connections = 0
+
+    def blackhole(self, dropping=True):
+        self.dropping = dropping
+
+    def _accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            server = socket.create_connection(self.upstream)
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections += 1
+            threading.Thread(target=self._pump, args=(client, server, "to_server"), daemon=True).start()
+            threading.Thread(target=self._pump, args=(server, client, "to_client"), daemon=True).start()
+
+    def _pump(self, source, destination, counter):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if self.dropping:
+                    continue
+                with self.lock:
+                    setattr(self, counter, getattr(self, counter) + len(data))
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, destination):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def totals(self):
+        with self.lock:
+            return self.to_server, self.to_client, self.connections
+
+
+def get_reply(stub, i, timeout=10):
+    return stub.GetReply(chatbot_pb2.ChatRequest(user_message=f"Hello {i}"), timeout=timeout)
+
+
+def connection_setup(relay, args):
+    print(f"GetReply x{args.calls}")
+    # New channels to one target share a connection through grpc's global subchannel pool
+    # while it is still open; own_connection forces a new connection and handshake
+    setups = {
+        "new channel per call": channel_options(),
+        "new connection per call": channel_options(own_connection=True),
+        "pooled channel": None,
+    }
+    for name, options in setups.items():
+        relay.reset()
+        latencies = []
+        pool = ChannelPool(relay.target, options=channel_options())
+        for i in range(args.calls):
+            start = time.perf_counter()
+            if options is None:
+                get_reply(chatbot_pb2_grpc.ChatServiceStub(pool.get()), i)
+            else:
+                with grpc.insecure_channel(relay.target, options=options) as channel:
+                    get_reply(chatbot_pb2_grpc.ChatServiceStub(channel), i)
+            latencies.append(time.perf_counter() - start)
+        pool.close()
+        to_server, to_client, connections = relay.totals()
+        print(f"  {name:<24} p50={statistics.median(latencies) * 1000:6.2f}ms  connections={connections:<4} "
+              f"bytes/call={(to_server + to_client) / args.calls:7.0f}")
+
+
+def compression(relay, args):
+    print(f"BulkSummarize of {args.bulk_size} URLs x{args.bulk_calls}")
+    with grpc.insecure_channel(relay.target, options=channel_options()) as channel:
+        stub = chatbot_pb2_grpc.ChatServiceStub(channel)
+        for name in COMPRESSION:
+            relay.reset()
+            latencies = []
+            response_bytes = 0
+            for _ in range(args.bulk_calls):
+                batch = uuid.uuid4().hex
+                requests = [chatbot_pb2.UrlRequest(url=f"https://example.com/{batch}/{i}", max_length=args.max_length)
+                            for i in range(args.bulk_size)]
+                start = time.perf_counter()
+                response = stub.BulkSummarize(iter(requests), metadata=response_compression(name), timeout=30)
+                latencies.append(time.perf_counter() - start)
+                response_bytes += response.ByteSize()
+            _, to_client, _ = relay.totals()
+            print(f"  {name:<8} p50={statistics.median(latencies) * 1000:7.2f}ms  response={response_bytes / args.bulk_calls:7.0f} B  "
+                  f"on the wire={to_client / args.bulk_calls:7.0f} B/call ({to_client / response_bytes:.0%})")
+
+
+def keepalive(relay, args):
+    print(f"Keepalive (pings every {args.keepalive_time}s)")
+    for enabled in (False, True):
+        name = "on" if enabled else "off"
+        options = channel_options(keepalive_time=args.keepalive_time if enabled else 0,
+                                  keepalive_timeout=args.keepalive_timeout, own_connection=True)
+        with grpc.insecure_channel(relay.target, options=options) as channel:
+            stub = chatbot_pb2_grpc.ChatServiceStub(channel)
+            get_reply(stub, 0)
+            relay.reset()
+            time.sleep(args.idle)
+            to_server, to_client, _ = relay.totals()
+            print(f"  {name:<4} idle {args.idle:.0f}s: {to_server + to_client} bytes")
+
+            # The connection stays open but nothing gets through, as when a peer or NAT vanishes
+            relay.blackhole()
+            start = time.perf_counter()
+            try:
+                get_reply(stub, 1, timeout=args.deadline)
+                outcome = "OK"
+            except grpc.RpcError as e:
+                outcome = e.code().name
+            relay.blackhole(False)
+            print(f"  {name:<4} dead connection: call failed with {outcome} after {time.perf_counter() - start:.1f}s "
+                  f"(deadline {args.deadline:.0f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", default="localhost:50051")
+    parser.add_argument("--calls", type=int, default=200, help="GetReply calls per channel setup")
+    parser.add_argument("--bulk-calls", type=int, default=20, help="BulkSummarize calls per compression")
+    parser.add_argument("--bulk-size", type=int, default=20, help="URLs per BulkSummarize call")
+    parser.add_argument("--max-length", type=int, default=100, help="max_length of each URL summary")
+    parser.add_argument("--keepalive-time", type=float, default=10.0,
+                        help="Client keepalive interval while measuring (the server refuses pings more often than 10s)")
+    parser.add_argument("--keepalive-timeout", type=float, default=2.0)
+    parser.add_argument("--idle", type=float, default=21.0, help="Seconds the connection is left idle")
+    parser.add_argument("--deadline", type=float, default=30.0, help="Deadline of the call on a dead connection")
+    parser.add_argument("--spawn-server", action="store_true",
+                        help="Start a local server with the fake backend instead of using --target")
+    parser.add_argument("--aio", action="store_true", help="Spawn the asyncio server")
+    parser.add_argument("--fake-latency", type=float, default=0.0)
+    parser.add_argument("--fake-tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--fake-error-rate", type=float, default=0.0)
+    parser.add_argument("--server-arg", action="append", default=["--no-fetch", "--cache-size=0"],
+                        help="Extra argument for the spawned server (repeatable)")
+    args = parser.parse_args()
+
+    process = None
+    target = args.target
+    if args.spawn_server:
+        process, target = spawn_server(args)
+    relay = CountingRelay(target)
+    try:
+        connection_setup(relay, args)
+        compression(relay, args)
+        keepalive(relay, args)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""Non-interactive load generator for all four RPC patterns.
+
+Drives GetReply, StreamResponse, BulkSummarize and ChatSession one after the
+other at a fixed concurrency, either as fast as the workers allow (closed
+loop) or at a target request rate (--rate, open loop). Reports latency
+percentiles, time to first chunk, throughput and errors per RPC, and can
+write them as JSON to compare runs over time.
+
+Against a running server:
+
+    python -m benchmarks.load --duration 10 --concurrency 16
+
+Or let it start a local server with the fake backend, and a local page
+stand-in for BulkSummarize to fetch, e.g. in CI:
+
+    python -m benchmarks.load --spawn-server --duration 5 --output results.json
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent import futures
+from datetime import datetime
+
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+
+from benchmarks.page_server import start_page_server
+from benchmarks.stream_latency import percentile
+
+RPCS = ("get_reply", "stream_response", "bulk_summarize", "chat_session")
+
+# Text the servicer sends instead of a ChatSession reply when the turn failed (turns refused by the rate
+# limit are told apart by retry_after_ms instead)
+CHAT_ERROR_PREFIX = "Sorry, I encountered an error"
+
+
+class CallResult:
+    """Outcome of one RPC: latency, time to first response message, and error code (None if ok)"""
+
+    __slots__ = ("latency", "first_response", "error", "items", "failed_items")
+
+    def __init__(self, latency, first_response=None, error=None, items=1, failed_items=0):
+        self.latency = latency
+        self.first_response = first_response if first_response is not None else latency
+        self.error = error
+        self.items = items
+        self.failed_items = failed_items
+
+
+class LoadClient:
+    """Runs single calls of each RPC pattern and times them"""
+
+    def __init__(self, stub, args):
+        self.stub = stub
+        self.args = args
+
+    def message(self, i):
+        # Unique messages keep the response cache from answering every request
+        return self.args.message if self.args.repeat else f"{self.args.message} (request {i})"
+
+    def get_reply(self, i, start):
+        self.stub.GetReply(chatbot_pb2.ChatRequest(user_message=self.message(i)), timeout=self.args.timeout)
+        return CallResult(time.perf_counter() - start)
+
+    def stream_response(self, i, start):
+        first = None
+        for chunk in self.stub.StreamResponse(chatbot_pb2.ChatRequest(user_message=self.message(i)),
+                                              timeout=self.args.timeout):
+            if first is None and chunk.content:
+                first = time.perf_counter() - start
+        return CallResult(time.perf_counter() - start, first)
+
+    def bulk_summarize(self, i, start):
+        requests = [chatbot_pb2.UrlRequest(url=f"{self.args.page_base_url}/{i}/page/{n}", max_length=50)
+                    for n in range(self.args.bulk_size)]
+        response = self.stub.BulkSummarize(iter(requests), timeout=self.args.timeout)
+        failed = sum(1 for summary in response.summaries if not summary.success)
+        # A call whose every URL failed measured nothing but the failure path
+        error = "ALL_ITEMS_FAILED" if failed and failed == len(response.summaries) else None
+        return CallResult(time.perf_counter() - start, error=error, items=len(response.summaries),
+                          failed_items=failed)
+
+    def chat_session(self, i, start):
+        """One conversation of --chat-turns turns; each message is sent once the previous reply arrives"""
+        session_id = str(uuid.uuid4())
+        outgoing = queue.Queue()
+
+        def requests():
+            while True:
+                text = outgoing.get()
+                if text is None:
+                    return
+                yield chatbot_pb2.ChatMessage(text=text, sender="user", session_id=session_id,
+                                              user_id=f"load-{i % self.args.users}",
+                                              message_id=str(uuid.uuid4()))
+
+        first = None
+        failed = 0
+        turns = 0
+        outgoing.put(f"{self.message(i)} turn 0")
+        try:
+            for reply in self.stub.ChatSession(requests(), timeout=self.args.timeout):
+                if first is None:
+                    first = time.perf_counter() - start
+                if reply.retry_after_ms or reply.text.startswith(CHAT_ERROR_PREFIX):
+                    failed += 1
+                turns += 1
+                outgoing.put(f"{self.message(i)} turn {turns}" if turns < self.args.chat_turns else None)
+        finally:
+            outgoing.put(None)
+        return CallResult(time.perf_counter() - start, first, "TURN_FAILED" if failed else None,
+                          items=turns, failed_items=failed)
+
+
+def run_phase(client, rpc, args):
+    """Run one RPC pattern for --duration seconds (or --requests calls) and return its CallResults"""
+    call = getattr(client, rpc)
+    results = []
+    results_lock = threading.Lock()
+    counter = iter(range(sys.maxsize))
+    counter_lock = threading.Lock()
+
+    def next_index():
+        with counter_lock:
+            i = next(counter)
+        return i if args.requests is None or i < args.requests else None
+
+    def timed(i, start):
+        try:
+            result = call(i, start)
+        except grpc.RpcError as e:
+            result = CallResult(time.perf_counter() - start, error=e.code().name)
+        with results_lock:
+            results.append(result)
+
+    phase_start = time.perf_counter()
+    deadline = phase_start + args.duration
+
+    if args.rate:
+        # Open loop: calls start on a fixed schedule and latency counts from the
+        # scheduled start, so queueing behind slow calls is not hidden
+        interval = 1.0 / args.rate
+        with futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            scheduled = phase_start
+            while scheduled < deadline:
+                i = next_index()
+                if i is None:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(timed, i, scheduled)
+                scheduled += interval
+    else:
+        # Closed loop: each worker starts its next call as soon as the last one ends
+        def worker():
+            while time.perf_counter() < deadline:
+                i = next_index()
+                if i is None:
+                    return
+                timed(i, time.perf_counter())
+
+        workers = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+    return results, time.perf_counter() - phase_start
+
+
+def distribution(values):
+    if not values:
+        return None
+    return {
+        "mean_ms": statistics.mean(values) * 1000,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": max(values) * 1000,
+    }
+
+
+def summarize(results, elapsed):
+    errors = {}
+    for result in results:
+        if result.error:
+            errors[result.error] = errors.get(result.error, 0) + 1
+    ok = [result for result in results if result.error is None]
+    items = sum(result.items for result in results)
+    return {
+        "requests": len(results),
+        "errors": sum(errors.values()),
+        "error_rate": sum(errors.values()) / len(results) if results else 0.0,
+        "errors_by_code": errors,
+        "items": items,
+        "failed_items": sum(result.failed_items for result in results),
+        "elapsed_s": elapsed,
+        "rps": len(results) / elapsed if elapsed else 0.0,
+        "latency": distribution([result.latency for result in ok]),
+        "time_to_first_response": distribution([result.first_response for result in ok]),
+    }
+
+
+def report(rpc, stats):
+    print(f"{rpc}: {stats['requests']} calls, {stats['rps']:.1f} req/s, "
+          f"{stats['errors']} errors ({stats['error_rate'] * 100:.1f}%)"
+          + (f" {stats['errors_by_code']}" if stats["errors_by_code"] else ""))
+    if stats["failed_items"]:
+        print(f"  {stats['failed_items']} of {stats['items']} items failed")
+    for name, key in (("latency", "latency"), ("first response", "time_to_first_response")):
+        values = stats[key]
+        if values:
+            print(f"  {name:<16} p50={values['p50_ms']:8.1f}ms p95={values['p95_ms']:8.1f}ms "
+                  f"p99={values['p99_ms']:8.1f}ms max={values['max_ms']:8.1f}ms")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def spawn_server(args, local_pages=False):
+    """Start server.py with the fake backend on a free port; returns (process, target).
+
+    With local_pages, the server may fetch from the loopback page stand-in.
+    """
+    port = free_port()
+    server_script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+    command = [sys.executable, server_script, "--backend", "fake", "--port", str(port),
+               "--fake-latency", str(args.fake_latency), "--fake-tokens-per-second", str(args.fake_tokens_per_second),
+               "--fake-error-rate", str(args.fake_error_rate)]
+    if args.aio:
+        command.append("--aio")
+    if local_pages:
+        command.append("--fetch-allow-private")
+    command.extend(args.server_arg)
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    target = f"localhost:{port}"
+    with grpc.insecure_channel(target) as channel:
+        try:
+            grpc.channel_ready_future(channel).result(timeout=15)
+        except grpc.FutureTimeoutError:
+            process.kill()
+            raise SystemExit(f"Server did not start: {' '.join(command)}")
+    return process, target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", default="localhost:50051")
+    parser.add_argument("--rpc", action="append", choices=RPCS,
+                        help="RPC pattern to load (repeatable, default: all four)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Concurrent calls (worker threads)")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Target calls per second for each RPC (default: closed loop, as fast as possible)")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="Seconds to load each RPC")
+    parser.add_argument("--requests", type=int, default=None,
+                        help="Stop each RPC after this many calls, even if --duration has not passed")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="Per-call deadline in seconds")
+    parser.add_argument("--message", default="Explain how gRPC streaming works.")
+    parser.add_argument("--repeat", action="store_true",
+                        help="Send the identical message every time instead of unique ones")
+    parser.add_argument("--bulk-size", type=int, default=10,
+                        help="URLs per BulkSummarize call")
+    parser.add_argument("--chat-turns", type=int, default=3,
+                        help="Messages per ChatSession conversation")
+    parser.add_argument("--users", type=int, default=100,
+                        help="Distinct user_ids used by ChatSession")
+    parser.add_argument("--page-base-url", default=None,
+                        help="BulkSummarize pages under this URL (default: a local page stand-in with "
+                             "--spawn-server, else https://example.com)")
+    parser.add_argument("--page-latency", type=float, default=0.02,
+                        help="Seconds the local page stand-in takes to answer each request")
+    parser.add_argument("--output", default=None,
+                        help="Write results to this JSON file")
+    parser.add_argument("--spawn-server", action="store_true",
+                        help="Start a local server with the fake backend instead of using --target")
+    parser.add_argument("--aio", action="store_true",
+                        help="With --spawn-server: run the asyncio server")
+    parser.add_argument("--fake-latency", type=float, default=0.05,
+                        help="With --spawn-server: fake backend seconds to first token")
+    parser.add_argument("--fake-tokens-per-second", type=float, default=2000.0,
+                        help="With --spawn-server: fake backend token rate")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0,
+                        help="With --spawn-server: fraction of fake backend calls that fail")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="With --spawn-server: extra argument for server.py (repeatable, e.g. --server-arg=--cache-size=0)")
+    args = parser.parse_args()
+    rpcs = args.rpc or list(RPCS)
+
+    process = None
+    target = args.target
+    pages = None
+    if args.page_base_url is None:
+        if args.spawn_server:
+            pages, args.page_base_url = start_page_server(latency=args.page_latency)
+        else:
+            args.page_base_url = "https://example.com"
+    if args.spawn_server:
+        process, target = spawn_server(args, local_pages=pages is not None)
+    try:
+        results = {}
+        with grpc.insecure_channel(target) as channel:
+            client = LoadClient(chatbot_pb2_grpc.ChatServiceStub(channel), args)
+            print(f"Load test against {target} (concurrency {args.concurrency}, "
+                  f"{f'{args.rate:g} req/s' if args.rate else 'closed loop'})")
+            for rpc in rpcs:
+                call_results, elapsed = run_phase(client, rpc, args)
+                results[rpc] = summarize(call_results, elapsed)
+                report(rpc, results[rpc])
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if pages is not None:
+            pages.shutdown()
+
+    if args.output:
+        run = {
+            "timestamp": datetime.now().isoformat(),
+            "target": "spawned fake-backend server" if args.spawn_server else target,
+            "options": {key: value for key, value in vars(args).items() if key not in ("output", "target")},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"Results written to {os.path.abspath(args.output)}")
+
+    failed = [rpc for rpc, stats in results.items() if stats["requests"] and stats["errors"] == stats["requests"]]
+    if failed:
+        raise SystemExit(f"Every call failed: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
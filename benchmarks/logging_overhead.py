@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Measure what request logging costs the RPC threads.
+
+Worker threads replay the log lines of one GetReply call (the received user
+message and the generated response) with realistic payload sizes, under the
+previous setup (f-strings with full payloads through a locked stream
+handler) and the structured logging options. Log output goes to a temporary
+file. In-process, no server needed:
+
+    python -m benchmarks.logging_overhead --threads 8 --requests 20000
+"""
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from structured_logging import configure_logging, payload, rpc_log, stop_logging
+
+# (name, configure_logging options, use the previous f-string call sites)
+SETUPS = [
+    ("f-string, full payload", {"payload_mode": "full", "use_queue": False}, True),
+    ("lazy, truncated", {"payload_mode": "truncate", "use_queue": False}, False),
+    ("lazy, truncated, queue", {"payload_mode": "truncate"}, False),
+    ("lazy, redacted, json, queue", {"payload_mode": "redact", "json_format": True}, False),
+    ("lazy, truncated, queue, 1% sampled", {"payload_mode": "truncate", "default_sample_rate": 0.01}, False),
+    ("f-string, INFO disabled", {"level": logging.WARNING, "use_queue": False}, True),
+    ("lazy, INFO disabled", {"level": logging.WARNING, "use_queue": False}, False),
+]
+
+
+def legacy_request(message, response):
+    logging.info(f"Received message: {message}")
+    logging.info(f"Generated response: {response}")
+
+
+def structured_request(message, response):
+    log = rpc_log("GetReply")
+    log.info("Received message: %s", payload(message))
+    log.info("Generated response: %s", payload(response))
+
+
+def run(setup, args, message, response, path):
+    name, options, legacy = setup
+    with open(path, "w") as stream:
+        configure_logging(stream=stream, **options)
+        request = legacy_request if legacy else structured_request
+        barrier = threading.Barrier(args.threads + 1)
+
+        def worker():
+            barrier.wait()
+            for _ in range(args.requests // args.threads):
+                request(message, response)
+
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        caller_time = time.perf_counter() - start
+        # Includes draining the queue, i.e. the total work done for logging
+        stop_logging()
+        total_time = time.perf_counter() - start
+    size = os.path.getsize(path)
+    requests = args.threads * (args.requests // args.threads)
+    print(f"{name:<36} {caller_time / requests * 1e6:9.1f}us {requests / caller_time:11.0f}/s "
+          f"{total_time / requests * 1e6:9.1f}us {size / 1e6:9.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--message-bytes", type=int, default=500)
+    parser.add_argument("--response-bytes", type=int, default=3000)
+    args = parser.parse_args()
+
+    message = ("How do I tune the gRPC server? " * 100)[:args.message_bytes]
+    response = ("Start by measuring the latency of each RPC. " * 200)[:args.response_bytes]
+
+    print(f"{args.requests} requests on {args.threads} threads, "
+          f"{args.message_bytes}B message and {args.response_bytes}B response per request")
+    print(f"{'setup':<36} {'per request':>11} {'throughput':>13} {'incl. drain':>11} {'written':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "server.log")
+        for setup in SETUPS:
+            run(setup, args, message, response, path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Measure the throughput and added latency of micro-batching completions.
+
+Starts a server with the fake backend limited to --fake-concurrency calls at
+a time (a batch counts as one call), like a local model server with that
+many slots, once without batching and once per --batch-wait with
+--batch-size. For each it reports GetReply latency with a single client
+(the latency batching adds when there is nothing to batch with), GetReply
+throughput and latency under --concurrency closed-loop clients, the time of
+one BulkSummarize of --bulk-size URLs, and the average batch size:
+
+    python -m benchmarks.micro_batching --batch-wait 0.005 0.01 0.02
+
+Without a concurrency limit the fake backend runs every call in parallel,
+and batching can only add latency.
+"""
+import argparse
+import re
+import threading
+import time
+import urllib.request
+import uuid
+
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+
+from benchmarks.load import free_port, spawn_server
+from benchmarks.stream_latency import percentile
+
+
+def closed_loop(stub, concurrency, duration):
+    """GetReply calls from concurrency threads for duration seconds; returns (latencies, errors)"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def worker():
+        while time.monotonic() < stop_at:
+            start = time.perf_counter()
+            try:
+                stub.GetReply(chatbot_pb2.ChatRequest(user_message=f"Question {uuid.uuid4()}"), timeout=30)
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            except grpc.RpcError as e:
+                with lock:
+                    errors.append(e.code())
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def bulk_summarize(stub, size):
+    batch = uuid.uuid4().hex
+    start = time.perf_counter()
+    response = stub.BulkSummarize(iter([chatbot_pb2.UrlRequest(url=f"https://example.com/{batch}/{i}", max_length=50)
+                                        for i in range(size)]), timeout=60)
+    failed = sum(1 for summary in response.summaries if not summary.success)
+    return time.perf_counter() - start, failed
+
+
+def mean_batch_size(metrics_port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+        body = response.read().decode()
+    total = re.search(r"^llm_batch_size_sum (\S+)", body, re.M)
+    count = re.search(r"^llm_batch_size_count (\S+)", body, re.M)
+    if not (total and count and float(count.group(1))):
+        return 1.0
+    return float(total.group(1)) / float(count.group(1))
+
+
+def run(label, server_args, args):
+    metrics_port = free_port()
+    spawn_args = argparse.Namespace(**vars(args))
+    spawn_args.server_arg = [*args.server_arg, *server_args, f"--metrics-port={metrics_port}",
+                             f"--fake-concurrency={args.fake_concurrency}"]
+    process, target = spawn_server(spawn_args)
+    try:
+        with grpc.insecure_channel(target) as channel:
+            stub = chatbot_pb2_grpc.ChatServiceStub(channel)
+            single, _ = closed_loop(stub, 1, args.single_duration)
+            loaded, errors = closed_loop(stub, args.concurrency, args.duration)
+            bulk_seconds, bulk_failed = bulk_summarize(stub, args.bulk_size)
+        batch_size = mean_batch_size(metrics_port) if server_args else 1.0
+    finally:
+        process.terminate()
+        process.wait()
+    print(f"{label:<18} single p50={percentile(single, 50) * 1000:6.0f}ms  "
+          f"x{args.concurrency}: {len(loaded) / args.duration:6.1f} calls/s p50={percentile(loaded, 50) * 1000:6.0f}ms "
+          f"p99={percentile(loaded, 99) * 1000:6.0f}ms errors={len(errors):<3} "
+          f"bulk x{args.bulk_size}={bulk_seconds * 1000:6.0f}ms (failed {bulk_failed})  "
+          f"mean batch={batch_size:4.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-wait", type=float, nargs="+", default=[0.005, 0.01, 0.02],
+                        help="Batching windows to compare, in seconds")
+    parser.add_argument("--batch-size", type=int, default=8, help="Most completions per batch")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Closed-loop GetReply clients (the threaded server has 10 workers)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load at --concurrency")
+    parser.add_argument("--single-duration", type=float, default=3.0, help="Seconds of load from a single client")
+    parser.add_argument("--bulk-size", type=int, default=8, help="URLs in the BulkSummarize call")
+    parser.add_argument("--aio", action="store_true", help="Spawn the asyncio server")
+    parser.add_argument("--fake-latency", type=float, default=0.1)
+    parser.add_argument("--fake-tokens-per-second", type=float, default=1000.0)
+    parser.add_argument("--fake-error-rate", type=float, default=0.0)
+    parser.add_argument("--fake-concurrency", type=int, default=1,
+                        help="Calls the fake backend runs at a time (a batch counts as one)")
+    parser.add_argument("--server-arg", action="append",
+                        default=["--no-fetch", "--cache-size=0", "--log-level=warning"],
+                        help="Extra argument for the spawned server (repeatable)")
+    args = parser.parse_args()
+
+    print(f"Fake backend: {args.fake_latency * 1000:.0f}ms to first token, {args.fake_tokens_per_second:.0f} tokens/s, "
+          f"{args.fake_concurrency} at a time")
+    run("no batching", [], args)
+    for wait in args.batch_wait:
+        run(f"batch {args.batch_size}, {wait * 1000:.0f}ms", [f"--batch-size={args.batch_size}", f"--batch-wait={wait}"],
+            args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Measure GetReply throughput of the multi-process server with 1 to N workers.
+
+Starts server.py --workers N for each worker count with the fake backend
+answering instantly and the response cache off, so every call spends its
+time in the server's own Python code (protobuf, prompt assembly, logging).
+Load comes from several client processes, each with its own connection,
+since SO_REUSEPORT balances connections rather than calls:
+
+    python -m benchmarks.multiprocess_scaling --workers 1 2 4 --clients 8
+
+Scaling needs more cores than workers plus the client processes' share; on
+a machine with fewer, throughput stays flat.
+"""
+import argparse
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+
+from benchmarks.load import free_port
+
+
+def client_process(target, concurrency, duration, index, results):
+    """Closed-loop GetReply calls from concurrency threads over one connection; reports (calls, errors)"""
+    # A local subchannel pool keeps this process's connection to itself, so each client process
+    # lands on a worker of its own
+    channel = grpc.insecure_channel(target, options=[("grpc.use_local_subchannel_pool", 1)])
+    stub = chatbot_pb2_grpc.ChatServiceStub(channel)
+    counts = [0, 0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def worker(thread):
+        calls = errors = 0
+        while time.monotonic() < stop_at:
+            try:
+                stub.GetReply(chatbot_pb2.ChatRequest(user_message=f"client {index}.{thread} call {calls}"), timeout=10)
+                calls += 1
+            except grpc.RpcError:
+                errors += 1
+        with lock:
+            counts[0] += calls
+            counts[1] += errors
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    channel.close()
+    results.put(tuple(counts))
+
+
+def handled_per_worker(metrics_port, workers):
+    """GetReply calls each worker has handled, from its metrics endpoint"""
+    counts = []
+    for index in range(workers):
+        with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port + index}/metrics", timeout=5) as response:
+            body = response.read().decode()
+        counts.append(sum(float(value) for value in re.findall(
+            r'grpc_server_handled_total\{method="GetReply"[^}]*\} (\S+)', body)))
+    return counts
+
+
+def start_server(workers, port, metrics_port, args):
+    """Start the supervisor and wait until every worker serves its metrics"""
+    server_script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+    command = [sys.executable, server_script, "--backend", "fake", "--fake-latency", "0",
+               "--fake-tokens-per-second", "0", "--cache-size", "0", "--log-level", "warning",
+               "--port", str(port), "--metrics-port", str(metrics_port), "--workers", str(workers)]
+    if args.aio:
+        command.append("--aio")
+    command.extend(args.server_arg)
+    process = subprocess.Popen(command)
+    give_up = time.monotonic() + 30
+    while True:
+        try:
+            handled_per_worker(metrics_port, workers)
+            return process
+        except OSError:
+            if process.poll() is not None or time.monotonic() > give_up:
+                process.kill()
+                raise SystemExit(f"Server did not start: {' '.join(command)}")
+            time.sleep(0.2)
+
+
+def run(workers, args):
+    port = free_port()
+    metrics_port = free_port()
+    process = start_server(workers, port, metrics_port, args)
+    try:
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        clients = [context.Process(target=client_process,
+                                   args=(f"localhost:{port}", args.concurrency, args.duration, i, results))
+                   for i in range(args.clients)]
+        for client in clients:
+            client.start()
+        totals = [results.get() for _ in clients]
+        for client in clients:
+            client.join()
+        per_worker = handled_per_worker(metrics_port, workers)
+    finally:
+        process.terminate()
+        process.wait()
+    return sum(calls for calls, _ in totals) / args.duration, sum(errors for _, errors in totals), per_worker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to compare")
+    parser.add_argument("--clients", type=int, default=8, help="Client processes, one connection each")
+    parser.add_argument("--concurrency", type=int, default=4, help="Calls in flight per client process")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load per worker count")
+    parser.add_argument("--aio", action="store_true", help="Run the asyncio server in each worker")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument for server.py (repeatable, e.g. --server-arg=--bulk-concurrency=4)")
+    args = parser.parse_args()
+
+    print(f"GetReply throughput, {args.clients} client processes x {args.concurrency} calls in flight, "
+          f"{os.cpu_count()} CPUs")
+    baseline = None
+    for workers in args.workers:
+        rate, errors, per_worker = run(workers, args)
+        baseline = baseline or rate
+        spread = " / ".join(f"{count:.0f}" for count in per_worker)
+        print(f"{workers:>3} workers {rate:10,.0f} calls/s  x{rate / baseline:4.2f}  errors={errors:<4} "
+              f"calls per worker: {spread}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Local HTTP stand-in serving synthetic web pages for BulkSummarize.
+
+Every path returns a deterministic HTML article (the same path always gets
+the same page) with an ETag and Last-Modified, answers conditional requests
+with 304 Not Modified, and keeps connections alive. --latency delays every
+response to mimic a remote site. Paths under /slow/ take ten times as long,
+/missing/ returns 404, /redirect/<path> redirects to /<path> and pages
+under /gzip/ are sent gzip-compressed to clients that accept it.
+
+    python -m benchmarks.page_server --port 8000 --latency 0.05
+
+and summarize http://localhost:8000/any/path. Benchmarks start it in-process
+with start_page_server().
+"""
+import argparse
+import gzip
+import hashlib
+import sys
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_WORDS = ("grpc", "server", "stream", "latency", "cache", "request", "deadline", "thread", "pool", "token",
+          "model", "summary", "network", "client", "response", "queue", "batch", "session", "backend", "page")
+
+# Fixed so validators stay the same across restarts
+LAST_MODIFIED = formatdate(1700000000, usegmt=True)
+
+
+def render_page(path, paragraphs=20):
+    """Deterministic HTML article for a path, with markup the extractor has to skip"""
+    digest = hashlib.sha256(path.encode("utf-8")).digest()
+    body = []
+    for p in range(paragraphs):
+        words = [_WORDS[digest[(p * 7 + i) % len(digest)] % len(_WORDS)] for i in range(60)]
+        body.append(f"<p>{' '.join(words).capitalize()}.</p>")
+    return (f"<!doctype html><html><head><title>Page {path}</title>"
+            f"<style>p {{ margin: 0 }}</style><script>var tracking = '{path}';</script></head>"
+            f"<body><nav><a href='/'>Home</a></nav><article><h1>Notes on {path}</h1>{''.join(body)}</article>"
+            f"<footer>&copy; stand-in</footer></body></html>").encode("utf-8")
+
+
+class PageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, paragraphs=20):
+        super().__init__(address, _PageHandler)
+        self.latency = latency
+        self.paragraphs = paragraphs
+        self.counts_lock = threading.Lock()
+        self.counts = {"requests": 0, "not_modified": 0, "connections": 0}
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] += 1
+
+    def handle_error(self, request, client_address):
+        # Clients that time out hang up mid-response; anything else is still reported
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _PageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.count("connections")
+
+    def do_GET(self):
+        self.server.count("requests")
+        path = self.path
+        time.sleep(self.server.latency * (10 if path.startswith("/slow/") else 1))
+        if path.startswith("/missing/"):
+            self._send(404, b"not found", "text/plain")
+            return
+        if path.startswith("/redirect/"):
+            self.send_response(302)
+            self.send_header("Location", path[len("/redirect"):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        page = render_page(path, self.server.paragraphs)
+        etag = '"' + hashlib.sha256(page).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        headers = {"ETag": etag, "Last-Modified": LAST_MODIFIED}
+        if path.startswith("/gzip/") and "gzip" in self.headers.get("Accept-Encoding", ""):
+            page = gzip.compress(page, mtime=0)
+            headers["Content-Encoding"] = "gzip"
+        self._send(200, page, "text/html; charset=utf-8", headers)
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_page_server(port=0, latency=0.0, paragraphs=20):
+    """Serve pages from a background thread; returns (server, base URL without a trailing slash)"""
+    server = PageServer(("127.0.0.1", port), latency, paragraphs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before each response")
+    parser.add_argument("--paragraphs", type=int, default=20, help="Paragraphs of about 60 words per page")
+    args = parser.parse_args()
+    server, base_url = start_page_server(args.port, args.latency, args.paragraphs)
+    print(f"Serving pages at {base_url}/")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""Measure chat turn latency and bulk throughput with and without the upstream scheduler.
+
+Starts a server whose fake backend runs at most --fake-concurrency calls at
+a time (the upstream quota), then keeps it busy with BulkSummarize calls
+from a heavy user (--heavy-calls concurrent calls) and a light user (one
+call), while --chat-users ChatSession conversations take turns with a
+pause in between. It runs once without the scheduler, where every call
+queues for the backend in arrival order, and once with
+--upstream-concurrency set to the same quota:
+
+    python -m benchmarks.priority_scheduling --duration 20
+
+and reports chat turn latency, URLs summarized per second for each bulk
+user, and the scheduler's queue wait per priority class.
+"""
+import argparse
+import asyncio
+import re
+import threading
+import time
+import urllib.request
+import uuid
+
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+
+from benchmarks.load import free_port, spawn_server
+from benchmarks.stream_latency import percentile
+from chat_client import ChatClient
+from scheduler import USER_ID_KEY, PRIORITY_CLASSES
+
+
+def bulk_loop(stub, user, size, stop, counts, lock):
+    """BulkSummarize calls as user until stop is set, counting summarized URLs"""
+    while not stop.is_set():
+        batch = uuid.uuid4().hex
+        requests = [chatbot_pb2.UrlRequest(url=f"https://example.com/{batch}/{i}", max_length=50) for i in range(size)]
+        try:
+            response = stub.BulkSummarize(iter(requests), metadata=((USER_ID_KEY, user),), timeout=120)
+        except grpc.RpcError:
+            continue
+        with lock:
+            counts[user] += sum(1 for summary in response.summaries if summary.success)
+
+
+async def chat_users(target, users, think, stop_at):
+    """Chat turns from each user with think seconds between them; returns turn latencies"""
+    latencies = []
+    async with ChatClient(target) as client:
+        async def talk(user):
+            conversation = client.conversation(user_id=user)
+            turn = 0
+            while time.monotonic() < stop_at:
+                start = time.perf_counter()
+                await conversation.send(f"Turn {turn} from {user}: {uuid.uuid4()}")
+                latencies.append(time.perf_counter() - start)
+                turn += 1
+                await asyncio.sleep(think)
+
+        await asyncio.gather(*(talk(f"chat-{i}") for i in range(users)))
+    return latencies
+
+
+def queue_waits(metrics_port):
+    """Mean and count of scheduler queue waits per priority class"""
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+        body = response.read().decode()
+    waits = {}
+    for priority in PRIORITY_CLASSES:
+        total = re.search(rf'^scheduler_queue_seconds_sum\{{class="{priority}"\}} (\S+)', body, re.M)
+        count = re.search(rf'^scheduler_queue_seconds_count\{{class="{priority}"\}} (\S+)', body, re.M)
+        if total and count and float(count.group(1)):
+            waits[priority] = (float(total.group(1)) / float(count.group(1)), int(float(count.group(1))))
+    return waits
+
+
+def run(label, server_args, args):
+    metrics_port = free_port()
+    spawn_args = argparse.Namespace(**vars(args))
+    spawn_args.server_arg = [*args.server_arg, *server_args, f"--metrics-port={metrics_port}",
+                             f"--fake-concurrency={args.fake_concurrency}"]
+    process, target = spawn_server(spawn_args)
+    stop = threading.Event()
+    counts = {"heavy": 0, "light": 0}
+    lock = threading.Lock()
+    try:
+        with grpc.insecure_channel(target) as channel:
+            stub = chatbot_pb2_grpc.ChatServiceStub(channel)
+            users = ["heavy"] * args.heavy_calls + ["light"]
+            threads = [threading.Thread(target=bulk_loop, args=(stub, user, args.bulk_size, stop, counts, lock))
+                       for user in users]
+            for thread in threads:
+                thread.start()
+            # Let the bulk job fill the queue before the first chat turn
+            time.sleep(args.warmup)
+            with lock:
+                counts.update(heavy=0, light=0)
+            start = time.monotonic()
+            latencies = asyncio.run(chat_users(target, args.chat_users, args.think, start + args.duration))
+            elapsed = time.monotonic() - start
+            with lock:
+                rates = {user: count / elapsed for user, count in counts.items()}
+            stop.set()
+            for thread in threads:
+                thread.join()
+        waits = queue_waits(metrics_port) if server_args else {}
+    finally:
+        stop.set()
+        process.terminate()
+        process.wait()
+    print(f"{label:<14} chat turns={len(latencies):<4} p50={percentile(latencies, 50) * 1000:6.0f}ms "
+          f"p99={percentile(latencies, 99) * 1000:6.0f}ms  bulk URLs/s heavy={rates['heavy']:5.1f} "
+          f"light={rates['light']:5.1f}")
+    for priority, (mean, count) in waits.items():
+        print(f"{'':<14} queue wait {priority:<11} mean={mean * 1000:7.1f}ms over {count} calls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds of chat turns under bulk load")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds of bulk load before the chat starts")
+    parser.add_argument("--chat-users", type=int, default=4, help="Concurrent ChatSession conversations")
+    parser.add_argument("--think", type=float, default=0.2, help="Seconds between a reply and the next turn")
+    parser.add_argument("--heavy-calls", type=int, default=3, help="Concurrent BulkSummarize calls of the heavy user")
+    parser.add_argument("--bulk-size", type=int, default=20, help="URLs per BulkSummarize call")
+    parser.add_argument("--aio", action="store_true", help="Spawn the asyncio server")
+    parser.add_argument("--fake-latency", type=float, default=0.1)
+    parser.add_argument("--fake-tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--fake-error-rate", type=float, default=0.0)
+    parser.add_argument("--fake-concurrency", type=int, default=4,
+                        help="Calls the fake backend runs at a time, and the scheduler's --upstream-concurrency")
+    parser.add_argument("--server-arg", action="append",
+                        default=["--no-fetch", "--cache-size=0", "--log-level=warning", "--bulk-concurrency=128"],
+                        help="Extra argument for the spawned server (repeatable)")
+    args = parser.parse_args()
+
+    print(f"Fake backend: {args.fake_latency * 1000:.0f}ms per call, {args.fake_concurrency} at a time; "
+          f"{args.chat_users} chat users, bulk from a heavy user ({args.heavy_calls} calls) and a light user (1 call)")
+    run("no scheduler", [], args)
+    run("scheduler", [f"--upstream-concurrency={args.fake_concurrency}"], args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Measure search index query latency on a large synthetic corpus.
+
+Builds (or reuses) a BM25 index of synthetic documents whose words follow a
+Zipf distribution, so the most common terms have posting lists covering most
+of the corpus, then times open, uncached queries with the default postings
+cut, the same queries reading every posting (and how close the cut's
+results come to the exact ones), and cached queries:
+
+    python -m benchmarks.search_index --documents 1000000
+
+The index is written to --index-dir and reused by later runs with the same
+corpus settings.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from search_index import SearchIndex, build_index, DEFAULT_MAX_POSTINGS, DEFAULT_SEARCH_RESULTS
+
+# Exact results looked at to score the results of the postings cut
+QUALITY_DEPTH = 1000
+
+
+def word(rank):
+    """Pronounceable pseudo-word for a vocabulary rank"""
+    consonants, vowels = "bdfgklmnprstvz", "aeiou"
+    letters = []
+    rank += 1
+    while rank:
+        rank, c = divmod(rank, len(consonants))
+        rank, v = divmod(rank, len(vowels))
+        letters.append(consonants[c] + vowels[v])
+    return "".join(letters)
+
+
+def synthetic_corpus(documents, vocabulary, words, seed=1):
+    """Yield (title, url, text) documents of about words Zipf-distributed words each"""
+    rng = random.Random(seed)
+    terms = [word(rank) for rank in range(vocabulary)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocabulary)))
+    for i in range(documents):
+        text = rng.choices(terms, cum_weights=weights, k=rng.randint(words // 2, words * 3 // 2))
+        yield " ".join(text[:6]).capitalize(), f"https://docs.example/{i}", " ".join(text) + "."
+
+
+def synthetic_queries(count, vocabulary, seed=2):
+    """Queries of 1 to 4 words drawn from the corpus distribution, so common terms are frequent"""
+    rng = random.Random(seed)
+    terms = [word(rank) for rank in range(vocabulary)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocabulary)))
+    return [" ".join(rng.choices(terms, cum_weights=weights, k=rng.randint(1, 4))) for _ in range(count)]
+
+
+def ensure_index(path, documents, vocabulary, words, rebuild):
+    """Build the index unless path already holds one of the same corpus; returns build seconds or None"""
+    settings = {"documents": documents, "vocabulary": vocabulary, "words": words}
+    settings_path = os.path.join(path, "corpus.json")
+    if not rebuild and os.path.exists(os.path.join(path, "meta.json")) and os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) == settings:
+                return None
+    start = time.perf_counter()
+    build_index(synthetic_corpus(documents, vocabulary, words), path)
+    elapsed = time.perf_counter() - start
+    with open(settings_path, "w") as f:
+        json.dump(settings, f)
+    return elapsed
+
+
+def timed(index, queries, k):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(index.search(query, k))
+        latencies.append(time.perf_counter() - start)
+    return latencies, results
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<28} p50={statistics.median(latencies) * 1000:7.3f}ms  p95={p95 * 1000:7.3f}ms  "
+          f"p99={p99 * 1000:7.3f}ms  max={latencies[-1] * 1000:8.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=1000000)
+    parser.add_argument("--vocabulary", type=int, default=100000, help="Distinct words in the corpus")
+    parser.add_argument("--words", type=int, default=40, help="Average words per document")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--exact-queries", type=int, default=100,
+                        help="Queries also run reading every posting, to compare results and latency")
+    parser.add_argument("--results", type=int, default=DEFAULT_SEARCH_RESULTS)
+    parser.add_argument("--max-postings", type=int, default=DEFAULT_MAX_POSTINGS)
+    parser.add_argument("--index-dir", default=os.path.join(tempfile.gettempdir(), "mira-search-bench"))
+    parser.add_argument("--rebuild", action="store_true", help="Build the index even if one can be reused")
+    args = parser.parse_args()
+
+    build_seconds = ensure_index(args.index_dir, args.documents, args.vocabulary, args.words, args.rebuild)
+    size = sum(os.path.getsize(os.path.join(args.index_dir, name)) for name in os.listdir(args.index_dir))
+    if build_seconds is None:
+        print(f"Reusing index in {args.index_dir} ({size / 2**20:.0f} MiB)")
+    else:
+        print(f"Built index of {args.documents:,} documents in {build_seconds:.1f}s ({size / 2**20:.0f} MiB)")
+
+    start = time.perf_counter()
+    index = SearchIndex(args.index_dir, cache_size=0, max_postings=args.max_postings)
+    print(f"Opened in {(time.perf_counter() - start) * 1000:.2f}ms: {len(index):,} documents, {index.terms:,} terms")
+
+    queries = synthetic_queries(args.queries, args.vocabulary)
+    latencies, results = timed(index, queries, args.results)
+    report(f"uncached, {args.max_postings} postings/term", latencies)
+
+    exact_index = SearchIndex(args.index_dir, cache_size=0, max_postings=0)
+    exact_queries = queries[:args.exact_queries]
+    exact_latencies, exact_results = timed(exact_index, exact_queries, args.results)
+    report("uncached, every posting", exact_latencies)
+    kept = close = total = 0
+    for query, cut, exact in zip(exact_queries, results, exact_results):
+        total += len(exact)
+        kept += len({result.url for result in cut} & {result.url for result in exact})
+        if exact:
+            # Many documents score almost the same on common words; a result within 1% of the
+            # k-th exact score is as good an answer as the one it displaced
+            exact_scores = {result.url: result.score for result in exact_index.search(query, QUALITY_DEPTH)}
+            close += sum(1 for result in cut if exact_scores.get(result.url, 0.0) >= exact[-1].score * 0.99)
+    print(f"{'same documents as exact':<28} {kept}/{total} ({kept / max(1, total):.1%})")
+    print(f"{'within 1% of exact k-th':<28} {close}/{total} ({close / max(1, total):.1%})")
+    exact_index.close()
+    index.close()
+
+    cached = SearchIndex(args.index_dir, max_postings=args.max_postings)
+    timed(cached, queries, args.results)
+    cached_latencies, _ = timed(cached, queries, args.results)
+    report("cached", cached_latencies)
+    cached.close()
+
+
+if __name__ == '__main__':
+    main()
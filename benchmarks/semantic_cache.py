@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Measure semantic cache lookup latency and how often it answers paraphrases.
+
+Fills a SemanticCache with --entries synthetic questions ("What is the
+<attribute> of <subject>?", with attributes and subjects drawn from a Zipf
+distribution so common words are in many of them), then times lookups of
+paraphrases of cached questions ("what's the ... of ...", "tell me the
+..."), of near misses (a cached question with one word of its subject
+changed, which must not be answered from the cache) and of unrelated
+questions. For each kind it reports latency percentiles and the share
+of lookups answered with their own question's answer and with another's,
+then how many paraphrases above the threshold the hashing missed, found by
+comparing them with every cached vector. It runs with NumPy (if
+installed) and with the pure Python fallback:
+
+    python -m benchmarks.semantic_cache --entries 100000
+"""
+import argparse
+import itertools
+import random
+import time
+
+from benchmarks.search_index import word
+from benchmarks.stream_latency import percentile
+from cache import ResponseCache
+from search_index import tokenize
+from semantic_cache import SemanticCache, DEFAULT_THRESHOLD, DEFAULT_TABLES, DEFAULT_BITS, DEFAULT_PROBES, _FILLER
+
+MODEL = "bench-model"
+SYSTEM_PROMPT = "You are mira, a helpful assistant."
+
+QUESTION = "What is the {attribute} of {subject}?"
+PARAPHRASES = (
+    "what's the {attribute} of {subject}",
+    "{attribute} of {subject}?",
+    "Tell me the {attribute} of {subject}.",
+    "what is {subject}'s {attribute}",
+    "WHAT IS THE {attribute} OF {subject}",
+)
+
+
+class Questions:
+    """Synthetic questions: one of a few hundred attributes, and a subject of two or three distinct words.
+
+    Generated words that are stopwords or filler ("be", "do") are left out: they are not part of
+    a prompt's embedding, so questions differing only in them are the same question to the cache.
+    """
+
+    def __init__(self, vocabulary, attributes, seed=1):
+        self.rng = random.Random(seed)
+        words = (word(rank) for rank in itertools.count())
+        words = [w for w in itertools.islice(words, 2 * (attributes + vocabulary)) if tokenize(w) and w not in _FILLER]
+        self.attributes = words[:attributes]
+        self.attribute_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(attributes)))
+        # Subject words come after the attributes in the vocabulary, so the two never mix
+        self.terms = words[attributes:attributes + vocabulary]
+        self.weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocabulary)))
+
+    def words(self, k):
+        """k distinct subject words; a repeated word ("neka sika neka") would barely change the question"""
+        words = []
+        while len(words) < k:
+            candidate = self.rng.choices(self.terms, cum_weights=self.weights)[0]
+            if candidate not in words:
+                words.append(candidate)
+        return words
+
+    def slots(self):
+        attribute = self.rng.choices(self.attributes, cum_weights=self.attribute_weights)[0]
+        return attribute, self.words(self.rng.randint(2, 3))
+
+    def near_miss(self, slots):
+        """slots with one subject word replaced"""
+        attribute, subject = slots
+        subject = list(subject)
+        position = self.rng.randrange(len(subject))
+        replacement = subject[position]
+        while replacement in subject:
+            replacement = self.words(1)[0]
+        subject[position] = replacement
+        return attribute, subject
+
+
+def text(template, slots):
+    attribute, subject = slots
+    return template.format(attribute=attribute, subject=" ".join(subject))
+
+
+def key(question):
+    return ResponseCache.make_key(MODEL, SYSTEM_PROMPT, question)
+
+
+def timed_lookups(cache, questions):
+    latencies = []
+    answers = []
+    for question in questions:
+        start = time.perf_counter()
+        answers.append(cache.get(key(question)))
+        latencies.append(time.perf_counter() - start)
+    return latencies, answers
+
+
+def report(label, latencies, answers, expected):
+    """Print latency percentiles, and the share of lookups answered with and without the expected question's answer"""
+    right = sum(answer == question for answer, question in zip(answers, expected))
+    wrong = sum(answer is not None and answer != question for answer, question in zip(answers, expected))
+    print(f"  {label:<12} p50={percentile(latencies, 50) * 1e6:6.0f}us p99={percentile(latencies, 99) * 1e6:6.0f}us "
+          f"answered {right / len(answers):6.1%}, wrongly {wrong / len(answers):6.2%}")
+
+
+def exhaustive_misses(cache, paraphrases, answers):
+    """Paraphrases not answered although a cached vector is above the threshold (NumPy caches only)"""
+    matrix = cache._matrix[:len(cache)]
+    missed = 0
+    for question, answer in zip(paraphrases, answers):
+        if answer is not None:
+            continue
+        vector, _ = cache._vector(key(question)[2])
+        if (matrix @ vector).max() >= cache.threshold:
+            missed += 1
+    return missed
+
+
+def run(label, args, use_numpy):
+    questions = Questions(args.vocabulary, args.attributes)
+    cached = [questions.slots() for _ in range(args.entries)]
+    cache = SemanticCache(max_entries=args.entries, ttl=float("inf"), threshold=args.threshold, tables=args.tables,
+                          bits=args.bits, probes=args.probes, use_numpy=use_numpy)
+    if use_numpy and cache._np is None:
+        print(f"{label}: NumPy is not installed")
+        return
+    start = time.perf_counter()
+    for slots in cached:
+        cache.put(key(text(QUESTION, slots)), text(QUESTION, slots))
+    fill_seconds = time.perf_counter() - start
+
+    rng = random.Random(2)
+    sample = rng.sample(range(args.entries), min(args.lookups, args.entries))
+    lookups = {
+        "paraphrase": [(rng.choice(PARAPHRASES), cached[i]) for i in sample],
+        "near miss": [(QUESTION, questions.near_miss(cached[i])) for i in sample],
+        "unrelated": [(QUESTION, questions.slots()) for _ in sample],
+    }
+
+    print(f"{label}: {len(cache):,} entries cached in {fill_seconds:.1f}s "
+          f"({fill_seconds / args.entries * 1e6:.0f}us per put)")
+    answers = {}
+    for kind, queries in lookups.items():
+        latencies, answers[kind] = timed_lookups(cache, [text(template, slots) for template, slots in queries])
+        # Answers are the cached question, so a lookup is answered right if it gets its own question back.
+        # A near miss or unrelated question can still be in the cache itself, as common words repeat
+        report(kind, latencies, answers[kind], [text(QUESTION, slots) for _, slots in queries])
+    if cache._np is not None:
+        paraphrases = [text(template, slots) for template, slots in lookups["paraphrase"]]
+        missed = exhaustive_misses(cache, paraphrases, answers["paraphrase"])
+        print(f"  {missed} of {len(sample)} paraphrases had a match above {args.threshold} that hashing did not find")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000, help="Questions in the cache")
+    parser.add_argument("--lookups", type=int, default=2000, help="Lookups of each kind")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="Distinct words in question subjects")
+    parser.add_argument("--attributes", type=int, default=300, help="Distinct attributes asked about")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--tables", type=int, default=DEFAULT_TABLES)
+    parser.add_argument("--bits", type=int, default=DEFAULT_BITS)
+    parser.add_argument("--probes", type=int, default=DEFAULT_PROBES)
+    parser.add_argument("--no-fallback", action="store_true", help="Skip the pure Python fallback")
+    args = parser.parse_args()
+
+    run("NumPy", args, True)
+    if not args.no_fallback:
+        run("Pure Python", args, False)
+
+
+if __name__ == '__main__':
+    main()
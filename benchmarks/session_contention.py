@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Compare session store contention: SessionStore vs the old dict plus global lock.
+
+Each worker thread replays the per-message pattern of ChatSession (append the
+user message, trim, snapshot the prompt, append the reply) on its own session,
+while another thread runs the idle-session cleanup the way closing streams do.
+The store is pre-filled with idle sessions so cleanup has realistic work:
+
+    python -m benchmarks.session_contention --threads 32 --idle-sessions 50000
+"""
+import argparse
+import statistics
+import threading
+import time
+from datetime import datetime
+
+from session_store import SessionStore
+
+SYSTEM_PROMPT = "You are mira, a helpful assistant."
+
+# Conversation messages kept by the previous design
+LEGACY_HISTORY_MESSAGES = 20
+
+
+class GlobalLockSessions:
+    """The previous design: one dict of message lists guarded by one lock"""
+
+    def __init__(self):
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+    def open(self, session_id):
+        with self.sessions_lock:
+            self.sessions[session_id] = {
+                "last_active": datetime.now().isoformat(),
+                "messages": [{"role": "system", "content": SYSTEM_PROMPT}]
+            }
+        return session_id
+
+    def run_turn(self, session_id, text):
+        with self.sessions_lock:
+            self.sessions[session_id]["last_active"] = datetime.now().isoformat()
+            messages = self.sessions[session_id]["messages"]
+            messages.append({"role": "user", "content": text})
+            if len(messages) > LEGACY_HISTORY_MESSAGES + 1:
+                self.sessions[session_id]["messages"] = [messages[0]] + messages[-(LEGACY_HISTORY_MESSAGES - 1):]
+        with self.sessions_lock:
+            prompt = self.sessions[session_id]["messages"].copy()
+        with self.sessions_lock:
+            self.sessions[session_id]["messages"].append({"role": "assistant", "content": text})
+        return prompt
+
+    def cleanup(self):
+        current_time = datetime.now()
+        with self.sessions_lock:
+            expired = [sid for sid, data in self.sessions.items()
+                       if (current_time - datetime.fromisoformat(data["last_active"])).total_seconds() > 86400]
+            for session_id in expired:
+                del self.sessions[session_id]
+
+
+class ShardedSessions:
+    """The same operations against SessionStore"""
+
+    def __init__(self):
+        self.store = SessionStore()
+
+    def open(self, session_id):
+        session, _ = self.store.get_or_create(session_id, "bench", SYSTEM_PROMPT)
+        return session
+
+    def run_turn(self, session, text):
+        session.append("user", text)
+        prompt = session.snapshot()
+        session.append("assistant", text)
+        return prompt
+
+    def cleanup(self):
+        self.store.remove_idle(86400)
+
+
+def run(store, threads, turns, idle_sessions):
+    """Return (turns per second, per-turn latencies) for one store"""
+    for i in range(idle_sessions):
+        store.open(f"idle-{i}")
+
+    start_barrier = threading.Barrier(threads + 1)
+    done = threading.Event()
+    latencies = []
+
+    def worker(index):
+        handle = store.open(f"session-{index}")
+        local = []
+        start_barrier.wait()
+        for i in range(turns):
+            began = time.perf_counter()
+            store.run_turn(handle, f"message {i}")
+            local.append(time.perf_counter() - began)
+        latencies.extend(local)
+
+    def cleaner():
+        while not done.is_set():
+            store.cleanup()
+            time.sleep(0.01)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for worker_thread in workers:
+        worker_thread.start()
+    cleaner_thread = threading.Thread(target=cleaner)
+    start_barrier.wait()
+    cleaner_thread.start()
+    start = time.perf_counter()
+    for worker_thread in workers:
+        worker_thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    cleaner_thread.join()
+    return threads * turns / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32, help="Concurrent active sessions")
+    parser.add_argument("--turns", type=int, default=500, help="Turns per active session")
+    parser.add_argument("--idle-sessions", type=int, default=50000)
+    args = parser.parse_args()
+
+    print(f"{args.threads} active sessions x {args.turns} turns, {args.idle_sessions} idle sessions, cleanup every 10ms")
+    for name, store in (("dict + global lock", GlobalLockSessions()), ("SessionStore", ShardedSessions())):
+        rate, latencies = run(store, args.threads, args.turns, args.idle_sessions)
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(f"{name:<20} {rate:10,.0f} turns/s  "
+              f"p50={statistics.median(latencies) * 1e6:8.1f}us  p99={p99 * 1e6:10.1f}us  max={latencies[-1] * 1e6:10.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Measure SQLite session persistence: write throughput and resume latency.
+
+Runs in-process against a temporary database:
+
+    python -m benchmarks.session_persistence --sessions 5000 --messages 20
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from session_backend import SQLiteSessionBackend
+from session_store import SessionStore, MAX_HISTORY_MESSAGES
+
+SYSTEM_PROMPT = "You are mira, a helpful assistant."
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=20, help="Messages written per session")
+    parser.add_argument("--resumes", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sessions.db")
+        backend = SQLiteSessionBackend(path, keep_messages=MAX_HISTORY_MESSAGES, max_idle=86400)
+        store = SessionStore(backend=backend)
+
+        # Write path: time spent on the caller's thread vs until everything is committed
+        total = args.sessions * args.messages
+        start = time.perf_counter()
+        for i in range(args.sessions):
+            session, _ = store.get_or_create(f"session-{i}", "bench", SYSTEM_PROMPT)
+            for j in range(args.messages):
+                session.append("user" if j % 2 == 0 else "assistant", f"message {j} " * 20)
+        enqueued = time.perf_counter() - start
+        backend.flush()
+        committed = time.perf_counter() - start
+        backend.close()
+
+        print(f"{total} messages across {args.sessions} sessions")
+        print(f"append (caller thread)   {total / enqueued:12,.0f} msgs/s  {enqueued / total * 1e6:8.1f}us per append")
+        print(f"append (committed)       {total / committed:12,.0f} msgs/s")
+
+        # Resume path: a fresh store, as after a restart
+        backend = SQLiteSessionBackend(path, keep_messages=MAX_HISTORY_MESSAGES, max_idle=86400)
+        store = SessionStore(backend=backend)
+        cold, warm = [], []
+        for i in range(min(args.resumes, args.sessions)):
+            session_id = f"session-{(i * 7919) % args.sessions}"
+            began = time.perf_counter()
+            store.get_or_create(session_id, "bench", SYSTEM_PROMPT)
+            cold.append(time.perf_counter() - began)
+            began = time.perf_counter()
+            store.get_or_create(session_id, "bench", SYSTEM_PROMPT)
+            warm.append(time.perf_counter() - began)
+        backend.close()
+
+        for name, values in (("resume from disk", cold), ("resume from memory", warm)):
+            values.sort()
+            print(f"{name:<24} p50={statistics.median(values) * 1e6:8.1f}us "
+                  f"p99={values[int(len(values) * 0.99) - 1] * 1e6:8.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Measure time-to-first-chunk and total latency of StreamResponse.
+
+Start a server first (python server.py), then run:
+
+    python -m benchmarks.stream_latency --requests 20 --concurrency 4
+"""
+import argparse
+import statistics
+import time
+from concurrent import futures
+
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def timed_stream(stub, message):
+    """Run one StreamResponse call, returning (ttfc, total, chunk_count)"""
+    start = time.perf_counter()
+    first_chunk = None
+    count = 0
+    for chunk in stub.StreamResponse(chatbot_pb2.ChatRequest(user_message=message)):
+        if first_chunk is None and chunk.content:
+            first_chunk = time.perf_counter() - start
+        count += 1
+    total = time.perf_counter() - start
+    return (first_chunk if first_chunk is not None else total), total, count
+
+
+def report(name, values):
+    print(f"{name:<22} mean={statistics.mean(values) * 1000:8.1f}ms "
+          f"p50={percentile(values, 50) * 1000:8.1f}ms "
+          f"p95={percentile(values, 95) * 1000:8.1f}ms "
+          f"max={max(values) * 1000:8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", default="localhost:50051")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--message", default="Explain how gRPC streaming works in a few paragraphs.")
+    parser.add_argument("--repeat", action="store_true",
+                        help="Send the identical message every time (otherwise each request is made unique to bypass the response cache)")
+    args = parser.parse_args()
+
+    def message(i):
+        return args.message if args.repeat else f"{args.message} (request {i})"
+
+    with grpc.insecure_channel(args.target) as channel:
+        stub = chatbot_pb2_grpc.ChatServiceStub(channel)
+        with futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda i: timed_stream(stub, message(i)), range(args.requests)))
+
+    print(f"StreamResponse x{args.requests} (concurrency {args.concurrency}) against {args.target}")
+    report("time to first chunk", [r[0] for r in results])
+    report("total latency", [r[1] for r in results])
+    print(f"{'chunks per response':<22} mean={statistics.mean(r[2] for r in results):.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Size-bounded LRU cache of completed AI responses with a TTL.
+
+    Keys are built with make_key() from the model, system prompt and a
+    normalized user message. All operations take a short internal lock and
+    never block on I/O, so one instance can be shared by the threaded and
+    asyncio servicers.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, system_prompt, user_message):
+        """Build a cache key, ignoring case and whitespace differences in the user message"""
+        normalized = " ".join(user_message.lower().split())
+        return (model, system_prompt, normalized)
+
+    def get(self, key):
+        """Return the cached value for key, or None if it is missing or expired"""
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used entries if full"""
+        expires_at = self._clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and the current number of entries"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
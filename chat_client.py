@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+import grpc
+import chatbot_pb2
+import chatbot_pb2_grpc
+
+from admission import RETRY_AFTER_KEY
+from grpc_config import channel_options
+from resilience import RetryPolicy
+
+DEFAULT_TARGET = "localhost:50051"
+
+# Reconnect attempts before unanswered messages fail, and their jittered backoff
+DEFAULT_RECONNECTS = 8
+DEFAULT_RECONNECT_DELAY = 0.2
+DEFAULT_MAX_RECONNECT_DELAY = 5.0
+
+# Seconds a conversation's stream stays open with no reply outstanding. Each open
+# stream holds a worker thread on the threaded server; the next send reopens it
+DEFAULT_IDLE_TIMEOUT = 5.0
+
+# Stream failures worth reconnecting for: the server restarting or shedding load
+RECONNECT_CODES = frozenset({
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.CANCELLED,
+    grpc.StatusCode.ABORTED,
+    grpc.StatusCode.INTERNAL,
+})
+
+
+def retry_after(error):
+    """Seconds the server asked the client to wait before retrying, or 0.0"""
+    for key, value in error.trailing_metadata() or ():
+        if key == RETRY_AFTER_KEY:
+            return int(value) / 1000
+    return 0.0
+
+
+class RateLimited(Exception):
+    """A message was turned away by the server's per-user rate limit every time it was sent"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Conversation:
+    """One ChatSession conversation of a ChatClient.
+
+    send() writes the message to the conversation's stream as soon as it is
+    called and resolves when the server replies to it (matched by reply_to),
+    so several messages can be in flight. The stream is opened on the first
+    send and closed again after idle_timeout seconds without outstanding
+    replies. If it fails with a code in RECONNECT_CODES, a new stream is
+    opened with the same session_id after a jittered backoff (at least the
+    server's retry-after hint) and unanswered messages are sent again, so
+    the server resumes the same history. A message whose reply was lost
+    after the server received it is sent twice and appears twice in that
+    history. A message turned away by the rate limit (a reply with
+    retry_after_ms) is sent again after that long, up to as many times as
+    the client reconnects, after which send() raises RateLimited.
+    """
+
+    def __init__(self, client, user_id="anonymous", session_id=None):
+        self.client = client
+        self.user_id = user_id
+        # Chosen up front so that every stream of this conversation resumes the same session
+        self.session_id = session_id or str(uuid.uuid4())
+        self.reconnects = 0
+        self.closed = False
+        self._call = None
+        self._reader = None
+        self._reconnecting = False
+        self._pending = OrderedDict()  # message_id -> (ChatMessage, Future)
+        self._turned_away = {}         # message_id -> times the rate limit turned it away
+        self._lock = asyncio.Lock()
+        self._idle_timer = None
+
+    async def send(self, text, timeout=None):
+        """Send a user message and return the server's reply ChatMessage"""
+        if self.closed:
+            raise RuntimeError("Conversation is closed")
+        message = chatbot_pb2.ChatMessage(
+            text=text,
+            sender="user",
+            timestamp=datetime.now().isoformat(),
+            message_id=str(uuid.uuid4()),
+            session_id=self.session_id,
+            user_id=self.user_id
+        )
+        reply = asyncio.get_running_loop().create_future()
+        self._pending[message.message_id] = (message, reply)
+        self._cancel_idle_timer()
+        try:
+            async with self._lock:
+                # While reconnecting, the new stream sends every pending message
+                if not self._reconnecting:
+                    if self._call is None:
+                        self._open(0)
+                    await self._write(self._call, message)
+            return await asyncio.wait_for(asyncio.shield(reply), timeout)
+        finally:
+            self._pending.pop(message.message_id, None)
+            self._turned_away.pop(message.message_id, None)
+            if not reply.done():
+                reply.cancel()
+
+    def _open(self, attempt):
+        self._call = self.client.stub.ChatSession()
+        self._reader = asyncio.create_task(self._read(self._call, attempt))
+
+    @staticmethod
+    async def _write(call, message):
+        try:
+            await call.write(message)
+        except (grpc.RpcError, asyncio.InvalidStateError) as e:
+            # The stream has failed; its reader reconnects and sends the message again
+            logging.debug("Chat stream write failed: %s", e)
+
+    async def _read(self, call, attempt):
+        """Deliver replies from one stream, then reconnect if it ended with replies outstanding"""
+        error = None
+        try:
+            async for message in call:
+                attempt = 0
+                if message.retry_after_ms:
+                    self._turned_away_by_rate_limit(call, message)
+                else:
+                    entry = self._pending.pop(message.reply_to, None)
+                    if entry is not None and not entry[1].done():
+                        entry[1].set_result(message)
+                if not self._pending:
+                    self._start_idle_timer(call)
+        except grpc.RpcError as e:
+            error = e
+        async with self._lock:
+            # A newer stream (after an idle close) owns the pending messages
+            if self._call is not call:
+                return
+            self._call = None
+            if self.closed or not self._pending:
+                return
+            if (error is not None and error.code() not in RECONNECT_CODES) or attempt >= self.client.reconnect.retries:
+                self._fail_pending(error or ConnectionError("Chat stream ended with replies outstanding"))
+                return
+            self._reconnecting = True
+        delay = max(self.client.reconnect.backoff(attempt), retry_after(error) if error is not None else 0.0)
+        logging.warning("Chat stream for session %s ended (%s), reconnecting in %.2fs", self.session_id,
+                        error.code() if error is not None else "OK", delay)
+        await asyncio.sleep(delay)
+        async with self._lock:
+            self._reconnecting = False
+            if self.closed:
+                return
+            self.reconnects += 1
+            self._open(attempt + 1)
+            for message, _ in list(self._pending.values()):
+                await self._write(self._call, message)
+
+    def _turned_away_by_rate_limit(self, call, notice):
+        """Schedule a message the rate limit turned away to be sent again, or fail it after too many tries"""
+        entry = self._pending.get(notice.reply_to)
+        if entry is None:
+            return
+        message, reply = entry
+        times = self._turned_away.get(message.message_id, 0)
+        retry_after = notice.retry_after_ms / 1000
+        if times >= self.client.reconnect.retries:
+            del self._pending[message.message_id]
+            if not reply.done():
+                reply.set_exception(RateLimited(notice.text, retry_after))
+            return
+        self._turned_away[message.message_id] = times + 1
+        self.client.spawn(self._send_again(call, message, max(retry_after, self.client.reconnect.backoff(times))))
+
+    async def _send_again(self, call, message, delay):
+        await asyncio.sleep(delay)
+        async with self._lock:
+            # A reconnect since then has already sent every pending message again
+            if self._call is not call or message.message_id not in self._pending:
+                return
+            await self._write(call, message)
+
+    def _fail_pending(self, error):
+        for _, reply in self._pending.values():
+            if not reply.done():
+                reply.set_exception(error)
+
+    def _start_idle_timer(self, call):
+        self._cancel_idle_timer()
+        if self.client.idle_timeout is not None:
+            self._idle_timer = asyncio.get_running_loop().call_later(
+                self.client.idle_timeout, lambda: self.client.spawn(self._close_idle(call)))
+
+    def _cancel_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    async def _close_idle(self, call):
+        async with self._lock:
+            if self._call is not call or self._pending:
+                return
+            self._call = None
+        await self._finish(call)
+
+    @staticmethod
+    async def _finish(call):
+        """Half-close a stream so the server ends it normally"""
+        try:
+            await call.done_writing()
+        except (grpc.RpcError, asyncio.InvalidStateError):
+            call.cancel()
+
+    async def close(self):
+        """End the conversation; replies still outstanding are cancelled"""
+        self.closed = True
+        self._cancel_idle_timer()
+        async with self._lock:
+            call, reader, self._call = self._call, self._reader, None
+        for _, reply in self._pending.values():
+            reply.cancel()
+        if call is not None:
+            await self._finish(call)
+        elif reader is not None:
+            # Waiting to reconnect, or already finished
+            reader.cancel()
+        if reader is not None:
+            await asyncio.gather(reader, return_exceptions=True)
+        self.client.conversations.discard(self)
+
+
+class ChatClient:
+    """asyncio client library for ChatSession conversations.
+
+    Every conversation is a stream on one shared channel, so a single
+    connection and event loop can carry thousands of them: there is no
+    thread or polling loop per conversation. Create it inside a running
+    event loop, e.g.
+
+        async with ChatClient("localhost:50051") as client:
+            conversation = client.conversation(user_id="bot")
+            reply = await conversation.send("Hello")
+            print(reply.text)
+    """
+
+    def __init__(self, target=DEFAULT_TARGET, options=None, reconnect=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.channel = grpc.aio.insecure_channel(target, options=options if options is not None else channel_options())
+        self.stub = chatbot_pb2_grpc.ChatServiceStub(self.channel)
+        self.reconnect = reconnect or RetryPolicy(retries=DEFAULT_RECONNECTS, base_delay=DEFAULT_RECONNECT_DELAY,
+                                                  max_delay=DEFAULT_MAX_RECONNECT_DELAY)
+        self.idle_timeout = idle_timeout
+        self.conversations = set()
+        # Strong references to fire-and-forget tasks so they are not garbage collected
+        self.background_tasks = set()
+
+    def conversation(self, user_id="anonymous", session_id=None):
+        """A conversation that resumes session_id, or starts a new session without one"""
+        conversation = Conversation(self, user_id, session_id)
+        self.conversations.add(conversation)
+        return conversation
+
+    def spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def close(self):
+        await asyncio.gather(*(conversation.close() for conversation in list(self.conversations)))
+        await self.channel.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
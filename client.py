@@ -1,61 +1,69 @@
 #!/usr/bin/env python3
+import asyncio
 import grpc
 import chatbot_pb2
 import chatbot_pb2_grpc
 import logging
-import uuid
 import datetime
 import threading
-import queue
 import sys
-import time
 import os
 import json
 
+from chat_client import ChatClient, RateLimited, DEFAULT_TARGET
+from grpc_config import ChannelPool, response_compression
+
 # Configure logging - Change from INFO to ERROR level to suppress info messages
 logging.basicConfig(level=logging.INFO)
 
+# Channel shared by every menu choice, with keepalive
+CHANNELS = ChannelPool(DEFAULT_TARGET)
+
+# Summaries compress well, so bulk results are requested gzip-compressed
+BULK_COMPRESSION = "gzip"
+
 def get_timestamp():
     """Helper function to get current timestamp in ISO format"""
     return datetime.datetime.now().isoformat()
 
 def run():
-    # Create a gRPC channel
-    with grpc.insecure_channel('localhost:50051') as channel:
-        # Create a stub (client)
-        stub = chatbot_pb2_grpc.ChatServiceStub(channel)
-        
-        print("\nMira AI Assistant - gRPC Demo")
-        print("==============================")
-        print("Choose a communication type:")
-        print("1. Unary RPC - Single question and answer")
-        print("2. Server Streaming - Get response in chunks")
-        print("3. Client Streaming - Submit URLs for bulk summarization")
-        print("4. Bidirectional Streaming - Interactive chat session with history")
-        print("5. Exit")
-        
-        choice = input("\nEnter your choice (1-5): ")
-        
-        if choice == "1":
-            unary_communication(stub)
-        elif choice == "2":
-            server_streaming(stub)
-        elif choice == "3":
-            client_streaming(stub)
-        elif choice == "4":
-            bidirectional_streaming(stub)
-        elif choice == "5":
-            print("\nGoodbye!")
-            return
-        else:
-            print("\nInvalid choice. Please try again.")
-            run()
+    # Reuse the same channel (and connection) every time the menu is shown
+    stub = chatbot_pb2_grpc.ChatServiceStub(CHANNELS.get())
+    
+    print("\nMira AI Assistant - gRPC Demo")
+    print("==============================")
+    print("Choose a communication type:")
+    print("1. Unary RPC - Single question and answer")
+    print("2. Server Streaming - Get response in chunks")
+    print("3. Client Streaming - Submit URLs for bulk summarization")
+    print("4. Bidirectional Streaming - Interactive chat session with history")
+    print("5. Exit")
+    
+    choice = input("\nEnter your choice (1-5): ")
+    
+    if choice == "1":
+        unary_communication(stub)
+    elif choice == "2":
+        server_streaming(stub)
+    elif choice == "3":
+        client_streaming(stub)
+    elif choice == "4":
+        bidirectional_streaming()
+    elif choice == "5":
+        print("\nGoodbye!")
+        return
+    else:
+        print("\nInvalid choice. Please try again.")
+        run()
 
 def unary_communication(stub):
     """Unary RPC - Summarize 1 URL or respond to 1 question"""
     print("\nUnary RPC Demo - Ask a question or request a URL summary")
     print("(type 'quit' to return to menu)")
     
+    # Answers draw on the server's search index when web access is enabled
+    web_access = input("Enable web search? (y/N): ").strip().lower() == 'y'
+    
     while True:
         user_input = input("\nYou: ")
         
@@ -70,7 +78,7 @@ def unary_communication(stub):
         
         try:
             # Create a request
-            request = chatbot_pb2.ChatRequest(user_message=user_input)
+            request = chatbot_pb2.ChatRequest(user_message=user_input, enable_web_access=web_access)
             
             # Make the gRPC call
             response = stub.GetReply(request)
@@ -78,13 +86,19 @@ def unary_communication(stub):
             # Print the response
             print(f"\nAI: {response.ai_response}")
             
+            # Print the search results the answer was based on
+            if response.web_results:
+                print("\nSources:")
+                for number, result in enumerate(response.web_results, 1):
+                    print(f"[{number}] {result.title} - {result.url}")
+            
         except grpc.RpcError as e:
             status_code = e.code()
             details = e.details()
-            logging.error(f"RPC error: {status_code}, {details}")
+            logging.error("RPC error: %s, %s", status_code, details)
             print(f"\nError communicating with server: {status_code}, {details}")
         except Exception as e:
-            logging.error(f"Error: {str(e)}")
+            logging.exception("Error")
             print(f"\nAn error occurred: {str(e)}")
 
 def server_streaming(stub):
@@ -116,7 +130,7 @@ def server_streaming(stub):
             
             # Process each chunk as it arrives
             for response in responses:
-                print(response.content, end=" ")
+                print(response.content, end="")
                 sys.stdout.flush()  # Ensure chunk is displayed immediately
                 
                 # If this is the final chunk, add a newline
@@ -126,10 +140,10 @@ def server_streaming(stub):
         except grpc.RpcError as e:
             status_code = e.code()
             details = e.details()
-            logging.error(f"RPC error: {status_code}, {details}")
+            logging.error("RPC error: %s, %s", status_code, details)
             print(f"\nError communicating with server: {status_code}, {details}")
         except Exception as e:
-            logging.error(f"Error: {str(e)}")
+            logging.exception("Error")
             print(f"\nAn error occurred: {str(e)}")
 
 def client_streaming(stub):
@@ -173,20 +187,28 @@ def client_streaming(stub):
             for url, max_length in urls:
                 yield chatbot_pb2.UrlRequest(url=url, max_length=max_length)
         
-        # Make the client streaming gRPC call
-        print("\nSubmitting URLs for summarization...")
-        response = stub.BulkSummarize(request_generator())
-        
-        # Process the response
-        print(f"\nProcessed {response.total_processed} URLs:")
+        # Ask whether to wait for the whole batch or see each summary as it completes
+        stream_results = input("Show each summary as soon as it is ready? (y/N): ").strip().lower() == 'y'
         
-        for i, summary in enumerate(response.summaries, 1):
-            print(f"\n--- Summary {i} ---")
-            print(f"URL: {summary.url}")
-            if summary.success:
-                print(f"Summary: {summary.summary}")
-            else:
-                print(f"Error: {summary.error_message}")
+        print("\nSubmitting URLs for summarization...")
+        if stream_results:
+            # Bidirectional streaming call - summaries arrive in completion order
+            processed = 0
+            for summary in stub.BulkSummarizeStream(request_generator(),
+                                                      metadata=response_compression(BULK_COMPRESSION)):
+                processed += 1
+                print_url_summary(summary.index + 1, summary)
+            print(f"\nProcessed {processed} URLs")
+        else:
+            # Make the client streaming gRPC call
+            response = stub.BulkSummarize(request_generator(),
+                                          metadata=response_compression(BULK_COMPRESSION))
+            
+            # Process the response
+            print(f"\nProcessed {response.total_processed} URLs:")
+            
+            for i, summary in enumerate(response.summaries, 1):
+                print_url_summary(i, summary)
         
         input("\nPress Enter to return to the menu...")
         run()
@@ -194,27 +216,30 @@ def client_streaming(stub):
     except grpc.RpcError as e:
         status_code = e.code()
         details = e.details()
-        logging.error(f"RPC error: {status_code}, {details}")
+        logging.error("RPC error: %s, %s", status_code, details)
         print(f"\nError communicating with server: {status_code}, {details}")
         input("\nPress Enter to return to the menu...")
         run()
     except Exception as e:
-        logging.error(f"Error: {str(e)}")
+        logging.exception("Error")
         print(f"\nAn error occurred: {str(e)}")
         input("\nPress Enter to return to the menu...")
         run()
 
-def bidirectional_streaming(stub):
+def print_url_summary(number, summary):
+    """Print one UrlSummary from a bulk summarization call"""
+    print(f"\n--- Summary {number} ---")
+    print(f"URL: {summary.url}")
+    if summary.success:
+        print(f"Summary: {summary.summary}")
+    else:
+        print(f"Error: {summary.error_message}")
+
+def bidirectional_streaming():
     """Bidirectional Streaming RPC - Real-time chat with history and session management"""
     print("\nBidirectional Streaming Demo - Interactive chat session with history")
     print("(type 'quit' to return to menu)")
     
-    # Set up a queue for outgoing messages
-    outgoing_queue = queue.Queue()
-    
-    # Set up a flag to signal the sending thread to stop
-    stop_event = threading.Event()
-    
     # Load or create user and session information
     user_id, session_id = load_user_session()
     print(f"User ID: {user_id}")
@@ -229,70 +254,62 @@ def bidirectional_streaming(stub):
     # Create a lock for console output to prevent overlapping prints
     console_lock = threading.Lock()
     
-    # Thread function for sending messages
-    def send_messages():
-        try:
-            # Create a generator that yields messages from the queue
-            def message_generator():
-                while not stop_event.is_set():
-                    try:
-                        message = outgoing_queue.get(block=True, timeout=0.1)
-                        yield message
-                        outgoing_queue.task_done()
-                    except queue.Empty:
-                        continue
-            
-            # Start the bidirectional streaming RPC
-            responses = stub.ChatSession(message_generator())
-            
-            # Process incoming messages
-            for response in responses:
-                if stop_event.is_set():
-                    break
-                
-                # Update session_id if this is the first response
-                nonlocal session_id
-                if not session_id and response.session_id:
-                    with console_lock:
-                        session_id = response.session_id
-                        save_user_session(user_id, session_id)
-                        print(f"\nNew session created: {session_id}")
-                
+    # The chat client runs on an event loop in a background thread; replies are
+    # printed as they arrive while this thread waits for input
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    
+    def on_loop(coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+    
+    async def open_client():
+        return ChatClient(DEFAULT_TARGET)
+    
+    client = on_loop(open_client()).result()
+    conversation = None
+    
+    async def open_conversation():
+        return client.conversation(user_id, session_id)
+    
+    def start_conversation():
+        """Open the conversation for the current user and session, remembering a new session's id"""
+        nonlocal conversation, session_id
+        # Conversations belong to the client's loop, so they are created on its thread
+        conversation = on_loop(open_conversation()).result()
+        if not session_id:
+            session_id = conversation.session_id
+            save_user_session(user_id, session_id)
+            print(f"\nNew session created: {session_id}")
+    
+    def show_reply(future):
+        """Print a reply, or the error that prevented it"""
+        with console_lock:
+            if future.cancelled():
+                return
+            try:
+                response = future.result()
+            except grpc.RpcError as e:
+                status_code = e.code()
+                details = e.details()
+                logging.error("RPC error: %s, %s", status_code, details)
+                print(f"\nError communicating with server: {status_code}, {details}")
+            except RateLimited as e:
+                print(f"\nYou are sending messages too fast, wait {e.retry_after:.1f}s and send that one again")
+            except Exception as e:
+                logging.exception("Error")
+                print(f"\nAn error occurred: {str(e)}")
+            else:
                 # Save message to history
                 message_history.append({
                     "sender": response.sender,
                     "text": response.text,
                     "timestamp": response.timestamp
                 })
-                
-                # Display the response with proper formatting
-                with console_lock:
-                    print(f"\nAI: {response.text}")
-                    # Re-display the input prompt
-                    sys.stdout.write("\nYou: ")
-                    sys.stdout.flush()
-                
-        except grpc.RpcError as e:
-            if not stop_event.is_set():  # Only log if not intentionally stopping
-                status_code = e.code()
-                details = e.details()
-                logging.error(f"RPC error: {status_code}, {details}")
-                with console_lock:
-                    print(f"\nError communicating with server: {status_code}, {details}")
-                    sys.stdout.write("\nYou: ")
-                    sys.stdout.flush()
-        except Exception as e:
-            if not stop_event.is_set():  # Only log if not intentionally stopping
-                logging.error(f"Error: {str(e)}")
-                with console_lock:
-                    print(f"\nAn error occurred: {str(e)}")
-                    sys.stdout.write("\nYou: ")
-                    sys.stdout.flush()
-    
-    # Start the sending thread
-    send_thread = threading.Thread(target=send_messages)
-    send_thread.daemon = True
-    send_thread.start()
+                print(f"\nAI: {response.text}")
+            # Re-display the input prompt
+            sys.stdout.write("\nYou: ")
+            sys.stdout.flush()
     
     try:
         # Get username if not already set
@@ -302,6 +319,8 @@ def bidirectional_streaming(stub):
                 user_id = username
                 save_user_session(user_id, session_id)
         
+        start_conversation()
+        
         # Print chat commands help
         print("\nChat Commands:")
         print("  /help     - Show these commands")
@@ -316,9 +335,6 @@ def bidirectional_streaming(stub):
             
             # Process special commands
             if user_input.lower() in ['/quit', 'quit', 'exit', 'back']:
-                stop_event.set()  # Signal the thread to stop
-                time.sleep(1)  # Give it time to clean up
-                run()
                 break
             
             elif user_input.lower() == '/help':
@@ -331,11 +347,12 @@ def bidirectional_streaming(stub):
                 continue
                 
             elif user_input.lower() == '/clear':
+                on_loop(conversation.close()).result()
                 with console_lock:
                     session_id = None
                     message_history.clear()
-                    save_user_session(user_id, session_id)
                     print("\nStarting a new chat session")
+                    start_conversation()
                 continue
                 
             elif user_input.lower() == '/history':
@@ -354,17 +371,6 @@ def bidirectional_streaming(stub):
             if not user_input.strip():
                 continue
             
-            # Create a chat message
-            message = chatbot_pb2.ChatMessage(
-                text=user_input,
-                sender="user",
-                timestamp=get_timestamp(),
-                message_id=str(uuid.uuid4()),
-                reply_to="",  # No specific message to reply to
-                session_id=session_id,
-                user_id=user_id
-            )
-            
             # Save message to history
             message_history.append({
                 "sender": "user",
@@ -372,18 +378,19 @@ def bidirectional_streaming(stub):
                 "timestamp": get_timestamp()
             })
             
-            # Add the message to the outgoing queue
-            outgoing_queue.put(message)
+            # Send right away; the reply is printed when it arrives
+            on_loop(conversation.send(user_input)).add_done_callback(show_reply)
             
     except KeyboardInterrupt:
         print("\nInterrupted by user")
     finally:
-        # Make sure we signal the thread to stop
-        stop_event.set()
         # Save the session information before exiting
         save_user_session(user_id, session_id)
-        send_thread.join(timeout=2)
-        run()
+        on_loop(client.close()).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join(timeout=2)
+        loop.close()
+    run()
 
 def load_user_session():
     """Load user and session information from a file"""
@@ -394,8 +401,8 @@ def load_user_session():
             with open(session_file, 'r') as f:
                 data = json.load(f)
                 return data.get("user_id", "anonymous"), data.get("session_id", None)
-    except Exception as e:
-        logging.error(f"Error loading session data: {str(e)}")
+    except Exception:
+        logging.exception("Error loading session data")
     
     return "anonymous", None
 
@@ -410,8 +417,8 @@ def save_user_session(user_id, session_id):
                 "session_id": session_id,
                 "last_updated": get_timestamp()
             }, f)
-    except Exception as e:
-        logging.error(f"Error saving session data: {str(e)}")
+    except Exception:
+        logging.exception("Error saving session data")
 
 if __name__ == '__main__':
     try:
@@ -419,5 +426,7 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         print("\nProgram terminated by user")
     except Exception as e:
-        logging.error(f"Unexpected error: {str(e)}")
-        print(f"\nAn unexpected error occurred: {str(e)}")
\ No newline at end of file
+        logging.exception("Unexpected error")
+        print(f"\nAn unexpected error occurred: {str(e)}")
+    finally:
+        CHANNELS.close()
\ No newline at end of file
@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+import codecs
+import hashlib
+import http.client
+import ipaddress
+import re
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent import futures
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+# Concurrent requests per host, and keep-alive connections kept open per host
+DEFAULT_PER_HOST = 4
+DEFAULT_MAX_IDLE_PER_HOST = 4
+
+# Fetch threads shared by all BulkSummarize calls
+DEFAULT_FETCH_CONCURRENCY = 16
+
+# Body bytes read per page; the rest of a larger page is never downloaded
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024
+
+# Seconds to connect or to wait for more of the response
+DEFAULT_FETCH_TIMEOUT = 10.0
+
+# Fetch cache defaults (URLs, seconds a page is used without revalidating it)
+DEFAULT_FETCH_CACHE_SIZE = 1024
+DEFAULT_FETCH_CACHE_TTL = 300.0
+
+# Source text sent to the model per word of requested summary, within these bounds (estimated tokens)
+CONTENT_TOKENS_PER_SUMMARY_WORD = 20
+MIN_CONTENT_TOKENS = 500
+MAX_CONTENT_TOKENS = 6000
+
+MAX_REDIRECTS = 5
+READ_CHUNK_BYTES = 64 * 1024
+# Bodies of redirects and errors up to this size are read so the connection can be reused
+MAX_DRAIN_BYTES = 64 * 1024
+USER_AGENT = "mira-summarizer/1.0"
+
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAX_AGE = re.compile(r"max-age\s*=\s*(\d+)")
+
+# Elements whose content is never text a reader sees
+_SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg", "iframe", "object", "canvas"}
+# Elements that start a new line of text
+_BLOCK_TAGS = {"p", "div", "br", "li", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "table",
+               "section", "article", "header", "footer", "nav", "main", "aside", "blockquote", "pre",
+               "dd", "dt", "dl", "hr", "figure", "figcaption", "form"}
+
+
+class FetchError(Exception):
+    """Raised when a page cannot be fetched or has no text to summarize"""
+
+
+def is_public_address(address):
+    """True for an IP address on the public internet: not loopback, private (RFC 1918), link-local
+    (which includes cloud metadata endpoints such as 169.254.169.254), multicast or otherwise reserved"""
+    ip = ipaddress.ip_address(address)
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def connect_public(host, port, timeout=None, source_address=None):
+    """Open a TCP connection to host, refusing hosts that resolve to a non-public address.
+
+    The connection goes to the address that was checked, so the host cannot
+    resolve to another address (DNS rebinding) between the check and the connect.
+    """
+    addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for *_, address in addresses:
+        if not is_public_address(address[0]):
+            raise FetchError(f"Refusing to fetch from {host}: {address[0]} is not a public address")
+    error = None
+    for family, kind, proto, _, address in addresses:
+        sock = socket.socket(family, kind, proto)
+        try:
+            if timeout is not None:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error or OSError(f"No address for {host}")
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection that only connects to public addresses"""
+
+    def connect(self):
+        self.sock = connect_public(self.host, self.port, self.timeout, self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection, _PublicHTTPConnection):
+    """HTTPSConnection that only connects to public addresses (the TLS handshake runs on top of
+    _PublicHTTPConnection.connect)"""
+
+
+def content_token_budget(max_length):
+    """Estimated tokens of page text worth sending for a summary of about max_length words"""
+    return max(MIN_CONTENT_TOKENS, min(MAX_CONTENT_TOKENS, max_length * CONTENT_TOKENS_PER_SUMMARY_WORD))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to about max_tokens (at 4 characters per token, as session_store.estimate_tokens),
+    at a word boundary"""
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", max_chars // 2, max_chars)
+    return text[:cut if cut > 0 else max_chars].rstrip() + " [...]"
+
+
+class TextExtractor(HTMLParser):
+    """Incremental HTML to text: feed() markup as it arrives, then read title and text()"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self._parts = []
+        self._skip_depth = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self._in_title = True
+        elif tag in _SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+        elif tag in _SKIPPED_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip_depth:
+            self._parts.append(data)
+
+    def text(self):
+        """Extracted text, one line per block with whitespace collapsed"""
+        lines = (" ".join(line.split()) for line in "".join(self._parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+
+class Page:
+    """Text extracted from a fetched URL; digest (sha256 of the text) identifies the content"""
+
+    __slots__ = ("url", "title", "text", "digest", "truncated")
+
+    def __init__(self, url, title, text, digest=None, truncated=False):
+        self.url = url
+        self.title = title
+        self.text = text
+        self.digest = digest or hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.truncated = truncated
+
+
+class _CachedUrl:
+    __slots__ = ("digest", "title", "truncated", "etag", "last_modified", "fresh_until")
+
+    def __init__(self, digest, title, truncated, etag, last_modified, fresh_until):
+        self.digest = digest
+        self.title = title
+        self.truncated = truncated
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh_until = fresh_until
+
+
+class FetchCache:
+    """Fetched pages by URL, with the validators needed to revalidate them.
+
+    Text is stored once per content digest, so URLs serving the same
+    content (mirrors, tracking parameters, redirects to one page) share it.
+    A page is used without a request while fresh: for its Cache-Control
+    max-age, at most ttl seconds. After that it is revalidated with
+    If-None-Match / If-Modified-Since, and a 304 keeps the stored text.
+    Responses marked no-store are not cached. At most max_entries URLs are
+    kept, dropping the least recently used.
+    """
+
+    def __init__(self, max_entries=DEFAULT_FETCH_CACHE_SIZE, ttl=DEFAULT_FETCH_CACHE_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._urls = OrderedDict()  # url -> _CachedUrl, least recently used first
+        self._texts = {}            # digest -> [text, number of URLs referencing it]
+        self._lock = threading.Lock()
+
+    def lookup(self, url):
+        """Return (Page, fresh, etag, last_modified) for a cached url, or None"""
+        with self._lock:
+            entry = self._urls.get(url)
+            if entry is None:
+                return None
+            self._urls.move_to_end(url)
+            page = Page(url, entry.title, self._texts[entry.digest][0], entry.digest, entry.truncated)
+            return page, self._clock() < entry.fresh_until, entry.etag, entry.last_modified
+
+    def store(self, page, cache_control="", etag=None, last_modified=None):
+        """Cache a page fetched from page.url, unless its Cache-Control forbids it"""
+        fresh_for = self._fresh_for(cache_control)
+        if fresh_for is None:
+            return
+        with self._lock:
+            self._remove(page.url)
+            texts = self._texts.setdefault(page.digest, [page.text, 0])
+            texts[1] += 1
+            self._urls[page.url] = _CachedUrl(page.digest, page.title, page.truncated, etag, last_modified,
+                                              self._clock() + fresh_for)
+            while len(self._urls) > self.max_entries:
+                self._remove(next(iter(self._urls)))
+
+    def revalidated(self, url, cache_control=""):
+        """Mark a cached url fresh again after a 304 Not Modified"""
+        fresh_for = self._fresh_for(cache_control)
+        with self._lock:
+            entry = self._urls.get(url)
+            if entry is not None:
+                entry.fresh_until = self._clock() + (fresh_for or 0.0)
+
+    def _fresh_for(self, cache_control):
+        """Seconds a response may be used without revalidation, or None if it must not be stored"""
+        directives = cache_control.lower()
+        if "no-store" in directives:
+            return None
+        if "no-cache" in directives:
+            return 0.0
+        match = _MAX_AGE.search(directives)
+        return min(self.ttl, float(match.group(1))) if match else self.ttl
+
+    def _remove(self, url):
+        entry = self._urls.pop(url, None)
+        if entry is not None:
+            texts = self._texts[entry.digest]
+            texts[1] -= 1
+            if not texts[1]:
+                del self._texts[entry.digest]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._urls)
+
+    def stats(self):
+        with self._lock:
+            return {"urls": len(self._urls), "contents": len(self._texts)}
+
+
+class _Host:
+    __slots__ = ("slots", "idle", "active")
+
+    def __init__(self, per_host):
+        self.slots = threading.BoundedSemaphore(per_host)
+        self.idle = []
+        self.active = 0
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections per host, with at most per_host requests to a host at a time.
+
+    A request waits for a slot of its host, then reuses an idle connection
+    or opens a new one. Connections whose response was read to the end go
+    back to the pool (up to max_idle_per_host); others are closed. Hosts
+    with nothing in flight and no idle connection are forgotten. Unless
+    allow_private is set, every new connection checks the addresses its
+    host resolves to and fails with FetchError for loopback, private,
+    link-local and reserved ones, so clients cannot make the server fetch
+    from its own network. Redirects are covered too, since each hop opens
+    or reuses a connection of the pool.
+    """
+
+    def __init__(self, per_host=DEFAULT_PER_HOST, max_idle_per_host=DEFAULT_MAX_IDLE_PER_HOST,
+                 timeout=DEFAULT_FETCH_TIMEOUT, allow_private=False):
+        self.per_host = per_host
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self.allow_private = allow_private
+        self._hosts = {}  # (scheme, host, port) -> _Host
+        self._lock = threading.Lock()
+        self.opened = 0   # connections opened, to compare with requests made
+
+    def acquire(self, key, wait=None):
+        """Wait up to wait seconds for a slot of host key; return (connection, reused)"""
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is None:
+                host = self._hosts[key] = _Host(self.per_host)
+            host.active += 1
+        if not host.slots.acquire(timeout=wait):
+            self._forget_if_unused(key, host)
+            raise FetchError(f"Timed out waiting for a connection to {key[1]}")
+        with self._lock:
+            if host.idle:
+                return host.idle.pop(), True
+            self.opened += 1
+        scheme, hostname, port = key
+        if self.allow_private:
+            connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        else:
+            connection_class = _PublicHTTPSConnection if scheme == "https" else _PublicHTTPConnection
+        return connection_class(hostname, port, timeout=self.timeout), False
+
+    def release(self, key, connection, reusable):
+        with self._lock:
+            host = self._hosts[key]
+            if reusable and len(host.idle) < self.max_idle_per_host:
+                host.idle.append(connection)
+                connection = None
+        if connection is not None:
+            connection.close()
+        host.slots.release()
+        self._forget_if_unused(key, host)
+
+    def _forget_if_unused(self, key, host):
+        with self._lock:
+            host.active -= 1
+            if not host.active and not host.idle and self._hosts.get(key) is host:
+                del self._hosts[key]
+
+    def close(self):
+        with self._lock:
+            hosts = list(self._hosts.values())
+        for host in hosts:
+            while host.idle:
+                host.idle.pop().close()
+
+
+class Fetcher:
+    """Fetches web pages for summarization and extracts their text.
+
+    Responses are read in chunks and parsed as they arrive, stopping after
+    max_bytes of body. HTML is reduced to its visible text; plain text is
+    used as is; other content types are refused. Pages go through an
+    optional FetchCache. fetch() blocks; the servicer runs it on executor
+    so fetching overlaps with summarization.
+    """
+
+    def __init__(self, pool=None, cache=None, max_bytes=DEFAULT_MAX_BYTES, concurrency=DEFAULT_FETCH_CONCURRENCY,
+                 metrics=None):
+        self.pool = pool or ConnectionPool()
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.executor = futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fetch")
+        self.results = self.latency = self.body_bytes = None
+        if metrics is not None:
+            self.results = metrics.counter(
+                "url_fetch_total", "Page fetches, by result (fresh cache hit, revalidated, fetched, error)",
+                ("result",))
+            self.latency = metrics.histogram("url_fetch_seconds", "Duration of page fetches that made a request")
+            self.body_bytes = metrics.counter("url_fetch_body_bytes_total", "Response body bytes read")
+            metrics.watch_executor("fetch", self.executor)
+            if cache is not None:
+                metrics.callback_gauge("fetch_cache_urls", "URLs in the fetch cache", lambda: len(cache))
+
+    def _count(self, result):
+        if self.results is not None:
+            self.results.inc(result)
+
+    def fetch(self, url, timeout=None):
+        """Return the Page at url, raising FetchError; timeout bounds the whole fetch in seconds"""
+        cached = self.cache.lookup(url) if self.cache is not None else None
+        if cached is not None and cached[1]:
+            self._count("fresh")
+            return cached[0]
+        headers = {}
+        if cached is not None:
+            _, _, etag, last_modified = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        expires = None if timeout is None else time.monotonic() + timeout
+        start = time.perf_counter()
+        try:
+            result = self._get(url, headers, expires)
+        except FetchError:
+            self._count("error")
+            raise
+        except (OSError, http.client.HTTPException, LookupError) as e:
+            self._count("error")
+            raise FetchError(f"Error fetching {url}: {e}") from e
+        finally:
+            if self.latency is not None:
+                self.latency.observe(time.perf_counter() - start)
+        fetched, response = result
+        if fetched is None:
+            self._count("revalidated")
+            self.cache.revalidated(url, response.getheader("Cache-Control", ""))
+            return cached[0]
+        self._count("fetched")
+        if self.cache is not None:
+            self.cache.store(fetched, response.getheader("Cache-Control", ""), response.getheader("ETag"),
+                             response.getheader("Last-Modified"))
+        return fetched
+
+    def _get(self, url, headers, expires):
+        """GET url following redirects; return (Page, response), or (None, response) for 304 Not Modified"""
+        target = url
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(target)
+            if parts.scheme not in ("http", "https") or not parts.hostname:
+                raise FetchError(f"Unsupported URL: {target}")
+            key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+            path = parts.path or "/"
+            if parts.query:
+                path = f"{path}?{parts.query}"
+            status, response, page = self._request(key, path, headers, expires, url)
+            if status in _REDIRECT_STATUSES and response.getheader("Location"):
+                target = urljoin(target, response.getheader("Location"))
+                # Validators belong to the original URL's cached copy
+                headers = {}
+                continue
+            if status == 304 and headers:
+                return None, response
+            if page is None:
+                raise FetchError(f"HTTP {status} fetching {target}")
+            return page, response
+        raise FetchError(f"Too many redirects fetching {url}")
+
+    def _request(self, key, path, headers, expires, url):
+        """One request on a pooled connection; return (status, response, Page or None)"""
+        connection, reused = self.pool.acquire(key, self._remaining(expires))
+        reusable = False
+        try:
+            try:
+                response = self._send(connection, key, path, headers, expires)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # The server closed the idle connection; retry once on a fresh one
+                connection.close()
+                response = self._send(connection, key, path, headers, expires)
+            if 200 <= response.status < 300:
+                page, complete = self._read_page(response, url, expires)
+            else:
+                page = None
+                complete = self._drain(response)
+            reusable = complete and not response.will_close
+            return response.status, response, page
+        finally:
+            self.pool.release(key, connection, reusable)
+
+    def _send(self, connection, key, path, headers, expires):
+        timeout = self._socket_timeout(expires)
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        connection.request("GET", path, headers={
+            "User-Agent": USER_AGENT, "Accept": "text/html, text/plain;q=0.9", "Accept-Encoding": "gzip", **headers})
+        return connection.getresponse()
+
+    def _remaining(self, expires):
+        if expires is None:
+            return None
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise FetchError("Deadline exceeded while fetching")
+        return remaining
+
+    def _socket_timeout(self, expires):
+        remaining = self._remaining(expires)
+        return self.pool.timeout if remaining is None else min(self.pool.timeout, remaining)
+
+    def _drain(self, response):
+        """Read a small unwanted body so the connection can be reused; return whether it was read to the end"""
+        body = response.read(MAX_DRAIN_BYTES + 1)
+        return len(body) <= MAX_DRAIN_BYTES and response.isclosed()
+
+    def _read_page(self, response, url, expires):
+        """Stream the body through the text extractor, up to max_bytes; return (Page, read to the end)"""
+        content_type = response.getheader("Content-Type", "text/html")
+        media_type, _, params = content_type.partition(";")
+        media_type = media_type.strip().lower()
+        if media_type not in ("text/html", "application/xhtml+xml", "text/plain"):
+            raise FetchError(f"Unsupported content type {media_type} at {url}")
+        charset = "utf-8"
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "charset" and value.strip():
+                charset = value.strip().strip('"')
+        decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+        gzipped = response.getheader("Content-Encoding", "").lower() == "gzip"
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        extractor = TextExtractor() if media_type != "text/plain" else None
+        parts = []
+
+        size = 0
+        complete = False
+        while size < self.max_bytes:
+            self._remaining(expires)
+            chunk = response.read(min(READ_CHUNK_BYTES, self.max_bytes - size))
+            if not chunk:
+                complete = True
+                break
+            if self.body_bytes is not None:
+                self.body_bytes.inc(amount=len(chunk))
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk, self.max_bytes - size)
+            size += len(chunk)
+            text = decoder.decode(chunk)
+            if extractor is not None:
+                extractor.feed(text)
+            else:
+                parts.append(text)
+        if not complete and response.isclosed():
+            complete = True
+        # The whole compressed body may have arrived with decompressed text left over
+        truncated = not complete or (decompressor is not None and bool(decompressor.unconsumed_tail))
+        tail = decoder.decode(b"", final=True)
+        if extractor is not None:
+            extractor.feed(tail)
+            extractor.close()
+            title, text = " ".join(extractor.title.split()), extractor.text()
+        else:
+            parts.append(tail)
+            title, text = "", "".join(parts).strip()
+        if not text:
+            raise FetchError(f"No text found at {url}")
+        return Page(url, title, text, truncated=truncated), complete
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.pool.close()
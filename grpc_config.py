@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import itertools
+import threading
+
+import grpc
+
+# Server keepalive: ping a connection after this many idle seconds, and close it if
+# the ping is not answered within the timeout, so dead clients free their streams
+DEFAULT_SERVER_KEEPALIVE_TIME = 60.0
+DEFAULT_KEEPALIVE_TIMEOUT = 20.0
+
+# Client keepalive, so connections through NATs and load balancers stay open and a
+# silently dead server is noticed. Kept above MIN_CLIENT_PING_INTERVAL, or the
+# server answers the pings with GOAWAY (too_many_pings)
+DEFAULT_CLIENT_KEEPALIVE_TIME = 30.0
+DEFAULT_CLIENT_KEEPALIVE_TIMEOUT = 10.0
+MIN_CLIENT_PING_INTERVAL = 10.0
+
+# Largest message accepted, as in grpc's default
+DEFAULT_MAX_MESSAGE_BYTES = 4 * 1024 * 1024
+
+# Request metadata with which a client picks the compression of one call's responses
+RESPONSE_COMPRESSION_KEY = "mira-response-compression"
+
+COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
+
+def ms(seconds):
+    return int(seconds * 1000)
+
+
+def server_options(keepalive_time=DEFAULT_SERVER_KEEPALIVE_TIME, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                   max_concurrent_streams=0, max_message_bytes=DEFAULT_MAX_MESSAGE_BYTES, reuse_port=False):
+    """grpc server options; 0 leaves keepalive or the stream limit at grpc's default"""
+    options = [
+        ("grpc.max_receive_message_length", max_message_bytes),
+        ("grpc.max_send_message_length", max_message_bytes),
+        # Accept client keepalive pings on idle connections down to this interval
+        ("grpc.http2.min_ping_interval_without_data_ms", ms(MIN_CLIENT_PING_INTERVAL)),
+        ("grpc.keepalive_permit_without_calls", 1),
+    ]
+    if keepalive_time:
+        options.append(("grpc.keepalive_time_ms", ms(keepalive_time)))
+        options.append(("grpc.keepalive_timeout_ms", ms(keepalive_timeout)))
+        options.append(("grpc.http2.ping_timeout_ms", ms(keepalive_timeout)))
+    if max_concurrent_streams:
+        options.append(("grpc.max_concurrent_streams", max_concurrent_streams))
+    if reuse_port:
+        # Workers of a multi-process server listen on the same port
+        options.append(("grpc.so_reuseport", 1))
+    return options
+
+
+def channel_options(keepalive_time=DEFAULT_CLIENT_KEEPALIVE_TIME, keepalive_timeout=DEFAULT_CLIENT_KEEPALIVE_TIMEOUT,
+                    max_message_bytes=DEFAULT_MAX_MESSAGE_BYTES, round_robin=True, own_connection=False):
+    """grpc channel options for clients; keepalive_time 0 turns keepalive off.
+
+    With round_robin, a target that resolves to several addresses (a DNS
+    name, or ipv4:host1:port,host2:port) gets a connection to each, and
+    calls take turns across them. own_connection keeps the channel from
+    sharing its connection with other channels to the same target.
+    """
+    options = [
+        ("grpc.max_receive_message_length", max_message_bytes),
+        ("grpc.max_send_message_length", max_message_bytes),
+    ]
+    if keepalive_time:
+        options += [
+            ("grpc.keepalive_time_ms", ms(keepalive_time)),
+            ("grpc.keepalive_timeout_ms", ms(keepalive_timeout)),
+            # Newer grpc cores wait this long for the ping's answer, whatever keepalive_timeout_ms says
+            ("grpc.http2.ping_timeout_ms", ms(keepalive_timeout)),
+            ("grpc.keepalive_permit_without_calls", 1),
+            # Keep pinging an idle connection instead of stopping after two pings without data
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+    if round_robin:
+        options.append(("grpc.lb_policy_name", "round_robin"))
+    if own_connection:
+        options.append(("grpc.use_local_subchannel_pool", 1))
+    return options
+
+
+class ChannelPool:
+    """Reusable client channels to one target, created once and handed out in turn.
+
+    A channel multiplexes all its calls over one HTTP/2 connection (per
+    server address), so one is enough for most clients; get() returns the
+    same channel instead of paying for a new connection and handshake per
+    use. With size > 1 each channel has a connection of its own, which
+    spreads load over the workers of a multi-process server, since
+    SO_REUSEPORT balances connections rather than calls. With aio, the
+    channels are grpc.aio channels and must be used from one event loop.
+    """
+
+    def __init__(self, target, size=1, options=None, aio=False):
+        self.target = target
+        self.size = size
+        self.options = list(options if options is not None else channel_options())
+        if size > 1:
+            self.options.append(("grpc.use_local_subchannel_pool", 1))
+        self.aio = aio
+        self._channels = []
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if not self._channels:
+                connect = grpc.aio.insecure_channel if self.aio else grpc.insecure_channel
+                self._channels = [connect(self.target, options=self.options) for _ in range(self.size)]
+            return self._channels[next(self._next) % self.size]
+
+    def close(self):
+        """Close the channels (a coroutine for aio pools); the next get() opens new ones"""
+        with self._lock:
+            channels, self._channels = self._channels, []
+        if self.aio:
+            return _close_all(channels)
+        for channel in channels:
+            channel.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+async def _close_all(channels):
+    for channel in channels:
+        await channel.close()
+
+
+def response_compression(name):
+    """Call metadata asking the server to compress this call's responses with name.
+
+    "none" sends no request and leaves the server's default compression:
+    grpc does not let a single call turn off compression set for the server.
+    """
+    if name not in COMPRESSION:
+        raise ValueError(f"Unknown compression {name!r}, expected one of {', '.join(COMPRESSION)}")
+    return () if name == "none" else ((RESPONSE_COMPRESSION_KEY, name),)
+
+
+def requested_compression(context):
+    """The compression a call's client asked for with response_compression(), or None"""
+    for key, value in context.invocation_metadata() or ():
+        if key == RESPONSE_COMPRESSION_KEY and value in COMPRESSION and value != "none":
+            return COMPRESSION[value]
+    return None
+
+
+def apply_response_compression(context):
+    """Compress a call's responses as its client asked, if it did"""
+    compression = requested_compression(context)
+    if compression is not None:
+        context.set_compression(compression)
+
+
+async def aapply_response_compression(context):
+    """apply_response_compression for grpc.aio handlers"""
+    compression = requested_compression(context)
+    if compression is not None:
+        context.set_compression(compression)
+        # The asyncio server only applies it with initial metadata sent explicitly
+        await context.send_initial_metadata(())
@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import grpc
+
+from backends import LLMBackend
+from session_store import estimate_tokens
+
+# Interface the metrics endpoint listens on: loopback only, since metrics reveal traffic and user activity
+DEFAULT_METRICS_HOST = "127.0.0.1"
+
+# Histogram bucket upper bounds in seconds, from cache hits to slow completions
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base for metrics with an optional fixed set of label names.
+
+    Values are kept per tuple of label values, in the order the names were
+    declared. Each metric has its own lock, held only for a dict update.
+    """
+
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class CallbackGauge(_Metric):
+    """Gauge (or counter) read from a function when the metrics are rendered.
+
+    The function returns a number, or a dict mapping tuples of label values
+    to numbers. Used for state that other objects already track (cache
+    size, session count, queue depth), so the hot path pays nothing.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn, labels=(), kind=None):
+        super().__init__(name, help_text, labels)
+        self.fn = fn
+        if kind is not None:
+            self.kind = kind
+
+    def render(self):
+        lines = self._header()
+        try:
+            values = self.fn()
+        except Exception:
+            logging.exception("Error reading metric %s", self.name)
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, Prometheus style"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per-bucket (non-cumulative) counts plus one overflow bucket, then count and sum
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def value(self, *labels):
+        """Return (count, sum) of the observations for labels"""
+        with self._lock:
+            state = self._values.get(labels)
+            return (state[1], state[2]) if state else (0, 0.0)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            items = sorted((labels, (list(state[0]), state[1], state[2])) for labels, state in self._values.items())
+        for labels, (counts, count, total) in items:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = (("le", _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Named collection of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._register(Gauge(name, help_text, labels))
+
+    def callback_gauge(self, name, help_text, fn, labels=()):
+        return self._register(CallbackGauge(name, help_text, fn, labels))
+
+    def callback_counter(self, name, help_text, fn, labels=()):
+        return self._register(CallbackGauge(name, help_text, fn, labels, kind="counter"))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def get(self, name):
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics(MetricsRegistry):
+    """Metrics recorded by the chat servers.
+
+    RPC metrics come from MetricsInterceptor / AsyncMetricsInterceptor and
+    upstream LLM metrics from InstrumentedBackend. State the servicer
+    already keeps (cache, single-flight, sessions, executor queues) is read
+    through callback gauges registered by watch_servicer() and
+    watch_executor() only when the metrics are scraped.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.rpc_handled = self.counter(
+            "grpc_server_handled_total", "RPCs completed, by method and status code", ("method", "code"))
+        self.rpc_latency = self.histogram(
+            "grpc_server_handling_seconds", "Time from RPC start until the handler finished", ("method",))
+        self.rpc_in_flight = self.gauge(
+            "grpc_server_in_flight", "RPCs currently being handled, including open streams", ("method",))
+        self.llm_latency = self.histogram(
+            "llm_request_seconds", "Duration of upstream LLM calls", ("operation",))
+        self.llm_first_token = self.histogram(
+            "llm_time_to_first_token_seconds", "Time until a streamed LLM call produced its first token")
+        self.llm_errors = self.counter(
+            "llm_errors_total", "Upstream LLM calls that raised", ("operation",))
+        self.llm_prompt_tokens = self.counter(
+            "llm_prompt_tokens_total", "Estimated prompt tokens sent upstream")
+        self.llm_completion_tokens = self.counter(
+            "llm_completion_tokens_total", "Estimated completion tokens received from upstream")
+        self.bulk_dropped = self.counter(
+            "bulk_urls_dropped_total", "URLs of cancelled or expired bulk calls dropped before being summarized",
+            ("method",))
+        self._executors = {}
+        self.callback_gauge("executor_queue_depth", "Tasks waiting for a worker thread, by pool",
+                            self._executor_queue_depths, ("pool",))
+
+    def watch_executor(self, name, executor):
+        """Report the backlog of a ThreadPoolExecutor as executor_queue_depth{pool=name}"""
+        self._executors[name] = executor
+
+    def _executor_queue_depths(self):
+        # _work_queue is the executor's internal queue of submitted, not yet started tasks
+        return {(name,): executor._work_queue.qsize() for name, executor in self._executors.items()}
+
+    def watch_servicer(self, servicer):
+        """Register callback gauges for the cache, single-flight and session store of a servicer"""
+        if servicer.cache is not None:
+            cache = servicer.cache
+            self.callback_counter("response_cache_hits_total", "Response cache hits",
+                                  lambda: cache.stats()["hits"])
+            self.callback_counter("response_cache_misses_total", "Response cache misses",
+                                  lambda: cache.stats()["misses"])
+            self.callback_gauge("response_cache_entries", "Answers currently cached", lambda: len(cache))
+        # Read through the servicer: the asyncio servicer swaps in its own single-flight
+        self.callback_counter("single_flight_calls_total", "Upstream calls made through single-flight",
+                              lambda: servicer.single_flight.stats()["calls"])
+        self.callback_counter("single_flight_coalesced_total", "Callers that shared an in-flight call",
+                              lambda: servicer.single_flight.stats()["coalesced"])
+        self.callback_gauge("single_flight_in_flight", "Distinct calls currently in flight",
+                            lambda: servicer.single_flight.stats()["in_flight"])
+        self.callback_gauge("chat_sessions", "Chat sessions held in memory", lambda: len(servicer.sessions))
+
+
+def _status_name(context, default="OK"):
+    code = context.code()
+    return code.name if code is not None else default
+
+
+def _returned_status_name(context):
+    """Status of a threaded RPC whose handler returned: a handler that stopped early for a client that
+    cancelled or ran out of time leaves the code unset"""
+    code = context.code()
+    if code is not None:
+        return code.name
+    return "OK" if context.is_active() else "CANCELLED"
+
+
+class _RpcRecorder:
+    """Shared bookkeeping of the sync and asyncio metrics interceptors"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def _instrument(self, handler, handler_call_details):
+        if handler is None:
+            return None
+        method = handler_call_details.method.rsplit("/", 1)[-1]
+        if handler.response_streaming:
+            behavior = self._wrap_stream(method, handler.unary_stream or handler.stream_stream)
+        else:
+            behavior = self._wrap_unary(method, handler.unary_unary or handler.stream_unary)
+        return replace_behavior(handler, behavior)
+
+    def _start(self, method):
+        self.metrics.rpc_in_flight.inc(method)
+        return time.perf_counter()
+
+    def _finish(self, method, start, code):
+        self.metrics.rpc_in_flight.dec(method)
+        self.metrics.rpc_latency.observe(time.perf_counter() - start, method)
+        self.metrics.rpc_handled.inc(method, code)
+
+
+class MetricsInterceptor(_RpcRecorder, grpc.ServerInterceptor):
+    """Records latency, status codes and in-flight counts for every RPC of a grpc.server.
+
+    Streaming responses are timed until the stream is exhausted or closed,
+    so long-lived ChatSession streams count as in flight while open.
+    """
+
+    def intercept_service(self, continuation, handler_call_details):
+        return self._instrument(continuation(handler_call_details), handler_call_details)
+
+    def _wrap_unary(self, method, behavior):
+        def handle(request, context):
+            start = self._start(method)
+            code = None
+            try:
+                return behavior(request, context)
+            except Exception:
+                code = _status_name(context, "UNKNOWN")
+                raise
+            finally:
+                self._finish(method, start, code or _returned_status_name(context))
+        return handle
+
+    def _wrap_stream(self, method, behavior):
+        def handle(request, context):
+            start = self._start(method)
+            code = None
+            try:
+                yield from behavior(request, context)
+            except GeneratorExit:
+                code = "CANCELLED"
+                raise
+            except Exception:
+                code = _status_name(context, "UNKNOWN")
+                raise
+            finally:
+                self._finish(method, start, code or _returned_status_name(context))
+        return handle
+
+
+class AsyncMetricsInterceptor(_RpcRecorder, grpc.aio.ServerInterceptor):
+    """MetricsInterceptor for a grpc.aio server, whose handlers are coroutines and async generators"""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        return self._instrument(await continuation(handler_call_details), handler_call_details)
+
+    def _wrap_unary(self, method, behavior):
+        async def handle(request, context):
+            start = self._start(method)
+            code = None
+            try:
+                return await behavior(request, context)
+            except asyncio.CancelledError:
+                code = "CANCELLED"
+                raise
+            except Exception:
+                code = _status_name(context, "UNKNOWN")
+                raise
+            finally:
+                self._finish(method, start, code or _status_name(context))
+        return handle
+
+    def _wrap_stream(self, method, behavior):
+        async def handle(request, context):
+            start = self._start(method)
+            code = None
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            except (GeneratorExit, asyncio.CancelledError):
+                code = "CANCELLED"
+                raise
+            except Exception:
+                code = _status_name(context, "UNKNOWN")
+                raise
+            finally:
+                self._finish(method, start, code or _status_name(context))
+        return handle
+
+
+def replace_behavior(handler, behavior):
+    """Return a copy of an RPC method handler with its behavior swapped"""
+    options = {"request_deserializer": handler.request_deserializer,
+               "response_serializer": handler.response_serializer}
+    if handler.request_streaming and handler.response_streaming:
+        return grpc.stream_stream_rpc_method_handler(behavior, **options)
+    if handler.request_streaming:
+        return grpc.stream_unary_rpc_method_handler(behavior, **options)
+    if handler.response_streaming:
+        return grpc.unary_stream_rpc_method_handler(behavior, **options)
+    return grpc.unary_unary_rpc_method_handler(behavior, **options)
+
+
+def _prompt_tokens(messages):
+    return sum(estimate_tokens(message["content"]) for message in messages)
+
+
+class InstrumentedBackend(LLMBackend):
+    """Wraps an LLMBackend to record call durations, errors and estimated token counts"""
+
+    def __init__(self, backend, metrics):
+        self.backend = backend
+        self.metrics = metrics
+
+    def _record(self, operation, start, prompts, responses):
+        metrics = self.metrics
+        metrics.llm_latency.observe(time.perf_counter() - start, operation)
+        metrics.llm_prompt_tokens.inc(amount=sum(_prompt_tokens(messages) for messages in prompts))
+        metrics.llm_completion_tokens.inc(amount=sum(estimate_tokens(text) for text in responses))
+
+    def complete(self, model, messages, timeout=None):
+        start = time.perf_counter()
+        try:
+            response = self.backend.complete(model, messages, timeout)
+        except Exception:
+            self.metrics.llm_errors.inc("complete")
+            raise
+        self._record("complete", start, [messages], [response])
+        return response
+
+    def stream(self, model, messages, timeout=None):
+        start = time.perf_counter()
+        pieces = []
+        try:
+            for piece in self.backend.stream(model, messages, timeout):
+                if not pieces:
+                    self.metrics.llm_first_token.observe(time.perf_counter() - start)
+                pieces.append(piece)
+                yield piece
+        except Exception:
+            self.metrics.llm_errors.inc("stream")
+            raise
+        self._record("stream", start, [messages], ["".join(pieces)])
+
+    def batch(self, model, message_lists, timeout=None):
+        start = time.perf_counter()
+        try:
+            responses = self.backend.batch(model, message_lists, timeout)
+        except Exception:
+            self.metrics.llm_errors.inc("batch")
+            raise
+        self._record("batch", start, message_lists, responses)
+        return responses
+
+    async def acomplete(self, model, messages, timeout=None):
+        start = time.perf_counter()
+        try:
+            response = await self.backend.acomplete(model, messages, timeout)
+        except Exception:
+            self.metrics.llm_errors.inc("complete")
+            raise
+        self._record("complete", start, [messages], [response])
+        return response
+
+    async def astream(self, model, messages, timeout=None):
+        start = time.perf_counter()
+        pieces = []
+        try:
+            async for piece in self.backend.astream(model, messages, timeout):
+                if not pieces:
+                    self.metrics.llm_first_token.observe(time.perf_counter() - start)
+                pieces.append(piece)
+                yield piece
+        except Exception:
+            self.metrics.llm_errors.inc("stream")
+            raise
+        self._record("stream", start, [messages], ["".join(pieces)])
+
+    async def abatch(self, model, message_lists, timeout=None):
+        start = time.perf_counter()
+        try:
+            responses = await self.backend.abatch(model, message_lists, timeout)
+        except Exception:
+            self.metrics.llm_errors.inc("batch")
+            raise
+        self._record("batch", start, message_lists, responses)
+        return responses
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; keep them out of the server log
+        pass
+
+
+def start_http_server(registry, port, host=DEFAULT_METRICS_HOST, reuse_port=False):
+    """Serve registry.render() at http://host:port/metrics from a daemon thread.
+
+    With reuse_port, a replacement process can bind the port while the one it replaces is still stopping.
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server_class = type("MetricsHTTPServer", (ThreadingHTTPServer,), {"allow_reuse_port": reuse_port})
+    http_server = server_class((host, port), handler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info("Metrics available at http://%s:%d/metrics", host or "0.0.0.0", http_server.server_port)
+    return http_server
@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+from backends import BackendError
+
+# Defaults for RetryPolicy
+DEFAULT_RETRIES = 2
+DEFAULT_BASE_DELAY = 0.1
+DEFAULT_MAX_DELAY = 2.0
+
+# Hedged attempts start after the p95 latency of recent calls, but never sooner than this
+DEFAULT_HEDGE_MIN_DELAY = 0.05
+
+# Latency samples kept per method to estimate the hedging delay
+LATENCY_WINDOW = 200
+
+# Defaults for CircuitBreaker
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_RESET = 30.0
+
+# context.time_remaining() beyond this means the client set no deadline (the
+# threaded server then reports about 2**63 seconds, the asyncio one None)
+NO_DEADLINE = 10 ** 9
+
+
+class CircuitOpenError(BackendError):
+    """Raised without calling upstream while the circuit breaker is open"""
+
+
+class CallCancelled(BackendError):
+    """Raised instead of calling upstream once the client has cancelled the RPC"""
+
+
+class DeadlineExceeded(BackendError):
+    """Raised instead of calling upstream once the RPC's deadline has passed"""
+
+
+class RetryBudgetExhausted(BackendError):
+    """Raised instead of retrying when the backoff before the next attempt would outlast the RPC's deadline.
+
+    Unlike DeadlineExceeded, the deadline has not passed yet: the call failed and has no time left to retry.
+    """
+
+
+def is_retryable(error):
+    return (isinstance(error, BackendError) and error.retryable
+            and not isinstance(error, (CircuitOpenError, CallCancelled, DeadlineExceeded, RetryBudgetExhausted)))
+
+
+class Deadline:
+    """Time left and cancellation state of one RPC, handed down to its upstream calls.
+
+    Resilience passes remaining() to the backend as the call timeout and
+    stops retrying once done(). The threaded servicer registers cancel()
+    with context.add_callback(), which gRPC runs when the RPC terminates for
+    any reason; callbacks added with on_cancel() then run too. On the
+    asyncio server cancellation arrives as CancelledError instead.
+    """
+
+    __slots__ = ("expires_at", "cancelled", "_callbacks", "_lock", "_clock")
+
+    def __init__(self, timeout=None, clock=time.monotonic):
+        self._clock = clock
+        self.expires_at = None if timeout is None or timeout >= NO_DEADLINE else clock() + timeout
+        self.cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_context(cls, context):
+        return cls(context.time_remaining())
+
+    def remaining(self):
+        """Seconds left, or None without a deadline"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - self._clock())
+
+    def expired(self):
+        return self.expires_at is not None and self._clock() >= self.expires_at
+
+    def done(self):
+        """True once the RPC was cancelled or its deadline passed, i.e. nobody waits for the result"""
+        return self.cancelled or self.expired()
+
+    def error(self):
+        """The exception to raise instead of calling upstream, or None while the RPC is live"""
+        if self.cancelled:
+            return CallCancelled("Call cancelled by the client")
+        if self.expired():
+            return DeadlineExceeded("Deadline exceeded")
+        return None
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.exception("Error in cancellation callback")
+
+    def on_cancel(self, callback):
+        """Run callback() on cancel(), or now if already cancelled"""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+class RetryPolicy:
+    """How one RPC method calls upstream: retry count, backoff and hedging.
+
+    Retries use exponential backoff with full jitter (a random delay between
+    zero and base_delay * 2**attempt, capped at max_delay) and only happen
+    for retryable BackendErrors. With hedge, a unary completion that has not
+    answered after the p95 latency of recent calls gets a second, parallel
+    attempt; whichever finishes first wins.
+    """
+
+    def __init__(self, retries=DEFAULT_RETRIES, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 hedge=False, hedge_min_delay=DEFAULT_HEDGE_MIN_DELAY):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class LatencyTracker:
+    """Sliding window of recent successful call latencies with a cached p95"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._p95 = None
+        self._stale = 0
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._stale += 1
+
+    def p95(self):
+        """p95 of the window, recomputed after every 10% of the window has been replaced"""
+        with self._lock:
+            if self._p95 is None or self._stale >= max(1, self._samples.maxlen // 10):
+                if not self._samples:
+                    return None
+                ordered = sorted(self._samples)
+                self._p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+                self._stale = 0
+            return self._p95
+
+
+class CircuitBreaker:
+    """Fails fast while upstream is unhealthy.
+
+    Closed: calls go through; failure_threshold consecutive failures open
+    the circuit. Open: calls raise CircuitOpenError for reset_timeout
+    seconds. Half-open: one trial call goes through; success closes the
+    circuit, failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=DEFAULT_BREAKER_FAILURES, reset_timeout=DEFAULT_BREAKER_RESET,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go upstream now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and self._clock() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            retry_in = max(0.0, self.reset_timeout - (self._clock() - self.opened_at))
+        raise CircuitOpenError(f"Upstream circuit open, retry in {retry_in:.1f}s")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info("Upstream circuit closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                if self.state == self.CLOSED:
+                    logging.warning("Upstream circuit opened after %d consecutive failures", self.failures)
+                self.state = self.OPEN
+                self.opened_at = self._clock()
+                self._trial_running = False
+
+    def record_cancelled(self):
+        """A half-open trial that was abandoned (e.g. a losing hedge) frees the trial slot"""
+        with self._lock:
+            self._trial_running = False
+
+
+class Resilience:
+    """Retries, hedging and a shared circuit breaker around upstream LLM calls.
+
+    The servicer passes the RPC method name with every call, which selects
+    the RetryPolicy (policies[method], else default_policy). The circuit
+    breaker is shared by all methods since it tracks the health of the one
+    upstream. breaker=None disables it.
+
+    With a Deadline, every attempt gets the RPC's remaining time as its
+    timeout, and no attempt or retry starts once the RPC is done. Attempts
+    that finish or are abandoned after their RPC is gone count as wasted
+    upstream work.
+    """
+
+    def __init__(self, policies=None, default_policy=None, breaker=None, metrics=None, hedge_workers=16):
+        self.policies = dict(policies or {})
+        self.default_policy = default_policy or RetryPolicy()
+        self.breaker = breaker
+        self._latency = {}
+        self._latency_lock = threading.Lock()
+        self._hedge_executor = None
+        self._hedge_workers = hedge_workers
+        # Idle hedge workers; attempts only go to the executor when one is free, so they never queue there
+        self._hedge_slots = threading.BoundedSemaphore(hedge_workers)
+        self.retries = self.hedges = self.hedge_wins = None
+        self.wasted = self.wasted_seconds = self.skipped = None
+        if metrics is not None:
+            self.retries = metrics.counter("upstream_retries_total", "Upstream call retries, by method", ("method",))
+            self.hedges = metrics.counter("upstream_hedges_total", "Hedged upstream attempts started, by method",
+                                          ("method",))
+            self.hedge_wins = metrics.counter("upstream_hedge_wins_total",
+                                              "Hedged attempts that answered first, by method", ("method",))
+            self.wasted = metrics.counter(
+                "upstream_wasted_total",
+                "Upstream attempts that finished or were abandoned after their RPC was gone, by method",
+                ("method",))
+            self.wasted_seconds = metrics.counter(
+                "upstream_wasted_seconds_total", "Upstream time spent on those attempts, by method", ("method",))
+            self.skipped = metrics.counter(
+                "upstream_skipped_total",
+                "Upstream attempts and retries not started because the RPC was cancelled or out of time, by method",
+                ("method",))
+            if breaker is not None:
+                metrics.callback_gauge("upstream_circuit_open", "1 while the upstream circuit breaker is open",
+                                       lambda: int(breaker.state != CircuitBreaker.CLOSED))
+
+    def policy(self, method):
+        return self.policies.get(method, self.default_policy)
+
+    def _tracker(self, method):
+        tracker = self._latency.get(method)
+        if tracker is None:
+            with self._latency_lock:
+                tracker = self._latency.setdefault(method, LatencyTracker())
+        return tracker
+
+    def _hedge_delay(self, method, policy):
+        p95 = self._tracker(method).p95()
+        return None if p95 is None else max(policy.hedge_min_delay, p95)
+
+    def _count(self, counter, method):
+        if counter is not None:
+            counter.inc(method)
+
+    def _record_wasted(self, method, start):
+        if self.wasted is not None:
+            self.wasted.inc(method)
+            self.wasted_seconds.inc(method, amount=time.perf_counter() - start)
+
+    def _check(self, method, deadline):
+        """Raise instead of starting an upstream attempt for an RPC that is already gone"""
+        error = deadline.error() if deadline is not None else None
+        if error is not None:
+            self._count(self.skipped, method)
+            raise error
+
+    def _retry_delay(self, method, policy, attempt, deadline):
+        """Backoff before the next retry, raising RetryBudgetExhausted if the deadline would pass first"""
+        delay = policy.backoff(attempt)
+        remaining = deadline.remaining() if deadline is not None else None
+        if remaining is not None and delay >= remaining:
+            self._count(self.skipped, method)
+            raise RetryBudgetExhausted("Not enough time left before the deadline for another upstream retry")
+        self._count(self.retries, method)
+        return delay
+
+    @staticmethod
+    def _timeout(deadline):
+        return {} if deadline is None else {"timeout": deadline.remaining()}
+
+    # One attempt, guarded by the breaker
+
+    def _attempt(self, method, fn, args, deadline=None):
+        self._check(method, deadline)
+        if self.breaker is not None:
+            self.breaker.before_call()
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **self._timeout(deadline))
+        except BaseException as e:
+            self._record_failure(method, start, e, deadline)
+            raise
+        self._record_success(method, start)
+        if deadline is not None and deadline.done():
+            # The thread could not be interrupted; the caller has gone (or another attempt won)
+            self._record_wasted(method, start)
+        return result
+
+    def _record_success(self, method, start):
+        self._tracker(method).record(time.perf_counter() - start)
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+    def _record_stream_success(self):
+        # Streams only count as a success for the circuit once they end cleanly,
+        # so one that breaks after its first piece still counts as a failure
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+    def _record_failure(self, method, start, error, deadline=None):
+        if isinstance(error, CircuitOpenError):
+            return
+        if not isinstance(error, Exception) or (deadline is not None and deadline.done()):
+            # Abandoned, or cut short by the RPC's own deadline: says nothing about upstream health
+            self._record_wasted(method, start)
+            if self.breaker is not None:
+                self.breaker.record_cancelled()
+        elif self.breaker is None:
+            return
+        elif isinstance(error, BackendError) and not error.retryable:
+            # The request itself was bad; upstream answered, so it is healthy
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    @staticmethod
+    def _give_up(error, deadline):
+        """Raise the RPC's own cancellation or deadline error if it caused error"""
+        own_error = deadline.error() if deadline is not None else None
+        if own_error is not None and not isinstance(error, (CallCancelled, DeadlineExceeded)):
+            raise own_error from error
+
+    # Threaded calls
+
+    def call(self, method, fn, *args, deadline=None):
+        """Run fn(*args) (a unary upstream call) under the method's policy.
+
+        With a deadline, fn is also passed timeout=<seconds remaining>.
+        """
+        policy = self.policy(method)
+        attempt = 0
+        while True:
+            try:
+                if policy.hedge:
+                    return self._hedged(method, policy, fn, args, deadline)
+                return self._attempt(method, fn, args, deadline)
+            except Exception as e:
+                self._give_up(e, deadline)
+                if attempt >= policy.retries or not is_retryable(e):
+                    raise
+                time.sleep(self._retry_delay(method, policy, attempt, deadline))
+                attempt += 1
+
+    def _submit_attempt(self, method, fn, args, deadline):
+        """Start an attempt on an idle hedge worker and return its Future, or None if every worker is busy"""
+        if not self._hedge_slots.acquire(blocking=False):
+            return None
+        if self._hedge_executor is None:
+            with self._latency_lock:
+                if self._hedge_executor is None:
+                    self._hedge_executor = futures.ThreadPoolExecutor(
+                        max_workers=self._hedge_workers, thread_name_prefix="hedge")
+        future = self._hedge_executor.submit(self._attempt, method, fn, args, deadline)
+        future.add_done_callback(lambda _: self._hedge_slots.release())
+        return future
+
+    def _hedged(self, method, policy, fn, args, deadline):
+        """One attempt, plus a second one if the first has not answered after the hedging delay.
+
+        The calling thread cannot give up on an attempt it runs itself, so both run on hedge workers,
+        but only on idle ones. When every worker is busy the attempt runs on the calling thread without
+        a hedge, and a hedge is only sent if a worker is free for it: under load, hedging backs off
+        instead of queueing attempts and doubling upstream traffic.
+        """
+        delay = self._hedge_delay(method, policy)
+        if delay is None:
+            # No latency history yet to pick a delay from
+            return self._attempt(method, fn, args, deadline)
+        primary = self._submit_attempt(method, fn, args, deadline)
+        if primary is None:
+            return self._attempt(method, fn, args, deadline)
+        done, _ = futures.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        hedge = self._submit_attempt(method, fn, args, deadline)
+        if hedge is None:
+            return primary.result()
+        self._count(self.hedges, method)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count(self.hedge_wins, method)
+                    # The losing attempt cannot be interrupted; its result is dropped
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def stream(self, method, fn, *args, deadline=None):
+        """Iterate fn(*args) (a streaming upstream call), retrying only until the first piece arrives.
+
+        Closing this generator closes the upstream stream too.
+        """
+        policy = self.policy(method)
+        attempt = 0
+        while True:
+            self._check(method, deadline)
+            if self.breaker is not None:
+                self.breaker.before_call()
+            start = time.perf_counter()
+            started = False
+            pieces = fn(*args, **self._timeout(deadline))
+            try:
+                for piece in pieces:
+                    if not started:
+                        started = True
+                        self._tracker(method).record(time.perf_counter() - start)
+                    yield piece
+                if not started:
+                    self._tracker(method).record(time.perf_counter() - start)
+                self._record_stream_success()
+                return
+            except Exception as e:
+                self._record_failure(method, start, e, deadline)
+                self._give_up(e, deadline)
+                if started or attempt >= policy.retries or not is_retryable(e):
+                    raise
+            except BaseException as e:
+                # Closed by the caller, whose RPC was cancelled or ended early
+                self._record_failure(method, start, e, deadline)
+                raise
+            finally:
+                pieces.close()
+            time.sleep(self._retry_delay(method, policy, attempt, deadline))
+            attempt += 1
+
+    # asyncio calls
+
+    async def _aattempt(self, method, fn, args, deadline=None):
+        self._check(method, deadline)
+        if self.breaker is not None:
+            self.breaker.before_call()
+        start = time.perf_counter()
+        try:
+            result = await fn(*args, **self._timeout(deadline))
+        except BaseException as e:
+            # Includes CancelledError: the client went away, or this attempt lost a hedge
+            self._record_failure(method, start, e, deadline)
+            raise
+        self._record_success(method, start)
+        return result
+
+    async def acall(self, method, fn, *args, deadline=None):
+        """asyncio version of call(); fn(*args) returns an awaitable"""
+        policy = self.policy(method)
+        attempt = 0
+        while True:
+            try:
+                if policy.hedge:
+                    return await self._ahedged(method, policy, fn, args, deadline)
+                return await self._aattempt(method, fn, args, deadline)
+            except Exception as e:
+                self._give_up(e, deadline)
+                if attempt >= policy.retries or not is_retryable(e):
+                    raise
+                await asyncio.sleep(self._retry_delay(method, policy, attempt, deadline))
+                attempt += 1
+
+    async def _ahedged(self, method, policy, fn, args, deadline):
+        delay = self._hedge_delay(method, policy)
+        if delay is None:
+            return await self._aattempt(method, fn, args, deadline)
+        primary = asyncio.ensure_future(self._aattempt(method, fn, args, deadline))
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            return primary.result()
+        self._count(self.hedges, method)
+        hedge = asyncio.ensure_future(self._aattempt(method, fn, args, deadline))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._count(self.hedge_wins, method)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Unlike threads, the losing attempt (or both, if the caller is cancelled) can be cancelled
+            for task in pending:
+                task.cancel()
+
+    async def astream(self, method, fn, *args, deadline=None):
+        """asyncio version of stream(); fn(*args) returns an async generator"""
+        policy = self.policy(method)
+        attempt = 0
+        while True:
+            self._check(method, deadline)
+            if self.breaker is not None:
+                self.breaker.before_call()
+            start = time.perf_counter()
+            started = False
+            pieces = fn(*args, **self._timeout(deadline))
+            try:
+                async for piece in pieces:
+                    if not started:
+                        started = True
+                        self._tracker(method).record(time.perf_counter() - start)
+                    yield piece
+                if not started:
+                    self._tracker(method).record(time.perf_counter() - start)
+                self._record_stream_success()
+                return
+            except Exception as e:
+                self._record_failure(method, start, e, deadline)
+                self._give_up(e, deadline)
+                if started or attempt >= policy.retries or not is_retryable(e):
+                    raise
+            except BaseException as e:
+                # Closed or cancelled by the caller, whose RPC was cancelled or ended early
+                self._record_failure(method, start, e, deadline)
+                raise
+            finally:
+                await pieces.aclose()
+            await asyncio.sleep(self._retry_delay(method, policy, attempt, deadline))
+            attempt += 1
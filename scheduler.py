@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+from resilience import CallCancelled, DeadlineExceeded
+
+# Priority classes of upstream calls, most urgent first
+INTERACTIVE = "interactive"
+UNARY = "unary"
+BULK = "bulk"
+PRIORITY_CLASSES = (INTERACTIVE, UNARY, BULK)
+
+# Class of each RPC method's upstream calls; methods not listed are unary
+METHOD_CLASSES = {
+    "ChatSession": INTERACTIVE,
+    "StreamResponse": INTERACTIVE,
+    "GetReply": UNARY,
+    "BulkSummarize": BULK,
+    "BulkSummarizeStream": BULK,
+}
+
+# Share of the upstream slots bulk work may hold when no cap is configured, so
+# interactive turns arriving during a bulk job find a free slot
+DEFAULT_BULK_SHARE = 0.75
+
+# Seconds between cancellation checks of a thread waiting for a slot
+SCHEDULER_POLL = 0.5
+
+# Request metadata naming the user an RPC is queued as (ChatSession uses the messages' user_id)
+USER_ID_KEY = "mira-user-id"
+
+
+def method_class(method):
+    return METHOD_CLASSES.get(method, UNARY)
+
+
+def request_user(context, user_id=""):
+    """The user whose share of upstream slots an RPC's calls use.
+
+    user_id when given (ChatSession messages carry one), else the USER_ID_KEY
+    request metadata, else the client's address.
+    """
+    if user_id:
+        return user_id
+    for key, value in context.invocation_metadata() or ():
+        if key == USER_ID_KEY:
+            return value
+    peer = context.peer() or ""
+    # "ipv4:127.0.0.1:54321": every connection from a host counts as one user
+    return peer.rpartition(":")[0] or peer
+
+
+class _Waiter:
+    __slots__ = ("priority", "user", "finish", "queued_at", "granted", "abandoned", "wake")
+
+    def __init__(self, priority, user, wake):
+        self.priority = priority
+        self.user = user
+        self.finish = 0.0
+        self.queued_at = time.monotonic()
+        self.granted = False
+        self.abandoned = False
+        self.wake = wake
+
+
+class _ClassQueue:
+    """Waiters of one priority class, in weighted fair queuing order across users.
+
+    Each waiter gets a virtual finish tag: one unit (divided by the user's
+    weight) after the later of the class's virtual time and the user's
+    previous tag. Waiters are served in tag order, so a user with many
+    queued calls takes turns with users that have few instead of going
+    first. The virtual time is the tag of the waiter last served.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.queued = 0
+        self.virtual_time = 0.0
+        self._heap = []          # (finish tag, sequence, _Waiter)
+        self._last_finish = {}   # user -> finish tag of their last queued waiter
+        self._user_queued = {}   # user -> waiters of theirs still queued
+        self._sequence = itertools.count()
+
+    def push(self, waiter, weight):
+        start = max(self.virtual_time, self._last_finish.get(waiter.user, 0.0))
+        waiter.finish = start + 1.0 / weight
+        self._last_finish[waiter.user] = waiter.finish
+        self._user_queued[waiter.user] = self._user_queued.get(waiter.user, 0) + 1
+        self.queued += 1
+        heapq.heappush(self._heap, (waiter.finish, next(self._sequence), waiter))
+
+    def pop(self):
+        while self._heap:
+            _, _, waiter = heapq.heappop(self._heap)
+            if waiter.abandoned:
+                continue
+            self.virtual_time = waiter.finish
+            self._forget(waiter)
+            return waiter
+        return None
+
+    def abandon(self, waiter):
+        waiter.abandoned = True
+        self._forget(waiter)
+
+    def _forget(self, waiter):
+        self.queued -= 1
+        count = self._user_queued[waiter.user] - 1
+        if count:
+            self._user_queued[waiter.user] = count
+        else:
+            # With nothing queued the user's next tag starts from the virtual time anyway
+            del self._user_queued[waiter.user]
+            del self._last_finish[waiter.user]
+
+
+class UpstreamScheduler:
+    """Shares max_concurrency upstream call slots between priority classes and users.
+
+    Every upstream call holds a slot while it runs; calls beyond the free
+    slots queue. When a slot frees it goes to the most urgent class
+    (interactive, then unary, then bulk) that has a queued call and is
+    below its cap in class_limits, and within the class to the user next in
+    weighted fair queuing order (weights: user -> weight, else
+    default_weight), so a user with weight 2 gets twice the turns. Bulk
+    work therefore only runs on slots the other classes leave free, and its
+    cap (by default DEFAULT_BULK_SHARE of the slots) keeps some free for
+    interactive turns arriving in the middle of a bulk job. A call that is
+    cancelled or runs out of time while queued leaves the queue and raises
+    CallCancelled or DeadlineExceeded. acquire() is for threads,
+    aacquire() for asyncio; a scheduler serves one or the other.
+
+    Class limits and weights must be positive: a class capped at 0 would
+    only ever queue its calls until their deadline.
+    """
+
+    def __init__(self, max_concurrency, class_limits=None, weights=None, default_weight=1, metrics=None):
+        self.max_concurrency = max_concurrency
+        limits = {BULK: max(1, int(max_concurrency * DEFAULT_BULK_SHARE))}
+        limits.update(class_limits or {})
+        self.classes = {}
+        for priority in PRIORITY_CLASSES:
+            limit = limits.get(priority)
+            if limit is None:
+                limit = max_concurrency
+            elif limit < 1:
+                raise ValueError(f"Class limit of {priority} must be at least 1, got {limit}")
+            self.classes[priority] = _ClassQueue(min(max_concurrency, limit))
+        self.weights = dict(weights or {})
+        self.default_weight = default_weight
+        for user, weight in [*self.weights.items(), ("*", default_weight)]:
+            if weight <= 0:
+                raise ValueError(f"Weight of user {user} must be positive, got {weight}")
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self.queue_wait = self.expired = None
+        if metrics is not None:
+            self.queue_wait = metrics.histogram("scheduler_queue_seconds",
+                                                "Time upstream calls waited for a slot, by priority class", ("class",))
+            self.expired = metrics.counter(
+                "scheduler_abandoned_total",
+                "Upstream calls that left the queue because their RPC was cancelled or out of time, by priority class",
+                ("class",))
+            metrics.callback_gauge("scheduler_queued", "Upstream calls waiting for a slot, by priority class",
+                                   lambda: self._gauge("queued"), ("class",))
+            metrics.callback_gauge("scheduler_in_flight", "Upstream calls holding a slot, by priority class",
+                                   lambda: self._gauge("in_flight"), ("class",))
+
+    def _gauge(self, field):
+        with self._lock:
+            return {(priority,): getattr(queue, field) for priority, queue in self.classes.items()}
+
+    def _enqueue(self, priority, user, wake):
+        waiter = _Waiter(priority, user, wake)
+        with self._lock:
+            self.classes[priority].push(waiter, self.weights.get(user, self.default_weight))
+            woken = self._dispatch()
+        self._wake(woken)
+        return waiter
+
+    def _dispatch(self):
+        """Grant free slots to queued waiters; returns them. Call with the lock held"""
+        woken = []
+        while self.in_flight < self.max_concurrency:
+            for queue in self.classes.values():
+                if queue.in_flight < queue.limit:
+                    waiter = queue.pop()
+                    if waiter is not None:
+                        break
+            else:
+                return woken
+            waiter.granted = True
+            queue.in_flight += 1
+            self.in_flight += 1
+            woken.append(waiter)
+        return woken
+
+    @staticmethod
+    def _wake(woken):
+        for waiter in woken:
+            waiter.wake()
+
+    def release(self, priority):
+        with self._lock:
+            self.classes[priority].in_flight -= 1
+            self.in_flight -= 1
+            woken = self._dispatch()
+        self._wake(woken)
+
+    def _granted(self, waiter):
+        """Record how long a granted waiter queued"""
+        if self.queue_wait is not None:
+            self.queue_wait.observe(time.monotonic() - waiter.queued_at, waiter.priority)
+
+    def _give_up(self, waiter, deadline):
+        """Leave the queue for a caller that stopped waiting, unless its slot was granted meanwhile"""
+        with self._lock:
+            if waiter.granted:
+                return
+            self.classes[waiter.priority].abandon(waiter)
+        if self.expired is not None:
+            self.expired.inc(waiter.priority)
+        if deadline is not None and deadline.cancelled:
+            raise CallCancelled("Call cancelled while waiting for an upstream slot")
+        raise DeadlineExceeded("Deadline exceeded while waiting for an upstream slot")
+
+    def acquire(self, priority, user, deadline=None):
+        """Wait for a slot for one upstream call of the priority class; call release(priority) after it"""
+        event = threading.Event()
+        waiter = self._enqueue(priority, user, event.set)
+        remaining = deadline.remaining() if deadline is not None else None
+        while not event.wait(SCHEDULER_POLL if remaining is None else min(SCHEDULER_POLL, remaining)):
+            if deadline is not None and deadline.done():
+                self._give_up(waiter, deadline)
+                break
+            remaining = deadline.remaining() if deadline is not None else None
+        self._granted(waiter)
+
+    async def aacquire(self, priority, user, deadline=None):
+        """asyncio version of acquire(); cancelling the caller leaves the queue"""
+        granted = asyncio.get_running_loop().create_future()
+        waiter = self._enqueue(priority, user, lambda: granted.done() or granted.set_result(None))
+        if not waiter.granted:
+            try:
+                await asyncio.wait_for(granted, deadline.remaining() if deadline is not None else None)
+            except asyncio.TimeoutError:
+                self._give_up(waiter, deadline)
+            except asyncio.CancelledError:
+                with self._lock:
+                    granted_meanwhile = waiter.granted
+                    if not granted_meanwhile:
+                        self.classes[priority].abandon(waiter)
+                if granted_meanwhile:
+                    self.release(priority)
+                raise
+        self._granted(waiter)
+
+    def scheduled(self, fn, priority, user, deadline=None):
+        """fn (a unary upstream call taking timeout=) wrapped to run in a slot.
+
+        The timeout passed on is what is left of the deadline after queueing.
+        """
+        def call(*args, **kwargs):
+            self.acquire(priority, user, deadline)
+            try:
+                return fn(*args, **_timeout(kwargs, deadline))
+            finally:
+                self.release(priority)
+        return call
+
+    def scheduled_stream(self, fn, priority, user, deadline=None):
+        """scheduled() for a streaming upstream call; the slot is held until the stream is closed"""
+        def stream(*args, **kwargs):
+            self.acquire(priority, user, deadline)
+            try:
+                yield from fn(*args, **_timeout(kwargs, deadline))
+            finally:
+                self.release(priority)
+        return stream
+
+    def ascheduled(self, fn, priority, user, deadline=None):
+        """scheduled() for a coroutine function"""
+        async def call(*args, **kwargs):
+            await self.aacquire(priority, user, deadline)
+            try:
+                return await fn(*args, **_timeout(kwargs, deadline))
+            finally:
+                self.release(priority)
+        return call
+
+    def ascheduled_stream(self, fn, priority, user, deadline=None):
+        """scheduled_stream() for an async generator function"""
+        async def stream(*args, **kwargs):
+            await self.aacquire(priority, user, deadline)
+            try:
+                async for piece in fn(*args, **_timeout(kwargs, deadline)):
+                    yield piece
+            finally:
+                self.release(priority)
+        return stream
+
+
+def _timeout(kwargs, deadline):
+    if deadline is not None and "timeout" in kwargs:
+        return {**kwargs, "timeout": deadline.remaining()}
+    return kwargs
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import pathlib
+import re
+import struct
+import time
+from array import array
+from collections import Counter
+from operator import itemgetter
+
+from cache import ResponseCache
+from fetcher import TextExtractor
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Results returned in ChatReply.web_results and added to the prompt
+DEFAULT_SEARCH_RESULTS = 3
+
+# Query cache entries; the index does not change while it is open, so entries never expire
+DEFAULT_QUERY_CACHE_SIZE = 4096
+
+# Highest-impact postings read per query term (0 reads all of them). Postings are stored best first,
+# so a cut only skips documents that score low on that term
+DEFAULT_MAX_POSTINGS = 1000
+
+# Best candidates rescored with the postings a cut skipped
+RESCORE_CANDIDATES = 100
+
+# Postings held in memory while building before they are written out as a sorted run
+DEFAULT_BUILD_BLOCK_POSTINGS = 4000000
+
+# Characters of each document kept for snippets, and the length of a snippet
+MAX_STORED_CHARS = 4000
+SNIPPET_CHARS = 240
+
+# Longer tokens (hashes, base64 blobs) are not indexed
+MAX_TERM_CHARS = 40
+
+# Query latency histogram buckets (seconds); searches are much faster than RPCs
+SEARCH_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+INDEX_VERSION = 1
+
+_TOKEN = re.compile(r"\w+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i in is it its of on or that the this to was what "
+    "when where which who why will with you your".split())
+_CORPUS_EXTENSIONS = {".txt", ".md", ".html", ".htm"}
+_RUN_HEADER = struct.Struct("<QI")
+
+
+def tokenize(text):
+    """Lowercased word tokens of text, without stopwords"""
+    return [token for token in _TOKEN.findall(text.lower())
+            if token not in _STOPWORDS and len(token) <= MAX_TERM_CHARS]
+
+
+def term_hash(term):
+    """64-bit key of a term in the lexicon"""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def make_snippet(text, terms, size=SNIPPET_CHARS):
+    """About size characters of text around the first occurrence of one of terms, cut at word boundaries"""
+    text = " ".join(text.split())
+    if len(text) <= size:
+        return text
+    match = re.search(r"\b(?:" + "|".join(map(re.escape, terms)) + r")\b", text, re.IGNORECASE)
+    begin = 0
+    if match is not None and match.end() > size:
+        begin = max(0, match.start() - size // 3)
+        space = text.find(" ", begin, match.start())
+        begin = space + 1 if space >= 0 else match.start()
+    end = min(len(text), begin + size)
+    if end < len(text):
+        space = text.rfind(" ", begin, end)
+        if space > begin:
+            end = space
+    return ("..." if begin else "") + text[begin:end] + ("..." if end < len(text) else "")
+
+
+def read_corpus(path):
+    """Yield (title, url, text) documents from a JSON lines file with title, url and text fields per line,
+    or from the .txt, .md and .html files under a directory"""
+    if not os.path.isdir(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    document = json.loads(line)
+                    yield document.get("title", ""), document.get("url", ""), document.get("text", "")
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            stem, extension = os.path.splitext(name)
+            if extension.lower() not in _CORPUS_EXTENSIONS:
+                continue
+            file_path = os.path.join(root, name)
+            with open(file_path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            title = stem
+            if extension.lower() in (".html", ".htm"):
+                extractor = TextExtractor()
+                extractor.feed(text)
+                extractor.close()
+                text = extractor.text()
+                title = " ".join(extractor.title.split()) or stem
+            yield title, pathlib.Path(file_path).resolve().as_uri(), text
+
+
+def _write_array(path, name, values):
+    with open(os.path.join(path, name), "wb") as f:
+        values.tofile(f)
+
+
+def _write_run(block, path, number):
+    """Write one block of postings sorted by term hash; doc ids in a run only grow"""
+    run_path = os.path.join(path, f"run-{number}.tmp")
+    entries = sorted(((term_hash(term), doc_ids, tfs) for term, (doc_ids, tfs) in block.items()),
+                     key=itemgetter(0))
+    with open(run_path, "wb") as f:
+        for key, doc_ids, tfs in entries:
+            f.write(_RUN_HEADER.pack(key, len(doc_ids)))
+            doc_ids.tofile(f)
+            tfs.tofile(f)
+    return run_path
+
+
+def _read_run(run_path, number):
+    with open(run_path, "rb") as f:
+        while True:
+            header = f.read(_RUN_HEADER.size)
+            if not header:
+                return
+            key, count = _RUN_HEADER.unpack(header)
+            yield key, number, f.read(count * 4), f.read(count * 2)
+
+
+def build_index(documents, path, block_postings=DEFAULT_BUILD_BLOCK_POSTINGS, k1=BM25_K1, b=BM25_B):
+    """Write a BM25 index of (title, url, text) documents to the directory path and return the document count.
+
+    Postings are collected in blocks of about block_postings, each written
+    out as a run sorted by term, then the runs are merged. Each term's
+    postings are stored with their precomputed BM25 score (impact) twice:
+    highest first, so a query reads only the head of each list, and by doc
+    id, to look up single documents in the rest. meta.json is written last;
+    a directory without it is not opened.
+    """
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    lengths = array("I")
+    offsets = array("Q", [0])
+    runs = []
+    block = {}
+    block_size = 0
+    with open(os.path.join(path, "docs.data"), "wb") as docs:
+        for title, url, text in documents:
+            doc_id = len(lengths)
+            record = json.dumps([title, url, text[:MAX_STORED_CHARS]], ensure_ascii=False).encode("utf-8")
+            docs.write(record)
+            offsets.append(offsets[-1] + len(record))
+            terms = tokenize(f"{title}\n{text}")
+            lengths.append(len(terms))
+            counts = Counter(terms)
+            for term, tf in counts.items():
+                postings = block.get(term)
+                if postings is None:
+                    postings = block[term] = (array("I"), array("H"))
+                postings[0].append(doc_id)
+                postings[1].append(min(tf, 0xFFFF))
+            block_size += len(counts)
+            if block_size >= block_postings:
+                runs.append(_write_run(block, path, len(runs)))
+                block = {}
+                block_size = 0
+    if block:
+        runs.append(_write_run(block, path, len(runs)))
+    _write_array(path, "docs.offsets", offsets)
+
+    document_count = len(lengths)
+    average_length = sum(lengths) / document_count if document_count else 0.0
+    # The per-document part of the BM25 denominator
+    norms = array("d", (k1 * (1 - b + b * length / average_length) if average_length else k1
+                        for length in lengths))
+    hashes = array("Q")
+    starts = array("Q")
+    counts = array("I")
+    position = 0
+    files = [open(os.path.join(path, name), "wb")
+             for name in ("impact_order.docs", "impact_order.impacts", "doc_order.docs", "doc_order.impacts")]
+    try:
+        merged = heapq.merge(*(_read_run(run_path, number) for number, run_path in enumerate(runs)))
+        for key, group in itertools.groupby(merged, key=itemgetter(0)):
+            doc_ids = array("I")
+            tfs = array("H")
+            for _, _, run_doc_ids, run_tfs in group:
+                doc_ids.frombytes(run_doc_ids)
+                tfs.frombytes(run_tfs)
+            df = len(doc_ids)
+            scale = math.log(1 + (document_count - df + 0.5) / (df + 0.5)) * (k1 + 1)
+            impacts = array("f", [scale * tf / (tf + norms[doc_id]) for doc_id, tf in zip(doc_ids, tfs)])
+            order = sorted(range(df), key=impacts.__getitem__, reverse=True)
+            array("I", map(doc_ids.__getitem__, order)).tofile(files[0])
+            array("f", map(impacts.__getitem__, order)).tofile(files[1])
+            doc_ids.tofile(files[2])
+            impacts.tofile(files[3])
+            hashes.append(key)
+            starts.append(position)
+            counts.append(df)
+            position += df
+    finally:
+        for f in files:
+            f.close()
+    for run_path in runs:
+        os.remove(run_path)
+    _write_array(path, "lexicon.hashes", hashes)
+    _write_array(path, "lexicon.starts", starts)
+    _write_array(path, "lexicon.counts", counts)
+    with open(meta_path, "w") as f:
+        json.dump({"version": INDEX_VERSION, "documents": document_count, "terms": len(hashes),
+                   "postings": position, "average_length": average_length, "k1": k1, "b": b}, f)
+    return document_count
+
+
+class SearchResult:
+    """One search hit: the document's title and URL, a snippet around the query terms and its BM25 score"""
+
+    __slots__ = ("title", "url", "snippet", "score")
+
+    def __init__(self, title, url, snippet, score):
+        self.title = title
+        self.url = url
+        self.snippet = snippet
+        self.score = score
+
+
+class SearchIndex:
+    """Read-only BM25 index written by build_index.
+
+    Every file is memory-mapped, so opening an index of any size reads only
+    meta.json and queries page in just the lexicon entries, postings and
+    documents they touch. A query looks its terms up by binary search in
+    the sorted lexicon, adds up the stored impacts of at most max_postings
+    postings per term, completes the scores of the best candidates from the
+    postings that were cut and reads the top k documents for their snippets.
+    Results are cached by the set of query terms. One instance can be shared
+    by any number of threads.
+    """
+
+    def __init__(self, path, cache_size=DEFAULT_QUERY_CACHE_SIZE, max_postings=DEFAULT_MAX_POSTINGS, metrics=None):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported search index version {meta.get('version')!r} in {path}")
+        self.path = path
+        self.documents = meta["documents"]
+        self.terms = meta["terms"]
+        self.max_postings = max_postings
+        self._maps = []
+        self._views = []
+        self._hashes = self._map("lexicon.hashes", "Q")
+        self._starts = self._map("lexicon.starts", "Q")
+        self._counts = self._map("lexicon.counts", "I")
+        self._postings = self._map("impact_order.docs", "I")
+        self._impacts = self._map("impact_order.impacts", "f")
+        self._doc_order = self._map("doc_order.docs", "I")
+        self._doc_order_impacts = self._map("doc_order.impacts", "f")
+        self._offsets = self._map("docs.offsets", "Q")
+        self._docs = self._map("docs.data", "B")
+        self.cache = ResponseCache(cache_size, float("inf")) if cache_size > 0 else None
+        self.latency = None
+        if metrics is not None:
+            self.latency = metrics.histogram("search_seconds", "Duration of search index queries (cache misses)",
+                                             buckets=SEARCH_LATENCY_BUCKETS)
+            if self.cache is not None:
+                cache = self.cache
+                metrics.callback_counter("search_cache_hits_total", "Search query cache hits",
+                                         lambda: cache.stats()["hits"])
+                metrics.callback_counter("search_cache_misses_total", "Search query cache misses",
+                                         lambda: cache.stats()["misses"])
+
+    def _map(self, name, typecode):
+        with open(os.path.join(self.path, name), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files cannot be mapped
+                return memoryview(b"").cast(typecode)
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        view = memoryview(mapped)
+        self._views.append(view)
+        view = view.cast(typecode)
+        self._views.append(view)
+        return view
+
+    def search(self, query, k=DEFAULT_SEARCH_RESULTS):
+        """Return a tuple of up to k SearchResults for query, best first"""
+        terms = sorted(set(tokenize(query)))
+        if not terms or k <= 0:
+            return ()
+        key = (tuple(terms), k)
+        if self.cache is not None:
+            results = self.cache.get(key)
+            if results is not None:
+                return results
+        start = time.perf_counter()
+        results = tuple(self._result(doc_id, score, terms) for doc_id, score in self._top(terms, k))
+        if self.latency is not None:
+            self.latency.observe(time.perf_counter() - start)
+        if self.cache is not None:
+            self.cache.put(key, results)
+        return results
+
+    def _top(self, terms, k):
+        """(doc id, score) of the k best documents.
+
+        Impacts are summed over the head of each term's postings. When a list
+        was cut, a candidate may also appear in its tail, so the best
+        candidates get those impacts added from the doc-ordered postings.
+        """
+        scores = {}
+        get = scores.get
+        cut = []
+        for term in terms:
+            key = term_hash(term)
+            i = bisect.bisect_left(self._hashes, key)
+            if i == len(self._hashes) or self._hashes[i] != key:
+                continue
+            start = self._starts[i]
+            count = self._counts[i]
+            end = start + (min(count, self.max_postings) if self.max_postings else count)
+            head = self._postings[start:end]
+            for doc_id, impact in zip(head, self._impacts[start:end]):
+                scores[doc_id] = get(doc_id, 0.0) + impact
+            if end < start + count:
+                cut.append((start, start + count, set(head)))
+        if not cut or len(terms) == 1:
+            return heapq.nlargest(k, scores.items(), key=itemgetter(1))
+        rescored = []
+        for doc_id, score in heapq.nlargest(max(k, RESCORE_CANDIDATES), scores.items(), key=itemgetter(1)):
+            for start, end, head in cut:
+                if doc_id not in head:
+                    i = bisect.bisect_left(self._doc_order, doc_id, start, end)
+                    if i < end and self._doc_order[i] == doc_id:
+                        score += self._doc_order_impacts[i]
+            rescored.append((doc_id, score))
+        return heapq.nlargest(k, rescored, key=itemgetter(1))
+
+    def _result(self, doc_id, score, terms):
+        title, url, text = json.loads(bytes(self._docs[self._offsets[doc_id]:self._offsets[doc_id + 1]]))
+        return SearchResult(title, url, make_snippet(text, terms), score)
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+        self._views = []
+        self._maps = []
+
+    def __len__(self):
+        return self.documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the local search index used for enable_web_access")
+    parser.add_argument("corpus", help="JSON lines file of {\"title\", \"url\", \"text\"} documents, "
+                                       "or a directory of .txt, .md and .html files")
+    parser.add_argument("index", help="Directory to write the index to")
+    parser.add_argument("--block-postings", type=int, default=DEFAULT_BUILD_BLOCK_POSTINGS,
+                        help="Postings held in memory before a sorted run is written to disk")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    count = build_index(read_corpus(args.corpus), args.index, args.block_postings)
+    logging.info("Indexed %d documents into %s in %.1fs", count, args.index, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
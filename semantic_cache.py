@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+import math
+import random
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+
+from search_index import tokenize
+
+# Coordinates of the hashed n-gram vectors
+DEFAULT_DIMENSIONS = 256
+
+# Cosine similarity a cached prompt needs for its answer to be served to a new prompt.
+# Lower thresholds answer more paraphrases but also more questions that differ in one word
+DEFAULT_THRESHOLD = 0.95
+
+# Locality-sensitive hashing: signature tables of random hyperplanes and bits per signature.
+# More tables find more of the matches close to the threshold; more bits make buckets smaller
+DEFAULT_TABLES = 12
+DEFAULT_BITS = 20
+
+# Neighbouring buckets a lookup also reads per table, flipping the least certain signature bits
+DEFAULT_PROBES = 4
+
+# Weights of word pairs and character trigrams, relative to single words
+BIGRAM_WEIGHT = 0.5
+TRIGRAM_WEIGHT = 0.5
+
+# Words that only make a request politer or longer ("can you tell me ..."), on top of the search stopwords
+_FILLER = frozenset("can could would please tell me give show know do does s d ll re ve".split())
+
+# Every process draws the same hyperplanes
+HYPERPLANE_SEED = 0
+
+# Lookup latency histogram buckets (seconds)
+LOOKUP_LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+
+class HashingVectorizer:
+    """Embeds text as hashed words, word pairs and character trigrams.
+
+    Words are the search index's tokens (lowercased, without stopwords),
+    less filler such as "tell me". Each distinct word, pair of adjacent
+    words and trigram of a padded word sets one of dimensions coordinates
+    to its weight, with a sign also taken from its hash so that collisions
+    cancel out on average. Pairs keep "dog bites man" apart from "man bites
+    dog", and trigrams let inflections and typos ("capitals", "captial")
+    still count as partly the same word. Needs no model or dependency, and
+    takes some tens of microseconds per prompt.
+    """
+
+    def __init__(self, dimensions=DEFAULT_DIMENSIONS, bigram_weight=BIGRAM_WEIGHT, trigram_weight=TRIGRAM_WEIGHT):
+        self.dimensions = dimensions
+        self.bigram_weight = bigram_weight
+        self.trigram_weight = trigram_weight
+
+    def __call__(self, text):
+        words = [word for word in tokenize(text) if word not in _FILLER]
+        features = dict.fromkeys(words, 1.0)
+        for pair in zip(words, words[1:]):
+            features.setdefault(" ".join(pair), self.bigram_weight)
+        for word in set(words):
+            padded = f"<{word}>"
+            for i in range(len(padded) - 2):
+                features.setdefault(padded[i:i + 3], self.trigram_weight)
+        vector = [0.0] * self.dimensions
+        for feature, weight in features.items():
+            h = zlib.crc32(feature.encode("utf-8"))
+            vector[h % self.dimensions] += weight if h & 0x80000000 else -weight
+        return vector
+
+
+class _Entry:
+    __slots__ = ("key", "buckets", "expires_at", "value")
+
+    def __init__(self, key, buckets, expires_at, value):
+        self.key = key
+        self.buckets = buckets
+        self.expires_at = expires_at
+        self.value = value
+
+
+class SemanticCache:
+    """LRU/TTL cache of AI responses that also answers prompts similar to a cached one.
+
+    Keys are ResponseCache.make_key() tuples. The model and system prompt
+    form a namespace, and a prompt only matches prompts cached in the same
+    one. Prompts are embedded with embed (text to a sequence of dimensions
+    floats; HashingVectorizer by default), and get() returns the answer of
+    the most similar cached prompt whose cosine similarity is at least
+    threshold. Candidates come from locality-sensitive hashing: each of
+    tables random hyperplane signatures puts a vector in a bucket, and a
+    lookup reads its own bucket and probes neighbouring ones per table and
+    compares only the vectors in them, so it costs about the same at any
+    cache size. The price is that a match only just above the threshold is
+    sometimes missed. Vectors are kept in a NumPy matrix when NumPy is
+    installed and use_numpy is set, else in arrays (several times slower).
+    Like ResponseCache, one instance can be shared by both servicers.
+    """
+
+    def __init__(self, max_entries=10000, ttl=3600.0, threshold=DEFAULT_THRESHOLD, embed=None,
+                 dimensions=DEFAULT_DIMENSIONS, tables=DEFAULT_TABLES, bits=DEFAULT_BITS, probes=DEFAULT_PROBES,
+                 use_numpy=True, clock=time.monotonic, metrics=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.embed = embed if embed is not None else HashingVectorizer(dimensions)
+        self.dimensions = dimensions
+        self.tables = tables
+        self.bits = bits
+        self.probes = min(probes, bits)
+        self._clock = clock
+        self._np = None
+        if use_numpy:
+            try:
+                import numpy
+                self._np = numpy
+            except ImportError:
+                pass
+        rng = random.Random(HYPERPLANE_SEED)
+        planes = [[rng.gauss(0.0, 1.0) for _ in range(dimensions)] for _ in range(tables * bits)]
+        if self._np is not None:
+            self._planes = self._np.array(planes, dtype=self._np.float32)
+            self._bit_values = 1 << self._np.arange(bits, dtype=self._np.int64)
+            self._table_keys = self._np.arange(tables, dtype=self._np.int64) << bits
+            self._matrix = self._np.zeros((min(max_entries, 1024), dimensions), dtype=self._np.float32)
+        else:
+            # Column i holds every hyperplane's coefficient for coordinate i, for sparse projections
+            self._columns = [array("d", column) for column in zip(*planes)]
+            self._rows = []
+        self._entries = OrderedDict()  # slot -> _Entry, least recently used first
+        self._slots = {}               # key -> slot
+        self._namespaces = {}          # (model, system prompt) -> {table << bits | signature: set of slots}
+        self._free = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.latency = None
+        if metrics is not None:
+            self.latency = metrics.histogram("semantic_cache_lookup_seconds", "Duration of semantic cache lookups",
+                                             buckets=LOOKUP_LATENCY_BUCKETS)
+            metrics.callback_counter("semantic_cache_hits_total", "Prompts answered by a similar cached prompt",
+                                     lambda: self.stats()["hits"])
+            metrics.callback_counter("semantic_cache_misses_total", "Semantic cache lookups without a match",
+                                     lambda: self.stats()["misses"])
+            metrics.callback_gauge("semantic_cache_entries", "Prompts in the semantic cache", lambda: len(self))
+
+    def _vector(self, text):
+        """Unit vector of text and its projections on the hyperplanes, or None for text without words.
+
+        Without NumPy the vector is the (coordinate, value) pairs of its non-zero coordinates.
+        """
+        vector = self.embed(text)
+        if len(vector) != self.dimensions:
+            raise ValueError(f"Embedding has {len(vector)} dimensions, expected {self.dimensions}")
+        if self._np is not None:
+            vector = self._np.asarray(vector, dtype=self._np.float32)
+            norm = float(self._np.linalg.norm(vector))
+            if not norm:
+                return None
+            vector = vector / norm
+            return vector, self._planes @ vector
+        norm = math.sqrt(sum(x * x for x in vector))
+        if not norm:
+            return None
+        pairs = [(i, x / norm) for i, x in enumerate(vector) if x]
+        projections = [0.0] * (self.tables * self.bits)
+        for i, x in pairs:
+            projections = [p + x * c for p, c in zip(projections, self._columns[i])]
+        return pairs, projections
+
+    def _buckets(self, projections, probes=0):
+        """Bucket keys of a vector in each table, plus the probes neighbouring buckets per table"""
+        if self._np is not None:
+            projections = projections.reshape(self.tables, self.bits)
+            signatures = (projections > 0) @ self._bit_values + self._table_keys
+            if not probes:
+                return signatures.tolist()
+            flips = self._bit_values[self._np.argsort(abs(projections), axis=1)[:, :probes]]
+            return self._np.concatenate((signatures, (signatures[:, None] ^ flips).ravel())).tolist()
+        buckets = []
+        for table in range(self.tables):
+            row = projections[table * self.bits:(table + 1) * self.bits]
+            signature = table << self.bits
+            for bit, p in enumerate(row):
+                if p > 0:
+                    signature |= 1 << bit
+            buckets.append(signature)
+            if probes:
+                for bit in sorted(range(self.bits), key=lambda b: abs(row[b]))[:probes]:
+                    buckets.append(signature ^ (1 << bit))
+        return buckets
+
+    def _similarities(self, vector, slots):
+        if self._np is not None:
+            rows = self._np.fromiter(slots, dtype=self._np.intp, count=len(slots))
+            return (self._matrix[rows] @ vector).tolist()
+        return [sum([row[i] * x for i, x in vector]) for row in map(self._rows.__getitem__, slots)]
+
+    def get(self, key):
+        """Return the answer cached for the prompt of key most similar to it, or None below the threshold"""
+        start = time.perf_counter()
+        embedded = self._vector(key[2])
+        value = None
+        with self._lock:
+            if embedded is not None:
+                value = self._match(key[:2], *embedded)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if self.latency is not None:
+            self.latency.observe(time.perf_counter() - start)
+        return value
+
+    def _match(self, namespace, vector, projections):
+        """Best unexpired match of vector in namespace, or None. Call with the lock held"""
+        buckets = self._namespaces.get(namespace)
+        if buckets is None:
+            return None
+        candidates = set()
+        for bucket in self._buckets(projections, self.probes):
+            slots = buckets.get(bucket)
+            if slots:
+                candidates.update(slots)
+        if not candidates:
+            return None
+        candidates = list(candidates)
+        scores = self._similarities(vector, candidates)
+        now = self._clock()
+        for score, slot in sorted(((score, slot) for score, slot in zip(scores, candidates)
+                                   if score >= self.threshold), reverse=True):
+            entry = self._entries[slot]
+            if entry.expires_at <= now:
+                self._remove(slot)
+                continue
+            self._entries.move_to_end(slot)
+            return entry.value
+        return None
+
+    def put(self, key, value):
+        """Store value as the answer to key's prompt, evicting the least recently used entries if full"""
+        embedded = self._vector(key[2])
+        if embedded is None:
+            # Prompts of stopwords only ("what is it?") are too vague to match
+            return
+        vector, projections = embedded
+        buckets = self._buckets(projections)
+        expires_at = self._clock() + self.ttl
+        with self._lock:
+            if key in self._slots:
+                self._remove(self._slots[key])
+            while len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))
+            slot = self._allocate(vector)
+            namespace = self._namespaces.setdefault(key[:2], {})
+            for bucket in buckets:
+                namespace.setdefault(bucket, set()).add(slot)
+            self._entries[slot] = _Entry(key, buckets, expires_at, value)
+            self._slots[key] = slot
+
+    def _allocate(self, vector):
+        """A free slot holding vector. Call with the lock held"""
+        if self._np is None:
+            row = array("d", bytes(8 * self.dimensions))
+            for i, x in vector:
+                row[i] = x
+            if self._free:
+                slot = self._free.pop()
+                self._rows[slot] = row
+            else:
+                slot = len(self._rows)
+                self._rows.append(row)
+            return slot
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._entries)
+            if slot == len(self._matrix):
+                # Grow by doubling, up to max_entries rows
+                grown = self._np.zeros((min(self.max_entries, 2 * slot), self.dimensions), dtype=self._np.float32)
+                grown[:slot] = self._matrix
+                self._matrix = grown
+        self._matrix[slot] = vector
+        return slot
+
+    def _remove(self, slot):
+        """Drop the entry in slot. Call with the lock held"""
+        entry = self._entries.pop(slot)
+        del self._slots[entry.key]
+        namespace = self._namespaces[entry.key[:2]]
+        for bucket in entry.buckets:
+            slots = namespace[bucket]
+            slots.discard(slot)
+            if not slots:
+                del namespace[bucket]
+        if not namespace:
+            del self._namespaces[entry.key[:2]]
+        self._free.append(slot)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._slots.clear()
+            self._namespaces.clear()
+            self._free.clear()
+            if self._np is None:
+                self._rows.clear()
+
+    def stats(self):
+        """Return hit/miss counters and the current number of entries"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
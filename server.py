@@ -1,102 +1,347 @@
 #!/usr/bin/env python3
 import os
+import sys
+import signal
+import argparse
+import asyncio
+import functools
 import grpc
 import chatbot_pb2
 import chatbot_pb2_grpc
-import concurrent.futures
 from concurrent import futures
 import logging
-from groq import Groq
 import time
 import uuid
 from datetime import datetime
 import threading
+import queue
+
+from admission import AdmissionController, AdmissionInterceptor, parse_limits
+from backends import BackendError, GroqBackend, build_backend, DEFAULT_MODEL
+from batcher import MicroBatcher, DEFAULT_MAX_WAIT as DEFAULT_BATCH_MAX_WAIT
+from cache import ResponseCache
+from grpc_config import (server_options, apply_response_compression, COMPRESSION, DEFAULT_SERVER_KEEPALIVE_TIME,
+                         DEFAULT_KEEPALIVE_TIMEOUT, DEFAULT_MAX_MESSAGE_BYTES)
+from fetcher import (Fetcher, FetchCache, ConnectionPool, content_token_budget, truncate_to_tokens,
+                     DEFAULT_FETCH_CONCURRENCY, DEFAULT_PER_HOST, DEFAULT_MAX_BYTES, DEFAULT_FETCH_TIMEOUT,
+                     DEFAULT_FETCH_CACHE_SIZE, DEFAULT_FETCH_CACHE_TTL)
+from metrics import ServerMetrics, MetricsInterceptor, InstrumentedBackend, start_http_server, DEFAULT_METRICS_HOST
+from resilience import (Resilience, RetryPolicy, CircuitBreaker, CircuitOpenError, CallCancelled, Deadline,
+                        DeadlineExceeded, RetryBudgetExhausted, DEFAULT_RETRIES, DEFAULT_BASE_DELAY, DEFAULT_MAX_DELAY,
+                        DEFAULT_BREAKER_FAILURES, DEFAULT_BREAKER_RESET)
+from scheduler import (UpstreamScheduler, method_class, request_user, PRIORITY_CLASSES, BULK, DEFAULT_BULK_SHARE,
+                       USER_ID_KEY)
+from search_index import SearchIndex, DEFAULT_SEARCH_RESULTS, DEFAULT_QUERY_CACHE_SIZE, DEFAULT_MAX_POSTINGS
+from semantic_cache import SemanticCache, DEFAULT_THRESHOLD as DEFAULT_SEMANTIC_THRESHOLD
+from singleflight import SingleFlight, SharedCallAbandoned
+from supervisor import Supervisor, notify_ready, DEFAULT_SHUTDOWN_GRACE
+from structured_logging import (rpc_log, payload, configure_logging, parse_sample_rates, PAYLOAD_MODES,
+                                DEFAULT_PAYLOAD_MODE, DEFAULT_PAYLOAD_CHARS)
+from session_store import (SessionStore, DEFAULT_MAX_IDLE, DEFAULT_MAX_SESSIONS, DEFAULT_EVICTION_INTERVAL,
+                           DEFAULT_TOKEN_BUDGET, MAX_HISTORY_MESSAGES)
+from session_backend import SQLiteSessionBackend
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 # You'll need to set your Groq API key as an environment variable
 # export GROQ_API_KEY=your_api_key_here
+# (not needed with --backend fake, which runs a local stand-in for load testing)
+
+# Streamed tokens are coalesced into ResponseChunks of at most this many bytes,
+# or whatever has arrived once this many seconds have passed since the last chunk
+STREAM_CHUNK_MAX_BYTES = 64
+STREAM_CHUNK_MAX_DELAY = 0.05
+
+# Marks the end of the tokens handed from coalesce_tokens' reader thread
+_END_OF_TOKENS = object()
+
+# Port the server listens on
+DEFAULT_PORT = 50051
+
+# Maximum number of URLs summarized concurrently across all BulkSummarize calls
+DEFAULT_BULK_CONCURRENCY = 8
+
+# Seconds between cancellation checks of a BulkSummarizeStream dispatcher waiting for a free slot
+BULK_DISPATCH_POLL = 0.5
+
+# System prompts (part of the response cache and single-flight keys, with the model)
+ASSISTANT_PROMPT = "You are mira, a helpful assistant."
+SUMMARY_PROMPT = "You are a summarization assistant."
+CHAT_SESSION_PROMPT = "You are mira, a helpful assistant. Maintain conversation context and provide relevant, coherent responses."
+CONDENSE_PROMPT = "You condense conversations into short summaries that keep the facts an assistant needs to continue them."
+
+# Target length of rolling conversation summaries
+ROLLING_SUMMARY_WORDS = 150
+
+# Response cache defaults (entries, seconds)
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 3600
+
+
+def coalesce_tokens(tokens, max_bytes=STREAM_CHUNK_MAX_BYTES, max_delay=STREAM_CHUNK_MAX_DELAY):
+    """Group streamed tokens into larger pieces by size or time window.
+
+    The first token is passed through immediately to keep time-to-first-chunk low.
+    Later tokens are flushed once max_bytes have arrived, or max_delay seconds after
+    the last flush even when no further token comes, so a stalling upstream does not
+    hold back what has already arrived. A reader thread iterates tokens and closes
+    them when they are exhausted or once this generator is closed.
+    """
+    pending = queue.SimpleQueue()
+    stopped = threading.Event()
+
+    def read():
+        try:
+            for token in tokens:
+                pending.put(token)
+                if stopped.is_set():
+                    break
+        except Exception as e:
+            pending.put(e)
+        finally:
+            close = getattr(tokens, "close", None)
+            if close is not None:
+                close()
+            pending.put(_END_OF_TOKENS)
+
+    threading.Thread(target=read, name="coalesce-tokens", daemon=True).start()
+    buffer = []
+    size = 0
+    last_flush = float("-inf")
+    try:
+        while True:
+            timeout = max(0.0, last_flush + max_delay - time.monotonic()) if buffer else None
+            try:
+                token = pending.get(timeout=timeout)
+            except queue.Empty:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                last_flush = time.monotonic()
+                continue
+            if token is _END_OF_TOKENS:
+                break
+            if isinstance(token, Exception):
+                raise token
+            buffer.append(token)
+            size += len(token.encode("utf-8"))
+            now = time.monotonic()
+            if size >= max_bytes or now - last_flush >= max_delay:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                last_flush = now
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        stopped.set()
+
+
+def upstream_error_status(error):
+    """Status for an RPC whose upstream call failed: UNAVAILABLE while the circuit is open, else INTERNAL"""
+    if isinstance(error, CircuitOpenError):
+        return grpc.StatusCode.UNAVAILABLE
+    if isinstance(error, (DeadlineExceeded, RetryBudgetExhausted)):
+        return grpc.StatusCode.DEADLINE_EXCEEDED
+    if isinstance(error, CallCancelled):
+        return grpc.StatusCode.CANCELLED
+    return grpc.StatusCode.INTERNAL
+
+
+def watch_deadline(context):
+    """Deadline for a threaded RPC, cancelled (running its on_cancel callbacks) when the RPC terminates"""
+    deadline = Deadline.from_context(context)
+    if not context.add_callback(deadline.cancel):
+        # Already terminated, e.g. cancelled while the call waited for a worker thread
+        deadline.cancel()
+    return deadline
+
+
+def web_search_prompt(results):
+    """ASSISTANT_PROMPT, followed by the search results the answer can draw on when there are any"""
+    if not results:
+        return ASSISTANT_PROMPT
+    sources = "\n\n".join(f"[{number}] {result.title} ({result.url})\n{result.snippet}"
+                           for number, result in enumerate(results, 1))
+    return f"{ASSISTANT_PROMPT} Use these search results where they help, citing them by number:\n\n{sources}"
+
+
+def web_result_messages(results):
+    return [chatbot_pb2.WebSearchResult(title=result.title, url=result.url, snippet=result.snippet)
+            for result in results]
+
+
+def replay_chunks(text, size=STREAM_CHUNK_MAX_BYTES):
+    """Split an already complete response into streaming-sized pieces"""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def rate_limited_message(request, rejection, timestamp, session_id, user_id):
+    """ChatSession reply to a message turned away by the per-user rate limit: a "system" message whose
+    retry_after_ms tells the client when to send it again"""
+    return chatbot_pb2.ChatMessage(
+        text=f"Sorry, you are sending messages too fast. {rejection.details()}",
+        sender="system",
+        timestamp=timestamp,
+        message_id=str(uuid.uuid4()),
+        reply_to=request.message_id,
+        session_id=session_id,
+        user_id=user_id,
+        retry_after_ms=rejection.retry_after_ms()
+    )
+
 
 class ChatServicer(chatbot_pb2_grpc.ChatServiceServicer):
-    def __init__(self):
-        # Initialize Groq client
-        api_key = os.environ.get("GROQ_API_KEY")
-        if not api_key:
-            logging.error("GROQ_API_KEY environment variable is not set")
-            raise ValueError("GROQ_API_KEY environment variable is not set")
-        self.client = Groq(api_key=api_key)
-        
-        # Session storage for conversation history
-        self.sessions = {}
-        self.sessions_lock = threading.Lock()
+    def __init__(self, bulk_concurrency=DEFAULT_BULK_CONCURRENCY, cache=None, sessions=None,
+                 backend=None, model=DEFAULT_MODEL, metrics=None, admission=None, resilience=None, fetcher=None,
+                 search=None, search_results=DEFAULT_SEARCH_RESULTS, batcher=None, scheduler=None,
+                 semantic_cache=None):
+        # LLM backend used for every completion (Groq unless another one is given)
+        if backend is None:
+            try:
+                backend = GroqBackend()
+            except ValueError as e:
+                logging.error(str(e))
+                raise
+        self.backend = backend
+        self.model = model
+        
+        # Session storage for conversation history; idle sessions are evicted in the background
+        self.sessions = sessions if sessions is not None else SessionStore()
+        self.sessions.start_eviction(min(DEFAULT_EVICTION_INTERVAL, self.sessions.max_idle))
+        
+        # Shared pool bounding how many BulkSummarize URLs are summarized at once
+        self.bulk_concurrency = bulk_concurrency
+        self.summary_executor = self._summary_pool(bulk_concurrency)
+        
+        # Optional response cache for GetReply and StreamResponse (None disables caching)
+        self.cache = cache
+        
+        # Optional SemanticCache consulted after an exact cache miss, answering similar prompts too
+        self.semantic_cache = semantic_cache
+        
+        # Identical completions already in flight share one upstream call; if it fails because the caller
+        # that started it went away, the others start their own
+        self.single_flight = SingleFlight(leader_errors=(CallCancelled, DeadlineExceeded))
         
+        # Optional ServerMetrics; upstream calls are timed by wrapping the backend
+        self.metrics = metrics
+        if metrics is not None:
+            self.backend = InstrumentedBackend(self.backend, metrics)
+            if self.summary_executor is not None:
+                metrics.watch_executor("summarize", self.summary_executor)
+            metrics.watch_servicer(self)
+        
+        # Optional AdmissionController; RPC limits are applied by the admission interceptor
+        self.admission = admission
+        
+        # Retries, hedging and circuit breaking around every upstream call, per RPC method
+        self.resilience = resilience if resilience is not None else Resilience(breaker=CircuitBreaker())
+        
+        # Optional Fetcher for the pages BulkSummarize summarizes (None: the model only sees the URL).
+        # Pages are fetched on its own pool as URLs arrive, overlapping with summarization
+        self.fetcher = fetcher
+        
+        # Optional SearchIndex answering requests with enable_web_access (None: the flag is ignored)
+        self.search = search
+        self.search_results = search_results
+        
+        # Optional MicroBatcher sending concurrent non-streaming completions as one backend batch() call
+        self.batcher = batcher
+        
+        # Optional UpstreamScheduler sharing upstream call slots by priority class and user
+        self.scheduler = scheduler
+        
+    @staticmethod
+    def _summary_pool(bulk_concurrency):
+        return futures.ThreadPoolExecutor(max_workers=bulk_concurrency, thread_name_prefix="summarize")
+    
     def GetReply(self, request, context):
         """Unary RPC - Summarize 1 URL or respond to 1 question"""
-        logging.info(f"Received message: {request.user_message}")
+        log = rpc_log("GetReply")
+        log.info("Received message: %s", payload(request.user_message))
+        deadline = watch_deadline(context)
         
         try:
-            # Call the Groq API with the user's message
-            chat_completion = self.client.chat.completions.create(
-                model="llama-3.1-8b-instant",  # You can change this to another model if needed
-                messages=[
-                    {"role": "system", "content": "You are mira, a helpful assistant."},
-                    {"role": "user", "content": request.user_message}
-                ]
-            )
+            # Search results become part of the prompt, so they are part of the cache key too
+            results = self._web_search(request, log)
+            system_prompt = web_search_prompt(results)
             
-            # Extract the response from the API result
-            ai_response = chat_completion.choices[0].message.content
-            logging.info(f"Generated response: {ai_response}")
+            cache_key, ai_response = self._cache_lookup(request.user_message, system_prompt)
+            if ai_response is not None:
+                log.info("Serving cached response")
+                return chatbot_pb2.ChatReply(ai_response=ai_response, web_results=web_result_messages(results))
             
-            return chatbot_pb2.ChatReply(ai_response=ai_response)
+            # Call the LLM backend with the user's message, sharing the call with identical in-flight requests
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": request.user_message}
+            ]
+            ai_response = self._shared_complete(cache_key, messages, "GetReply", deadline, request_user(context))
+            log.info("Generated response: %s", payload(ai_response))
+            
+            self._cache_store(cache_key, ai_response)
+            
+            return chatbot_pb2.ChatReply(ai_response=ai_response, web_results=web_result_messages(results))
         
         except Exception as e:
-            logging.error(f"Error calling Groq API: {str(e)}")
-            context.set_code(grpc.StatusCode.INTERNAL)
+            log.error("Error calling LLM backend: %s", e)
+            context.set_code(upstream_error_status(e))
             context.set_details(f"Error processing request: {str(e)}")
             return chatbot_pb2.ChatReply(ai_response="Sorry, I encountered an error processing your request.")
     
     def StreamResponse(self, request, context):
         """Server Streaming RPC - Stream chatbot response in parts"""
-        logging.info(f"Received stream request: {request.user_message}")
+        log = rpc_log("StreamResponse")
+        log.info("Received stream request: %s", payload(request.user_message))
+        deadline = watch_deadline(context)
         
         try:
-            # Call the Groq API with the user's message
-            chat_completion = self.client.chat.completions.create(
-                model="llama-3.1-8b-instant",
-                messages=[
-                    {"role": "system", "content": "You are mira, a helpful assistant."},
-                    {"role": "user", "content": request.user_message}
-                ]
-            )
+            system_prompt = web_search_prompt(self._web_search(request, log))
+            cache_key, ai_response = self._cache_lookup(request.user_message, system_prompt)
+            if ai_response is not None:
+                # Replay the cached answer without touching the backend
+                log.info("Streaming cached response")
+                for text in replay_chunks(ai_response):
+                    yield chatbot_pb2.ResponseChunk(content=text, is_final=False)
+                yield chatbot_pb2.ResponseChunk(content="", is_final=True)
+                return
             
-            # Extract the response from the API result
-            ai_response = chat_completion.choices[0].message.content
-            logging.info(f"Generated response for streaming: {ai_response}")
+            # Call the LLM backend in streaming mode so tokens can be forwarded as they arrive
+            stream = self._schedule_stream(self.backend.stream, "StreamResponse", request_user(context), deadline)
+            tokens = self.resilience.stream("StreamResponse", stream, self.model, [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": request.user_message}
+            ], deadline=deadline)
             
-            # Split the response into chunks (sentences or paragraphs)
-            # For demonstration, we'll split by sentences
-            chunks = ai_response.split('. ')
-            total_chunks = len(chunks)
+            # Forward coalesced pieces of the response as soon as they are ready
+            parts = []
+            chunks = coalesce_tokens(tokens)
+            try:
+                for text in chunks:
+                    if deadline.done():
+                        # Nobody is reading any more; stop generating into a dead stream
+                        log.info("Client cancelled or deadline passed, stopping stream")
+                        return
+                    parts.append(text)
+                    yield chatbot_pb2.ResponseChunk(content=text, is_final=False)
+            finally:
+                # Stops the reader thread, which closes the upstream stream if we stopped early
+                chunks.close()
             
-            for i, chunk in enumerate(chunks):
-                # Add period back if this isn't the last chunk
-                if i < total_chunks - 1 and not chunk.endswith('.'):
-                    chunk += '.'
-                    
-                # Add a small delay to simulate streaming
-                time.sleep(0.5)
-                
-                # Determine if this is the final chunk
-                is_final = (i == total_chunks - 1)
-                
-                # Yield each chunk as a separate response
-                yield chatbot_pb2.ResponseChunk(content=chunk.strip(), is_final=is_final)
+            ai_response = "".join(parts)
+            log.info("Generated response for streaming: %s", payload(ai_response))
+            
+            self._cache_store(cache_key, ai_response)
+            
+            # Empty final chunk marks the end of the response
+            yield chatbot_pb2.ResponseChunk(content="", is_final=True)
                 
         except Exception as e:
-            logging.error(f"Error in streaming response: {str(e)}")
-            context.set_code(grpc.StatusCode.INTERNAL)
+            log.error("Error in streaming response: %s", e)
+            context.set_code(upstream_error_status(e))
             context.set_details(f"Error processing streaming request: {str(e)}")
             # We need to yield an error response since this is a streaming RPC
             yield chatbot_pb2.ResponseChunk(
@@ -104,67 +349,282 @@ class ChatServicer(chatbot_pb2_grpc.ChatServiceServicer):
                 is_final=True
             )
     
+    def _web_search(self, request, log):
+        """Search results for a GetReply/StreamResponse request with enable_web_access, else ()"""
+        if not request.enable_web_access or self.search is None:
+            return ()
+        results = self.search.search(request.user_message, self.search_results)
+        log.info("Found %d search results", len(results))
+        return results
+    
+    def _cache_lookup(self, user_message, system_prompt=ASSISTANT_PROMPT):
+        """Return (cache key, cached response or None) for a GetReply/StreamResponse message"""
+        cache_key = ResponseCache.make_key(self.model, system_prompt, user_message)
+        for cache in (self.cache, self.semantic_cache):
+            if cache is not None:
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    return cache_key, cached
+        return cache_key, None
+    
+    def _cache_store(self, cache_key, ai_response):
+        """Cache a GetReply/StreamResponse answer under the key from _cache_lookup"""
+        for cache in (self.cache, self.semantic_cache):
+            if cache is not None:
+                cache.put(cache_key, ai_response)
+    
+    def _schedule(self, fn, method, user, deadline, priority=None):
+        """fn, waiting for an upstream slot of the method's priority class (or priority) before each call"""
+        if self.scheduler is None:
+            return fn
+        return self.scheduler.scheduled(fn, priority or method_class(method), user, deadline)
+    
+    def _schedule_stream(self, fn, method, user, deadline):
+        if self.scheduler is None:
+            return fn
+        return self.scheduler.scheduled_stream(fn, method_class(method), user, deadline)
+    
+    def _scheduled_batch(self, priority, user):
+        """backend.batch() waiting for one upstream slot of the priority class for the whole batch.
+        
+        A batch runs the function of the completion that opened it, so it queues as that completion's
+        user. The wait is bounded by the batch's timeout; running out of it is retryable for each caller.
+        """
+        if self.scheduler is None:
+            return self.backend.batch
+        scheduled = self.scheduler.scheduled
+        batch = self.backend.batch
+        
+        def call(model, message_lists, timeout=None):
+            try:
+                return scheduled(batch, priority, user, Deadline(timeout))(model, message_lists, timeout=timeout)
+            except DeadlineExceeded:
+                raise BackendError("Batch timed out waiting for an upstream slot", retryable=True) from None
+        return call
+    
+    def _complete(self, messages, method, deadline=None, user="", priority=None):
+        """Run one chat completion for an RPC method under its retry policy and return the response text.
+        
+        With a scheduler, each attempt queues for a slot as user, in the method's priority class unless
+        priority is given. With a batcher as well, completions are batched first, per priority class,
+        and each batch queues for one slot.
+        """
+        if self.batcher is not None:
+            priority = priority or method_class(method)
+            group = priority if self.scheduler is not None else None
+            return self.resilience.call(method, functools.partial(self.batcher.complete, group=group),
+                                        self._scheduled_batch(priority, user), self.model, messages,
+                                        deadline=deadline)
+        complete = self._schedule(self.backend.complete, method, user, deadline, priority)
+        return self.resilience.call(method, complete, self.model, messages, deadline=deadline)
+    
+    def _shared_complete(self, key, messages, method, deadline, user=""):
+        """_complete through single-flight, so identical completions in flight share one upstream call.
+        
+        The shared call runs under the deadline of the caller that started it. If that caller
+        goes away and the call gives up, the others start their own instead of failing. Any other
+        error, including the starting caller's own, is raised as is.
+        """
+        while True:
+            try:
+                return self.single_flight.do(key, self._complete, messages, method, deadline, user)
+            except SharedCallAbandoned:
+                error = deadline.error()
+                if error is not None:
+                    raise error
+    
+    def _drop_summaries(self, pending, method):
+        """Cancel the summaries of a terminated bulk call that have not started yet"""
+        dropped = sum(1 for future in pending if not future.done() and future.cancel())
+        if dropped and self.metrics is not None:
+            self.metrics.bulk_dropped.inc(method, amount=dropped)
+        return dropped
+    
+    def _start_fetch(self, url, deadline):
+        """Start fetching a page on the fetch pool; returns its Future"""
+        return self.fetcher.executor.submit(self._fetch, url, deadline)
+    
+    def _submit_summary(self, index, url, max_length, method, log, deadline, user=""):
+        """Summarize a URL on the summary pool, after fetching its page on the fetch pool if fetching is enabled.
+        
+        Returns a Future of the UrlSummary. The summary is only queued once its page has arrived, so
+        summary workers never wait on the network. Cancelling the Future before the summary starts
+        drops it, along with the fetch if that has not started either.
+        """
+        result = futures.Future()
+        
+        def summarize(fetch=None):
+            # Marks the result running so it can no longer be dropped; False if it already was
+            if result.set_running_or_notify_cancel():
+                result.set_result(self._summarize_url(index, url, max_length, method, log, deadline, fetch, user))
+        
+        if self.fetcher is None:
+            self.summary_executor.submit(summarize)
+        else:
+            fetch = self._start_fetch(url, deadline)
+            fetch.add_done_callback(lambda fetch: self.summary_executor.submit(summarize, fetch))
+            result.add_done_callback(lambda result: result.cancelled() and fetch.cancel())
+        return result
+    
+    def _fetch(self, url, deadline):
+        error = deadline.error()
+        if error is not None:
+            raise error
+        return self.fetcher.fetch(url, deadline.remaining())
+    
     def BulkSummarize(self, request_iterator, context):
         """Client Streaming RPC - Send multiple URLs to summarize in bulk"""
-        logging.info("Started bulk URL summarization process")
+        log = rpc_log("BulkSummarize")
+        log.info("Started bulk URL summarization process")
+        # Summaries are large and compress well; the client can ask for gzip or deflate per call
+        apply_response_compression(context)
         
-        summaries = []
+        pending = []
         count = 0
+        # Once the client cancels or its deadline passes, URLs still queued are dropped
+        deadline = watch_deadline(context)
+        deadline.on_cancel(lambda: self._drop_summaries(pending, "BulkSummarize"))
+        user = request_user(context)
         
-        # Process each URL request from the client stream
-        for request in request_iterator:
-            count += 1
-            url = request.url
-            max_length = request.max_length if request.max_length > 0 else 100  # Default length
-            
-            logging.info(f"Processing URL {count}: {url}")
-            
-            try:
-                # For demonstration, we'll simulate URL summarization
-                # In a real implementation, you would fetch and analyze the URL content
-                
-                # Call the Groq API to generate a summary
-                prompt = f"Summarize the content of this URL: {url} in about {max_length} words."
-                
-                chat_completion = self.client.chat.completions.create(
-                    model="llama-3.1-8b-instant",
-                    messages=[
-                        {"role": "system", "content": "You are a summarization assistant."},
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-                
-                summary = chat_completion.choices[0].message.content
-                
-                # Add the summary to our results
-                summaries.append(chatbot_pb2.UrlSummary(
-                    url=url,
-                    summary=summary,
-                    success=True,
-                    error_message=""
-                ))
+        # Hand each URL to the summary pool as soon as it arrives off the client stream
+        try:
+            for request in request_iterator:
+                if deadline.done():
+                    break
+                count += 1
+                max_length = request.max_length if request.max_length > 0 else 100  # Default length
                 
-            except Exception as e:
-                logging.error(f"Error summarizing URL {url}: {str(e)}")
-                summaries.append(chatbot_pb2.UrlSummary(
-                    url=url,
-                    summary="",
-                    success=False,
-                    error_message=str(e)
-                ))
-        
-        logging.info(f"Completed processing {count} URLs")
+                log.info("Queueing URL %d: %s", count, request.url)
+                pending.append(self._submit_summary(count - 1, request.url, max_length, "BulkSummarize", log,
+                                                    deadline, user))
+        except grpc.RpcError:
+            # The request stream ends with an error when the client cancels
+            if not deadline.done():
+                raise
+        
+        if deadline.done():
+            dropped = self._drop_summaries(pending, "BulkSummarize")
+            log.info("Client cancelled or deadline passed after %d URLs, dropped %d queued", count, dropped)
+            return chatbot_pb2.BulkSummaryResponse()
+        
+        # Collect results in input order
+        try:
+            summaries = [future.result() for future in pending]
+        except futures.CancelledError:
+            log.info("Client cancelled or deadline passed, stopped summarizing %d URLs", count)
+            return chatbot_pb2.BulkSummaryResponse()
+        
+        log.info("Completed processing %d URLs", count)
         return chatbot_pb2.BulkSummaryResponse(
             summaries=summaries,
             total_processed=count
         )
     
+    def BulkSummarizeStream(self, request_iterator, context):
+        """Bidirectional Streaming RPC - Stream each URL summary back as soon as it completes"""
+        log = rpc_log("BulkSummarizeStream")
+        log.info("Started streaming bulk URL summarization process")
+        apply_response_compression(context)
+        
+        # Completed summaries, plus a final (None, count) marker from the dispatcher
+        results = queue.Queue()
+        # Caps summaries in flight or waiting to be sent, so memory stays constant per call
+        slots = threading.BoundedSemaphore(self.bulk_concurrency)
+        # Summaries submitted and not finished, dropped if the client cancels or its deadline passes
+        in_flight = set()
+        deadline = watch_deadline(context)
+        deadline.on_cancel(lambda: self._drop_summaries(list(in_flight), "BulkSummarizeStream"))
+        user = request_user(context)
+        
+        def finished(future):
+            in_flight.discard(future)
+            if not future.cancelled():
+                results.put((future.result(), None))
+        
+        def dispatch():
+            count = 0
+            try:
+                for request in request_iterator:
+                    # Nobody releases slots once the handler stops reading results, so wait in steps
+                    while not slots.acquire(timeout=BULK_DISPATCH_POLL):
+                        if deadline.done():
+                            return
+                    if deadline.done():
+                        return
+                    max_length = request.max_length if request.max_length > 0 else 100  # Default length
+                    future = self._submit_summary(count, request.url, max_length, "BulkSummarizeStream", log,
+                                                  deadline, user)
+                    in_flight.add(future)
+                    future.add_done_callback(finished)
+                    count += 1
+            except Exception as e:
+                if not deadline.done():
+                    log.error("Error reading bulk summarization stream: %s", e)
+            finally:
+                results.put((None, count))
+        
+        threading.Thread(target=dispatch, daemon=True).start()
+        
+        sent = 0
+        total = None
+        while total is None or sent < total:
+            summary, count = results.get()
+            if deadline.done():
+                log.info("Client cancelled or deadline passed after %d URL summaries", sent)
+                return
+            if summary is None:
+                total = count
+                continue
+            yield summary
+            sent += 1
+            slots.release()
+        
+        log.info("Completed streaming %d URL summaries", sent)
+    
+    def _summarize_url(self, index, url, max_length, method, log, deadline, fetch=None, user=""):
+        """Summarize a single URL, reporting failures in the returned UrlSummary.
+        
+        fetch is the completed Future of the page fetched by _start_fetch, if fetching is enabled.
+        """
+        log.info("Processing URL: %s", url)
+        
+        try:
+            page = fetch.result() if fetch is not None else None
+            
+            # URLs (or pages) repeated within or across concurrent batches share one call
+            key, messages = summary_request(self.model, url, max_length, page)
+            summary = self._shared_complete(key, messages, method, deadline, user)
+            
+            return chatbot_pb2.UrlSummary(
+                url=url,
+                summary=summary,
+                success=True,
+                error_message="",
+                index=index
+            )
+            
+        except Exception as e:
+            if deadline.done():
+                log.info("Stopped summarizing URL %s: %s", url, e)
+            else:
+                log.error("Error summarizing URL %s: %s", url, e)
+            return chatbot_pb2.UrlSummary(
+                url=url,
+                summary="",
+                success=False,
+                error_message=str(e),
+                index=index
+            )
+    
     def ChatSession(self, request_iterator, context):
         """Bidirectional Streaming RPC - Real-time chatbot with history"""
-        logging.info("Started bidirectional chat session")
+        log = rpc_log("ChatSession")
+        log.info("Started bidirectional chat session")
         
         session_id = None
         user_id = None
+        session = None
+        deadline = watch_deadline(context)
         
         try:
             # Process incoming messages from the client
@@ -173,45 +633,32 @@ class ChatServicer(chatbot_pb2_grpc.ChatServiceServicer):
                 if session_id is None:
                     session_id = request.session_id if request.session_id else str(uuid.uuid4())
                     user_id = request.user_id if request.user_id else "anonymous"
+                    # Anonymous users are told apart by metadata or address for upstream scheduling
+                    user = request_user(context, request.user_id)
                     
                     # Initialize session if it doesn't exist
-                    with self.sessions_lock:
-                        if session_id not in self.sessions:
-                            logging.info(f"Creating new session {session_id} for user {user_id}")
-                            self.sessions[session_id] = {
-                                "user_id": user_id,
-                                "created_at": datetime.now().isoformat(),
-                                "last_active": datetime.now().isoformat(),
-                                "messages": [
-                                    {"role": "system", "content": "You are mira, a helpful assistant. Maintain conversation context and provide relevant, coherent responses."}
-                                ]
-                            }
-                        else:
-                            logging.info(f"Resuming existing session {session_id} for user {user_id}")
+                    session, created = self.sessions.get_or_create(session_id, user_id, CHAT_SESSION_PROMPT)
+                    if created:
+                        log.info("Creating new session %s for user %s", session_id, user_id)
+                    else:
+                        log.info("Resuming existing session %s for user %s", session_id, user_id)
                 
                 # Record timestamp for the message
                 timestamp = datetime.now().isoformat()
                 
+                # Per-user turn rate limit: only this message is turned away, the stream stays open
+                if self.admission is not None:
+                    rejection = self.admission.admit_turn(user)
+                    if rejection is not None:
+                        log.warning("Rate limiting user %s in session %s", user_id, session_id)
+                        yield rate_limited_message(request, rejection, timestamp, session_id, user_id)
+                        continue
+                
                 # Log the incoming message
-                logging.info(f"Received chat message in session {session_id}: {request.text}")
+                log.info("Received chat message in session %s: %s", session_id, payload(request.text))
                 
-                # Update session
-                with self.sessions_lock:
-                    # Update last activity time
-                    self.sessions[session_id]["last_active"] = timestamp
-                    
-                    # Add the user message to chat history
-                    self.sessions[session_id]["messages"].append({
-                        "role": "user",
-                        "content": request.text
-                    })
-                    
-                    # Keep only the last 20 messages to prevent context size issues
-                    if len(self.sessions[session_id]["messages"]) > 21:  # 1 system prompt + 20 conversation turns
-                        # Keep the system message and the 19 most recent conversation messages
-                        self.sessions[session_id]["messages"] = [
-                            self.sessions[session_id]["messages"][0]  # System message
-                        ] + self.sessions[session_id]["messages"][-19:]  # Last 19 conversation messages
+                # Add the user message to chat history (older messages drop off automatically)
+                session.append("user", request.text)
                 
                 # Generate a unique message ID for the AI response
                 response_id = str(uuid.uuid4())
@@ -219,23 +666,17 @@ class ChatServicer(chatbot_pb2_grpc.ChatServiceServicer):
                 # Create a response message based on the chat history
                 try:
                     # Get the current session messages for context
-                    with self.sessions_lock:
-                        messages = self.sessions[session_id]["messages"].copy()
-                    
-                    # Call the Groq API with the full chat history
-                    chat_completion = self.client.chat.completions.create(
-                        model="llama-3.1-8b-instant",
-                        messages=messages
-                    )
+                    messages = session.snapshot()
                     
-                    ai_response = chat_completion.choices[0].message.content
+                    # Call the LLM backend with the full chat history
+                    ai_response = self._complete(messages, "ChatSession", deadline, user)
                     
                     # Add the AI response to chat history
-                    with self.sessions_lock:
-                        self.sessions[session_id]["messages"].append({
-                            "role": "assistant",
-                            "content": ai_response
-                        })
+                    session.append("assistant", ai_response)
+                    
+                    # Condense trimmed history off the response path (rolling summary mode only)
+                    if session.evicted:
+                        self.summary_executor.submit(self._condense_history, session)
                     
                     # Send the AI response back to the client
                     yield chatbot_pb2.ChatMessage(
@@ -249,7 +690,7 @@ class ChatServicer(chatbot_pb2_grpc.ChatServiceServicer):
                     )
                     
                 except Exception as e:
-                    logging.error(f"Error generating AI response: {str(e)}")
+                    log.error("Error generating AI response: %s", e)
                     error_message = f"Sorry, I encountered an error: {str(e)}"
                     
                     # Send error message back to the client
@@ -264,40 +705,430 @@ class ChatServicer(chatbot_pb2_grpc.ChatServiceServicer):
                     )
             
             # Session ended normally        
-            logging.info(f"Chat session {session_id} ended normally")
+            log.info("Chat session %s ended normally", session_id)
                     
         except Exception as e:
-            logging.error(f"Error in chat session {session_id}: {str(e)}")
+            if deadline.done():
+                log.info("Chat session %s cancelled by the client", session_id)
+                return
+            log.error("Error in chat session %s: %s", session_id, e)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details(f"Chat session error: {str(e)}")
-        
-        # Clean up very old sessions (could be done in a separate maintenance thread)
-        self._cleanup_old_sessions()
+        finally:
+            if session is not None:
+                self.sessions.release(session)
+
+    def _condense_history(self, session):
+        """Fold messages trimmed from a session into its rolling summary"""
+        claimed = session.begin_summary()
+        if claimed is None:
+            return
+        summary = None
+        try:
+            # Nobody waits for the summary, so it runs as bulk work
+            summary = self._complete(condense_messages(*claimed), "ChatSession", user=session.user_id, priority=BULK)
+        except Exception:
+            logging.exception("Error condensing history of session %s", session.session_id)
+        finally:
+            session.finish_summary(summary)
+
+def condense_messages(previous_summary, messages):
+    """Build the prompt asking the model to fold messages into a rolling summary"""
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    if previous_summary:
+        transcript = f"Summary so far: {previous_summary}\n\nLater messages:\n{transcript}"
+    return [
+        {"role": "system", "content": CONDENSE_PROMPT},
+        {"role": "user", "content": f"{transcript}\n\nSummarize the conversation above in at most "
+                                    f"{ROLLING_SUMMARY_WORDS} words."}
+    ]
+
+def summary_request(model, url, max_length, page=None):
+    """Build the (single-flight key, messages) of a URL summary, from the fetched page when there is one.
     
-    def _cleanup_old_sessions(self):
-        """Clean up sessions that haven't been active for more than 24 hours"""
-        current_time = datetime.now()
-        with self.sessions_lock:
-            sessions_to_remove = []
-            for session_id, session_data in self.sessions.items():
-                last_active = datetime.fromisoformat(session_data["last_active"])
-                # If session is more than 24 hours old
-                if (current_time - last_active).total_seconds() > 86400:  # 24 hours
-                    sessions_to_remove.append(session_id)
-            
-            # Remove old sessions
-            for session_id in sessions_to_remove:
-                logging.info(f"Cleaning up inactive session {session_id}")
-                del self.sessions[session_id]
-
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    chatbot_pb2_grpc.add_ChatServiceServicer_to_server(ChatServicer(), server)
-    server_address = '[::]:50051'
+    Page text is cut to a token budget that grows with max_length. Keys of fetched pages use the
+    content digest, so URLs serving the same content share one summary.
+    """
+    if page is None:
+        prompt = f"Summarize the content of this URL: {url} in about {max_length} words."
+        key = ResponseCache.make_key(model, SUMMARY_PROMPT, prompt)
+    else:
+        text = truncate_to_tokens(page.text, content_token_budget(max_length))
+        title = f"Title: {page.title}\n\n" if page.title else ""
+        prompt = f"Summarize this web page in about {max_length} words.\n\n{title}{text}"
+        key = (model, SUMMARY_PROMPT, page.digest, max_length)
+    return key, [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def build_cache(cache_size=DEFAULT_CACHE_SIZE, cache_ttl=DEFAULT_CACHE_TTL):
+    """Create the response cache, or None when cache_size is 0"""
+    if cache_size <= 0:
+        return None
+    return ResponseCache(max_entries=cache_size, ttl=cache_ttl)
+
+def build_semantic_cache(cache_size=0, threshold=DEFAULT_SEMANTIC_THRESHOLD, cache_ttl=DEFAULT_CACHE_TTL, metrics=None):
+    """Create the semantic response cache, or None when cache_size is 0"""
+    if cache_size <= 0:
+        return None
+    return SemanticCache(max_entries=cache_size, ttl=cache_ttl, threshold=threshold, metrics=metrics)
+
+def build_session_store(session_ttl=DEFAULT_MAX_IDLE, max_sessions=DEFAULT_MAX_SESSIONS, session_db=None,
+                        context_tokens=DEFAULT_TOKEN_BUDGET, rolling_summary=False, shared=False):
+    """Create the session store, persisted to an SQLite file when session_db is set.
+    
+    shared marks the file as used by other server processes too (the workers of a multi-process server).
+    """
+    backend = None
+    if session_db:
+        backend = SQLiteSessionBackend(session_db, keep_messages=MAX_HISTORY_MESSAGES, max_idle=session_ttl)
+        logging.info("Persisting chat sessions to %s", session_db)
+    return SessionStore(max_idle=session_ttl, max_sessions=max_sessions, backend=backend,
+                        token_budget=context_tokens, rolling_summary=rolling_summary, shared=shared)
+
+def build_admission(rate_limit=0, rate_burst=0, user_rate_limit=0, user_rate_burst=0, max_in_flight=(),
+                    metrics=None):
+    """Create the admission controller, or None when no limit is configured"""
+    limits, default_limit = parse_limits(max_in_flight)
+    if not (rate_limit or user_rate_limit or limits or default_limit):
+        return None
+    return AdmissionController(rate_limit, rate_burst, user_rate_limit, user_rate_burst, limits, default_limit,
+                               metrics)
+
+def build_resilience(retries=(), hedge=(), base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                     breaker_failures=DEFAULT_BREAKER_FAILURES, breaker_reset=DEFAULT_BREAKER_RESET, metrics=None):
+    """Create the upstream retry/hedging/circuit breaker layer from per-method settings"""
+    retry_counts, default_retries = parse_limits(retries, "retry count")
+    if default_retries is None:
+        default_retries = DEFAULT_RETRIES
+    methods = set(retry_counts) | set(hedge)
+    policies = {method: RetryPolicy(retry_counts.get(method, default_retries), base_delay, max_delay,
+                                    hedge=method in hedge or "*" in hedge)
+                for method in methods if method != "*"}
+    default_policy = RetryPolicy(default_retries, base_delay, max_delay, hedge="*" in hedge)
+    breaker = CircuitBreaker(breaker_failures, breaker_reset) if breaker_failures > 0 else None
+    return Resilience(policies, default_policy, breaker, metrics)
+
+def build_fetcher(fetch_concurrency=DEFAULT_FETCH_CONCURRENCY, per_host=DEFAULT_PER_HOST, max_bytes=DEFAULT_MAX_BYTES,
+                  timeout=DEFAULT_FETCH_TIMEOUT, cache_size=DEFAULT_FETCH_CACHE_SIZE, cache_ttl=DEFAULT_FETCH_CACHE_TTL,
+                  metrics=None, allow_private=False):
+    """Create the page fetcher for BulkSummarize, with a fetch cache unless cache_size is 0.
+    
+    Pages on loopback, private and link-local addresses are refused unless allow_private is set.
+    """
+    cache = FetchCache(cache_size, cache_ttl) if cache_size > 0 else None
+    return Fetcher(ConnectionPool(per_host, per_host, timeout, allow_private), cache, max_bytes, fetch_concurrency,
+                   metrics)
+
+def build_search(search_index=None, cache_size=DEFAULT_QUERY_CACHE_SIZE, max_postings=DEFAULT_MAX_POSTINGS,
+                 metrics=None):
+    """Open the search index built by search_index.py for enable_web_access, or None without one"""
+    if not search_index:
+        return None
+    return SearchIndex(search_index, cache_size, max_postings, metrics)
+
+def build_batcher(batch_size=0, batch_wait=DEFAULT_BATCH_MAX_WAIT, metrics=None):
+    """Create the micro-batcher for non-streaming completions, or None when batch_size is 0"""
+    if batch_size <= 0:
+        return None
+    return MicroBatcher(batch_wait, batch_size, metrics)
+
+def build_scheduler(upstream_concurrency=0, class_limits=(), user_weights=(), metrics=None):
+    """Create the upstream scheduler from CLASS=N limits and USER=N weights, or None when upstream_concurrency is 0"""
+    if upstream_concurrency <= 0:
+        return None
+    limits, default_limit = parse_limits(class_limits, "class limit")
+    unknown = set(limits) - set(PRIORITY_CLASSES)
+    if unknown:
+        raise ValueError(f"Unknown priority class {', '.join(sorted(unknown))}, "
+                         f"expected one of {', '.join(PRIORITY_CLASSES)}")
+    if default_limit is not None:
+        limits = {priority: limits.get(priority, default_limit) for priority in PRIORITY_CLASSES}
+    weights, default_weight = parse_limits(user_weights, "user weight")
+    return UpstreamScheduler(upstream_concurrency, limits, weights, 1 if default_weight is None else default_weight,
+                             metrics)
+
+def servicer_options(args):
+    """Build ChatServicer keyword arguments from parsed command line arguments"""
+    backend_options = {}
+    if args.backend == "fake":
+        backend_options = {
+            "latency": args.fake_latency,
+            "latency_jitter": args.fake_latency_jitter,
+            "tokens_per_second": args.fake_tokens_per_second,
+            "error_rate": args.fake_error_rate,
+            "concurrency": args.fake_concurrency,
+        }
+    metrics = ServerMetrics() if args.metrics_port else None
+    return {
+        "backend": build_backend(args.backend, **backend_options),
+        "model": args.model,
+        "bulk_concurrency": args.bulk_concurrency,
+        "cache": build_cache(args.cache_size, args.cache_ttl),
+        "sessions": build_session_store(args.session_ttl, args.max_sessions, args.session_db,
+                                        args.context_tokens, args.rolling_summary,
+                                        shared=args.worker_index is not None),
+        "metrics": metrics,
+        "admission": build_admission(args.rate_limit, args.rate_burst, args.user_rate_limit, args.user_rate_burst,
+                                     args.max_in_flight, metrics),
+        "resilience": build_resilience(args.retries, args.hedge, args.retry_base_delay, args.retry_max_delay,
+                                       args.breaker_failures, args.breaker_reset, metrics),
+        "fetcher": None if args.no_fetch else build_fetcher(args.fetch_concurrency, args.fetch_per_host,
+                                                            args.fetch_max_bytes, args.fetch_timeout,
+                                                            args.fetch_cache_size, args.fetch_cache_ttl, metrics,
+                                                            args.fetch_allow_private),
+        "search": build_search(args.search_index, args.search_cache_size, args.search_max_postings, metrics),
+        "search_results": args.search_results,
+        "batcher": build_batcher(args.batch_size, args.batch_wait, metrics),
+        "scheduler": build_scheduler(args.upstream_concurrency, args.class_limit, args.user_weight, metrics),
+        "semantic_cache": build_semantic_cache(args.semantic_cache_size, args.semantic_threshold,
+                                               args.semantic_cache_ttl, metrics),
+    }
+
+def logging_options(args):
+    """Build configure_logging keyword arguments from parsed command line arguments"""
+    sample_rates, default_sample_rate = parse_sample_rates(args.log_sample)
+    return {
+        "level": args.log_level.upper(),
+        "json_format": args.log_format == "json",
+        "payload_mode": args.log_payloads,
+        "payload_chars": args.log_payload_chars,
+        "sample_rates": sample_rates,
+        "default_sample_rate": default_sample_rate,
+    }
+
+def serve(servicer=None, port=DEFAULT_PORT, metrics_port=0, grace=DEFAULT_SHUTDOWN_GRACE, worker=False, ready_fd=None,
+          options=None, compression=None, max_concurrent_rpcs=None, metrics_host=DEFAULT_METRICS_HOST):
+    """Run the threaded server until SIGTERM, then give in-flight RPCs grace seconds to finish.
+    
+    Workers of a multi-process server share the port through SO_REUSEPORT and tell their supervisor
+    through ready_fd once they are serving. options are grpc server options (default: grpc_config's),
+    and compression is the default compression of responses. grpc rejects calls beyond
+    max_concurrent_rpcs in flight with RESOURCE_EXHAUSTED before they are queued for a worker thread.
+    Metrics are served on metrics_host:metrics_port (loopback only by default).
+    """
+    servicer = servicer or ChatServicer()
+    executor = futures.ThreadPoolExecutor(max_workers=10)
+    interceptors = []
+    if servicer.metrics is not None:
+        servicer.metrics.watch_executor("grpc", executor)
+        interceptors.append(MetricsInterceptor(servicer.metrics))
+        if metrics_port:
+            start_http_server(servicer.metrics, metrics_port, metrics_host, reuse_port=worker)
+    if servicer.admission is not None:
+        # After the metrics interceptor, so rejected calls are counted with their status
+        interceptors.append(AdmissionInterceptor(servicer.admission))
+    if options is None:
+        options = server_options(reuse_port=worker)
+    server = grpc.server(executor, interceptors=interceptors, options=options, compression=compression,
+                         maximum_concurrent_rpcs=max_concurrent_rpcs)
+    chatbot_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    server_address = f'[::]:{port}'
     server.add_insecure_port(server_address)
     server.start()
-    logging.info(f"Server started, listening on {server_address}")
+    logging.info("Server started, listening on %s", server_address)
+    
+    def stop(signum, frame):
+        logging.info("Stopping, giving in-flight calls %ss to finish", grace)
+        server.stop(grace)
+    signal.signal(signal.SIGTERM, stop)
+    if ready_fd is not None:
+        notify_ready(ready_fd)
     server.wait_for_termination()
+    servicer.sessions.close()
+
+def grpc_server_options(args):
+    """grpc server options (keepalive, stream and message limits) from parsed command line arguments"""
+    return server_options(args.keepalive_time, args.keepalive_timeout, args.max_concurrent_streams,
+                          int(args.max_message_mb * 1024 * 1024), reuse_port=args.worker_index is not None)
+
+def worker_metrics_port(args):
+    """Each worker of a multi-process server serves its metrics on its own port, counting up from --metrics-port"""
+    if not args.metrics_port or args.worker_index is None:
+        return args.metrics_port
+    return args.metrics_port + args.worker_index
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mira gRPC chat server")
+    parser.add_argument("--aio", action="store_true",
+                        help="Run the asyncio (grpc.aio) server instead of the thread pool server")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Run this many server processes sharing the port through SO_REUSEPORT, under a "
+                             "supervisor that replaces them one at a time on SIGHUP (default: one process, no supervisor)")
+    parser.add_argument("--shutdown-grace", type=float, default=DEFAULT_SHUTDOWN_GRACE,
+                        help="Seconds in-flight calls get to finish after SIGTERM")
+    # Set by the supervisor for each worker process
+    parser.add_argument("--worker-index", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--ready-fd", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Collect metrics and serve them in the Prometheus text format at http://localhost:PORT/metrics "
+                             "(default: off); with --workers, worker N serves its own at PORT+N")
+    parser.add_argument("--metrics-host", default=DEFAULT_METRICS_HOST,
+                        help="Interface the metrics endpoint listens on (default: loopback only; 0.0.0.0 lets other "
+                             "hosts scrape it)")
+    parser.add_argument("--keepalive-time", type=float, default=DEFAULT_SERVER_KEEPALIVE_TIME,
+                        help="Seconds a client connection can be idle before the server pings it (0: grpc's default, 2 hours)")
+    parser.add_argument("--keepalive-timeout", type=float, default=DEFAULT_KEEPALIVE_TIMEOUT,
+                        help="Seconds to wait for a keepalive ping's answer before closing the connection")
+    parser.add_argument("--max-concurrent-streams", type=int, default=0,
+                        help="Calls in flight per client connection; clients queue further calls (default: unlimited)")
+    parser.add_argument("--max-message-mb", type=float, default=DEFAULT_MAX_MESSAGE_BYTES / (1024 * 1024),
+                        help="Largest request or response message in MiB")
+    parser.add_argument("--compression", choices=list(COMPRESSION), default="none",
+                        help="Compression of all responses, for clients that accept it. Clients can ask for gzip or "
+                             "deflate per call for BulkSummarize and BulkSummarizeStream")
+    parser.add_argument("--backend", choices=["groq", "fake"], default="groq",
+                        help="LLM backend: the Groq API, or a local stand-in for offline load testing")
+    parser.add_argument("--model", default=DEFAULT_MODEL,
+                        help="Model name passed to the backend")
+    parser.add_argument("--fake-latency", type=float, default=0.2,
+                        help="Fake backend: median seconds to first token")
+    parser.add_argument("--fake-latency-jitter", type=float, default=0.25,
+                        help="Fake backend: spread (log-normal sigma) of the time to first token")
+    parser.add_argument("--fake-tokens-per-second", type=float, default=200.0,
+                        help="Fake backend: token generation rate")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0,
+                        help="Fake backend: fraction of calls that fail")
+    parser.add_argument("--fake-concurrency", type=int, default=0,
+                        help="Fake backend: calls (or batches) it runs at a time, queueing the rest, like a local "
+                             "model server (default: 0, unlimited)")
+    parser.add_argument("--upstream-concurrency", type=int, default=0,
+                        help="Upstream LLM calls in flight at once; further calls queue by priority class "
+                             "(interactive chat and streams, then GetReply, then bulk summaries) and fairly "
+                             "across users (default: 0, no scheduling)")
+    parser.add_argument("--class-limit", action="append", default=[], metavar="CLASS=N",
+                        help="Most upstream slots, at least 1, a priority class (interactive, unary, bulk) may hold "
+                             f"(repeatable; default: bulk gets {DEFAULT_BULK_SHARE * 100:.0f}%% of --upstream-concurrency)")
+    parser.add_argument("--user-weight", action="append", default=[], metavar="USER=N",
+                        help="Share of upstream slots of a user relative to others, e.g. batch-bot=1 with *=4 for "
+                             "everyone else (repeatable; default 1). Users are ChatSession user_ids, the "
+                             f"{USER_ID_KEY} request metadata, or else the client address")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="Send up to this many concurrent non-streaming completions (GetReply, URL summaries, "
+                             "chat turns) as one batched backend call (default: 0, each completion is its own call). "
+                             "Not available with the Groq backend, which has no batch endpoint")
+    parser.add_argument("--batch-wait", type=float, default=DEFAULT_BATCH_MAX_WAIT,
+                        help="Seconds a completion waits for others to join its batch before the batch is sent")
+    parser.add_argument("--bulk-concurrency", type=int, default=DEFAULT_BULK_CONCURRENCY,
+                        help="Maximum number of URLs summarized concurrently by BulkSummarize")
+    parser.add_argument("--no-fetch", action="store_true",
+                        help="Summarize URLs from the URL string alone instead of fetching the pages")
+    parser.add_argument("--fetch-allow-private", action="store_true",
+                        help="Also fetch pages on loopback, private and link-local addresses (refused by default, "
+                             "so clients cannot reach the server's own network)")
+    parser.add_argument("--fetch-concurrency", type=int, default=DEFAULT_FETCH_CONCURRENCY,
+                        help="Maximum number of pages fetched concurrently across all bulk calls")
+    parser.add_argument("--fetch-per-host", type=int, default=DEFAULT_PER_HOST,
+                        help="Maximum concurrent requests (and idle keep-alive connections) per host")
+    parser.add_argument("--fetch-max-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help="Bytes of each page read; the rest is not downloaded")
+    parser.add_argument("--fetch-timeout", type=float, default=DEFAULT_FETCH_TIMEOUT,
+                        help="Seconds to wait for a page server to connect or send more data")
+    parser.add_argument("--fetch-cache-size", type=int, default=DEFAULT_FETCH_CACHE_SIZE,
+                        help="Maximum number of fetched pages cached (0 disables the fetch cache)")
+    parser.add_argument("--fetch-cache-ttl", type=float, default=DEFAULT_FETCH_CACHE_TTL,
+                        help="Seconds a fetched page is used before it is revalidated (at most; pages can ask for less)")
+    parser.add_argument("--search-index", default=None,
+                        help="Directory of a search index built with search_index.py, used for requests with "
+                             "enable_web_access (default: the flag is ignored)")
+    parser.add_argument("--search-results", type=int, default=DEFAULT_SEARCH_RESULTS,
+                        help="Search results returned and added to the prompt per request")
+    parser.add_argument("--search-cache-size", type=int, default=DEFAULT_QUERY_CACHE_SIZE,
+                        help="Maximum number of cached search queries (0 disables the query cache)")
+    parser.add_argument("--search-max-postings", type=int, default=DEFAULT_MAX_POSTINGS,
+                        help="Highest-scoring postings read per query term (0 reads all; slower on common words)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="Maximum number of cached GetReply/StreamResponse answers (0 disables the cache)")
+    parser.add_argument("--cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+                        help="Seconds a cached answer stays valid")
+    parser.add_argument("--semantic-cache-size", type=int, default=0,
+                        help="Maximum number of answers in the semantic cache, which also serves them to similar "
+                             "GetReply/StreamResponse prompts (default 0: off)")
+    parser.add_argument("--semantic-threshold", type=float, default=DEFAULT_SEMANTIC_THRESHOLD,
+                        help="Cosine similarity a cached prompt needs for its answer to be reused. In "
+                             "benchmarks.semantic_cache the default answers 99.6%% of paraphrases and about 1 in "
+                             "5,000 other questions wrongly; 0.92 answers all paraphrases but 1 in 500 wrongly")
+    parser.add_argument("--semantic-cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+                        help="Seconds an answer stays in the semantic cache")
+    parser.add_argument("--session-ttl", type=float, default=DEFAULT_MAX_IDLE,
+                        help="Seconds of inactivity after which a chat session is evicted")
+    parser.add_argument("--max-sessions", type=int, default=DEFAULT_MAX_SESSIONS,
+                        help="Maximum number of chat sessions kept in memory; least recently used ones are evicted beyond it")
+    parser.add_argument("--session-db", default=None,
+                        help="SQLite file to persist chat sessions in, so they survive restarts (default: memory only)")
+    parser.add_argument("--context-tokens", type=int, default=DEFAULT_TOKEN_BUDGET,
+                        help="Estimated token budget for the chat history sent with each ChatSession turn")
+    parser.add_argument("--rolling-summary", action="store_true",
+                        help="Condense chat history that no longer fits the token budget into a summary instead of dropping it")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="Admit at most this many RPCs per second across all methods (default: unlimited)")
+    parser.add_argument("--rate-burst", type=float, default=0,
+                        help="Burst size for --rate-limit (default: one second's worth)")
+    parser.add_argument("--user-rate-limit", type=float, default=0,
+                        help="Admit at most this many ChatSession messages per second from each user_id (default: unlimited)")
+    parser.add_argument("--user-rate-burst", type=float, default=0,
+                        help="Burst size for --user-rate-limit (default: one second's worth)")
+    parser.add_argument("--max-in-flight", action="append", default=[], metavar="METHOD=N",
+                        help="Reject calls to an RPC method beyond N in flight, e.g. GetReply=8 "
+                             "(repeatable; *=N sets the default). The threaded server applies these limits once a "
+                             "worker thread runs the call; --max-concurrent-rpcs rejects calls before they queue")
+    parser.add_argument("--max-concurrent-rpcs", type=int, default=None,
+                        help="Reject calls beyond this many in flight with RESOURCE_EXHAUSTED before they wait for "
+                             "a worker thread (default: unlimited). Open ChatSession streams count as calls")
+    parser.add_argument("--retries", action="append", default=[], metavar="METHOD=N",
+                        help=f"Retry failed upstream calls of an RPC method up to N times with jittered exponential "
+                             f"backoff (repeatable; *=N sets the default, {DEFAULT_RETRIES}). Only timeouts, connection "
+                             f"errors, rate limiting and upstream 5xx are retried")
+    parser.add_argument("--retry-base-delay", type=float, default=DEFAULT_BASE_DELAY,
+                        help="Backoff before the first retry is random up to this many seconds, doubling per retry")
+    parser.add_argument("--retry-max-delay", type=float, default=DEFAULT_MAX_DELAY,
+                        help="Upper bound on the backoff between retries")
+    parser.add_argument("--hedge", action="append", default=[], metavar="METHOD",
+                        help="Send a second upstream request for an RPC method's completions when the first has not "
+                             "answered within the p95 latency of recent calls (repeatable; * for all methods)")
+    parser.add_argument("--breaker-failures", type=int, default=DEFAULT_BREAKER_FAILURES,
+                        help="Consecutive upstream failures that open the circuit breaker (0 disables it)")
+    parser.add_argument("--breaker-reset", type=float, default=DEFAULT_BREAKER_RESET,
+                        help="Seconds the circuit stays open before a trial call is let through")
+    parser.add_argument("--log-level", default="info", choices=["debug", "info", "warning", "error"])
+    parser.add_argument("--log-format", choices=["text", "json"], default="text",
+                        help="Log line format; json writes one object per line with extra fields such as the RPC")
+    parser.add_argument("--log-payloads", choices=PAYLOAD_MODES, default=DEFAULT_PAYLOAD_MODE,
+                        help="How user messages and model output are logged: in full, truncated, or as length and hash")
+    parser.add_argument("--log-payload-chars", type=int, default=DEFAULT_PAYLOAD_CHARS,
+                        help="Characters of each message kept with --log-payloads truncate")
+    parser.add_argument("--log-sample", action="append", default=[], metavar="METHOD=RATE",
+                        help="Log INFO lines for only this fraction of calls to an RPC method, e.g. GetReply=0.01 "
+                             "(repeatable; *=RATE sets the default). Errors are always logged")
+    args = parser.parse_args()
+    if args.batch_size and args.backend == "groq":
+        # LLMBackend.batch() would send the batched prompts one after another, holding every caller until the last
+        parser.error("--batch-size needs a backend with a batch endpoint; the Groq backend has none")
+    return args
 
 if __name__ == '__main__':
-    serve()
\ No newline at end of file
+    args = parse_args()
+    configure_logging(**logging_options(args))
+    worker = args.worker_index is not None
+    if args.workers and not worker:
+        # Each worker runs this script again with the same arguments
+        if args.workers > 1 and not args.session_db:
+            logging.warning("Chat sessions are kept per worker process; use --session-db so any worker can resume them")
+        Supervisor([sys.executable, os.path.abspath(__file__), *sys.argv[1:]], args.workers, args.shutdown_grace).run()
+    else:
+        if worker:
+            # Ctrl-C reaches the whole process group; the supervisor stops workers gracefully with SIGTERM
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if args.aio:
+            import aio_server
+            asyncio.run(aio_server.serve(aio_server.AsyncChatServicer(**servicer_options(args)), args.port,
+                                         worker_metrics_port(args), args.shutdown_grace, worker, args.ready_fd,
+                                         grpc_server_options(args), COMPRESSION[args.compression],
+                                         args.max_concurrent_rpcs, args.metrics_host))
+        else:
+            serve(ChatServicer(**servicer_options(args)), args.port, worker_metrics_port(args), args.shutdown_grace,
+                  worker, args.ready_fd, grpc_server_options(args), COMPRESSION[args.compression],
+                  args.max_concurrent_rpcs, args.metrics_host)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+# Writer thread commits at most this many queued writes per transaction
+DEFAULT_BATCH_SIZE = 512
+
+# Seconds the writer waits for more writes before committing a partial batch
+DEFAULT_FLUSH_INTERVAL = 0.05
+
+# Seconds between compaction passes
+DEFAULT_COMPACT_INTERVAL = 300
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    last_active REAL NOT NULL,
+    summary TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_session ON messages (session_id, id);
+"""
+
+
+class SQLiteSessionBackend:
+    """Persists ChatSession history to an SQLite database.
+
+    Writes are queued and committed by a single writer thread in batches
+    (group commit), so appending a message never waits on disk. Reads go
+    through a per-thread connection; the database runs in WAL mode so they
+    do not block the writer.
+
+    Compaction periodically drops messages beyond the newest keep_messages
+    of each session and deletes sessions idle for longer than max_idle.
+    Loading a session counts as activity, as does appending to it.
+
+    If a batch fails to commit, its writes are retried one transaction each,
+    so a single bad write does not take the rest of the batch with it; the
+    writes that still fail are logged and counted in failed_writes.
+    """
+
+    def __init__(self, path, keep_messages, max_idle, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, compact_interval=DEFAULT_COMPACT_INTERVAL):
+        self.path = path
+        self.keep_messages = keep_messages
+        self.max_idle = max_idle
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self._local = threading.local()
+        self._writes = queue.Queue()
+        self.failed_writes = 0
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        # Databases written before summaries were persisted lack the column
+        if "summary" not in [row[1] for row in conn.execute("PRAGMA table_info(sessions)")]:
+            conn.execute("ALTER TABLE sessions ADD COLUMN summary TEXT")
+        conn.commit()
+
+        self._writer = threading.Thread(target=self._write_loop, name="session-writer", daemon=True)
+        self._writer.start()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # Writes (queued, applied by the writer thread)
+
+    def create(self, session_id, user_id, created_at):
+        self._writes.put(("create", session_id, user_id, created_at, time.time()))
+
+    def append(self, session_id, role, content):
+        self._writes.put(("append", session_id, role, content, time.time()))
+
+    def save_summary(self, session_id, summary):
+        self._writes.put(("summary", session_id, summary))
+
+    def touch(self, session_id):
+        self._writes.put(("touch", session_id, time.time()))
+
+    def delete(self, session_id):
+        self._writes.put(("delete", session_id))
+
+    def flush(self):
+        """Block until every queued write has been committed"""
+        self._writes.join()
+
+    def close(self):
+        self.flush()
+        self._writes.put(None)
+        self._writer.join()
+
+    # Reads (on the calling thread)
+
+    def load(self, session_id, limit):
+        """Return (user_id, created_at, summary or None, newest limit messages oldest first), or None if unknown.
+
+        The session is marked active, so compaction does not delete sessions
+        that are only being read.
+        """
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT user_id, created_at, summary FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        self.touch(session_id)
+        rows = conn.execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+            (session_id, limit)).fetchall()
+        messages = [{"role": role, "content": content} for role, content in reversed(rows)]
+        return row[0], row[1], row[2], messages
+
+    # Writer thread
+
+    def _write_loop(self):
+        conn = self._connection()
+        next_compaction = time.monotonic() + self.compact_interval
+        while True:
+            try:
+                first = self._writes.get(timeout=self.compact_interval)
+            except queue.Empty:
+                first = ()
+            if first is None:
+                self._writes.task_done()
+                return
+
+            batch = [first] if first else []
+            deadline = time.monotonic() + self.flush_interval
+            while batch and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._writes.get(timeout=remaining) if remaining > 0 else self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Shutdown marker: commit what we have, then put it back for the outer loop
+                    self._writes.task_done()
+                    self._writes.put(None)
+                    break
+                batch.append(item)
+
+            if batch:
+                try:
+                    self._commit(conn, batch)
+                finally:
+                    for _ in batch:
+                        self._writes.task_done()
+
+            if time.monotonic() >= next_compaction:
+                try:
+                    self.compact()
+                except Exception:
+                    logging.exception("Error compacting session database")
+                next_compaction = time.monotonic() + self.compact_interval
+
+    def _commit(self, conn, batch):
+        """Commit batch in one transaction, falling back to one transaction per write if that fails"""
+        try:
+            self._apply(conn, batch)
+            return
+        except Exception:
+            logging.exception("Error writing %d session updates, retrying them one at a time", len(batch))
+        for item in batch:
+            try:
+                self._apply(conn, (item,))
+            except Exception:
+                self.failed_writes += 1
+                logging.exception("Dropping %s write for session %s", item[0], item[1])
+
+    def _apply(self, conn, batch):
+        with conn:
+            for item in batch:
+                op = item[0]
+                if op == "create":
+                    _, session_id, user_id, created_at, now = item
+                    conn.execute(
+                        "INSERT OR IGNORE INTO sessions (session_id, user_id, created_at, last_active) "
+                        "VALUES (?, ?, ?, ?)", (session_id, user_id, created_at, now))
+                elif op == "append":
+                    _, session_id, role, content, now = item
+                    conn.execute("INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+                                 (session_id, role, content))
+                    conn.execute("UPDATE sessions SET last_active = ? WHERE session_id = ?", (now, session_id))
+                elif op == "touch":
+                    _, session_id, now = item
+                    conn.execute("UPDATE sessions SET last_active = ? WHERE session_id = ?", (now, session_id))
+                elif op == "summary":
+                    _, session_id, summary = item
+                    conn.execute("UPDATE sessions SET summary = ? WHERE session_id = ?", (summary, session_id))
+                elif op == "delete":
+                    _, session_id = item
+                    conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                    conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def compact(self):
+        """Drop history older than keep_messages per session and sessions idle past max_idle"""
+        conn = self._connection()
+        with conn:
+            cutoff = time.time() - self.max_idle
+            conn.execute(
+                "DELETE FROM messages WHERE session_id IN "
+                "(SELECT session_id FROM sessions WHERE last_active < ?)", (cutoff,))
+            conn.execute("DELETE FROM sessions WHERE last_active < ?", (cutoff,))
+            conn.execute(
+                "DELETE FROM messages WHERE id IN (SELECT id FROM ("
+                "SELECT id, ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY id DESC) AS newer "
+                "FROM messages) WHERE newer > ?)", (self.keep_messages,))
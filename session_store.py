@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+# Hard cap on conversation messages kept per session, excluding the system prompt
+MAX_HISTORY_MESSAGES = 200
+
+# Estimated prompt tokens (system prompt, summary and history) sent per chat turn
+DEFAULT_TOKEN_BUDGET = 4000
+
+# Number of independently locked shards in a SessionStore
+DEFAULT_SHARDS = 16
+
+# Sessions idle for longer than this many seconds are evicted
+DEFAULT_MAX_IDLE = 86400  # 24 hours
+
+# Upper bound on stored sessions; least recently used sessions are evicted beyond it
+DEFAULT_MAX_SESSIONS = 100000
+
+# Seconds between background eviction passes
+DEFAULT_EVICTION_INTERVAL = 60
+
+
+def estimate_tokens(text):
+    """Cheap token estimate for a chat message (about 4 characters per token plus framing)"""
+    return len(text) // 4 + 4
+
+
+class Session:
+    """Conversation history for one ChatSession.
+
+    Each session has its own lock, so concurrent chats never wait on each
+    other. History is trimmed from the oldest end to fit token_budget (and
+    at most max_history messages). Token counts are computed once per
+    message and kept as a running total, so appending and trimming never
+    re-tokenize the history.
+
+    With rolling_summary, trimmed messages are collected instead of dropped;
+    the servicer condenses them into summary, which is sent as a second
+    system message ahead of the remaining history. The backend keeps the
+    summary, so a reloaded session starts from it.
+    """
+
+    __slots__ = ("session_id", "user_id", "created_at", "last_active",
+                 "system_message", "history", "lock", "shard", "backend",
+                 "max_history", "token_budget", "count_tokens", "token_counts",
+                 "fixed_tokens", "history_tokens", "rolling_summary",
+                 "summary", "summary_message", "evicted", "summarizing", "streams")
+
+    def __init__(self, session_id, user_id, system_prompt, shard=None, backend=None,
+                 created_at=None, messages=(), max_history=MAX_HISTORY_MESSAGES,
+                 token_budget=DEFAULT_TOKEN_BUDGET, count_tokens=estimate_tokens, rolling_summary=False,
+                 summary=None):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.created_at = created_at or datetime.now().isoformat()
+        self.last_active = time.monotonic()
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.lock = threading.Lock()
+        # Owning store shard, told about activity so it can keep its expiry order
+        self.shard = shard
+        # Optional persistent backend that receives every appended message
+        self.backend = backend
+
+        self.max_history = max_history
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.rolling_summary = rolling_summary
+        # Tokens of the system prompt and summary, which are never trimmed
+        self.fixed_tokens = count_tokens(system_prompt)
+        self.summary = None
+        self.summary_message = None
+        if summary is not None:
+            self._set_summary(summary)
+        self.evicted = []
+        self.summarizing = False
+        # ChatSession streams of this process that have the session open
+        self.streams = 0
+
+        self.history = deque()
+        self.token_counts = deque()  # token count of each history message
+        self.history_tokens = 0
+        for message in messages:
+            self._push(message)
+        self._trim()
+
+    def _push(self, message):
+        tokens = self.count_tokens(message["content"])
+        self.history.append(message)
+        self.token_counts.append(tokens)
+        self.history_tokens += tokens
+
+    def _trim(self):
+        """Drop the oldest messages until the prompt fits; the newest message is always kept"""
+        while len(self.history) > 1 and (
+                len(self.history) > self.max_history
+                or self.fixed_tokens + self.history_tokens > self.token_budget):
+            message = self.history.popleft()
+            self.history_tokens -= self.token_counts.popleft()
+            if self.rolling_summary:
+                self.evicted.append(message)
+
+    def append(self, role, content):
+        """Add a message to the history and mark the session active"""
+        message = {"role": role, "content": content}
+        with self.lock:
+            self._push(message)
+            self._trim()
+            self.last_active = time.monotonic()
+        if self.shard is not None:
+            self.shard.touch(self)
+        if self.backend is not None:
+            self.backend.append(self.session_id, role, content)
+
+    def snapshot(self):
+        """Return the prompt messages (system prompt first) for the next completion.
+
+        Message dicts are never mutated after they are appended, so the
+        snapshot is a shallow list of shared references.
+        """
+        with self.lock:
+            if self.summary_message is None:
+                return [self.system_message, *self.history]
+            return [self.system_message, self.summary_message, *self.history]
+
+    def prompt_tokens(self):
+        """Estimated token size of the next snapshot"""
+        with self.lock:
+            return self.fixed_tokens + self.history_tokens
+
+    def begin_summary(self):
+        """Claim trimmed messages for condensing.
+
+        Returns (previous summary or None, messages) or None if there is
+        nothing to condense or a summary is already being written.
+        """
+        with self.lock:
+            if self.summarizing or not self.evicted:
+                return None
+            self.summarizing = True
+            evicted, self.evicted = self.evicted, []
+            return self.summary, evicted
+
+    def finish_summary(self, summary):
+        """Install a new summary (None keeps the previous one) and release the claim"""
+        with self.lock:
+            self.summarizing = False
+            if summary is None:
+                return
+            self._set_summary(summary)
+            self._trim()
+        if self.backend is not None:
+            self.backend.save_summary(self.session_id, summary)
+
+    def _set_summary(self, summary):
+        old_tokens = self.count_tokens(self.summary_message["content"]) if self.summary_message else 0
+        self.summary = summary
+        self.summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+        self.fixed_tokens += self.count_tokens(self.summary_message["content"]) - old_tokens
+
+    def __len__(self):
+        return len(self.history)
+
+
+class _Shard:
+    """One lock-protected slice of a SessionStore.
+
+    Sessions are kept in an OrderedDict in least-recently-active order. With
+    a single idle TTL for every session this doubles as the expiry index:
+    expired sessions are always at the front, and marking a session active
+    is an O(1) move to the back.
+    """
+
+    __slots__ = ("sessions", "lock")
+
+    def __init__(self):
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def touch(self, session):
+        with self.lock:
+            # Ignore sessions that were evicted while a stream still held them
+            if self.sessions.get(session.session_id) is session:
+                self.sessions.move_to_end(session.session_id)
+
+    def pop_expired(self, cutoff):
+        """Remove sessions last active before cutoff, returning their ids.
+
+        A session a stream still holds is not idle, however long ago its last
+        message was: it is marked active now and kept.
+        """
+        expired = []
+        held = []
+        with self.lock:
+            while self.sessions:
+                session_id, session = next(iter(self.sessions.items()))
+                if session.last_active >= cutoff:
+                    break
+                del self.sessions[session_id]
+                if session.streams:
+                    held.append(session)
+                else:
+                    expired.append(session_id)
+            now = time.monotonic()
+            for session in held:
+                session.last_active = now
+                self.sessions[session.session_id] = session
+        return expired
+
+    def evict_over(self, capacity):
+        """Drop the least recently active sessions no stream holds until at most capacity remain,
+        returning their ids. Call with the lock held"""
+        excess = len(self.sessions) - capacity
+        if excess <= 0:
+            return []
+        unheld = (session_id for session_id, session in self.sessions.items() if not session.streams)
+        evicted = list(itertools.islice(unheld, excess))
+        for session_id in evicted:
+            del self.sessions[session_id]
+        return evicted
+
+
+class SessionStore:
+    """Sharded in-memory store of Session objects keyed by session_id.
+
+    Lookups only take the lock of the shard owning the session id, and
+    message updates only take the session's own lock plus an O(1) recency
+    update in its shard. Idle sessions are evicted by a background thread
+    (start_eviction) that only visits expired entries. Capacity is enforced
+    per shard: each shard keeps at most ceil(max_sessions / shards) sessions
+    by evicting its own least recently active ones, so a full shard evicts
+    even while others have room, and the store as a whole can hold slightly
+    more than max_sessions. Neither evicts a session while a stream has it
+    open.
+
+    With a persistent backend (see session_backend.py) the in-memory shards
+    act as a bounded cache of hot sessions: unknown session ids are loaded
+    from the backend on first use, sessions evicted for capacity stay on
+    disk, and sessions that expire are deleted from the backend as well.
+
+    With shared=True the backend is also written by other server processes,
+    so a session in memory is only trusted while a stream here has it open.
+    When the last stream releases it, its writes are flushed and it is
+    dropped from memory, so the next stream to open it in any process loads
+    the latest history. Expiry then only frees memory; the backend's
+    compaction deletes sessions once they are idle in every process.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS, max_history=MAX_HISTORY_MESSAGES,
+                 max_idle=DEFAULT_MAX_IDLE, max_sessions=DEFAULT_MAX_SESSIONS, backend=None,
+                 token_budget=DEFAULT_TOKEN_BUDGET, count_tokens=estimate_tokens, rolling_summary=False,
+                 shared=False):
+        self.max_history = max_history
+        self.backend = backend
+        self.shared = shared and backend is not None
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.rolling_summary = rolling_summary
+        self.max_idle = max_idle
+        self.max_sessions = max_sessions
+        self._shards = [_Shard() for _ in range(shards)]
+        # Capacity of each shard, rounded up so the store as a whole can hold at least max_sessions
+        self._max_per_shard = max(1, -(-max_sessions // shards))
+        self._stop_eviction = threading.Event()
+        self._eviction_thread = None
+
+    def _shard(self, session_id):
+        return self._shards[hash(session_id) % len(self._shards)]
+
+    def get(self, session_id):
+        shard = self._shard(session_id)
+        with shard.lock:
+            return shard.sessions.get(session_id)
+
+    def get_or_create(self, session_id, user_id, system_prompt):
+        """Return (session, created) for session_id, creating the session if needed.
+
+        Each call opens the session for one stream; call release() when the
+        stream ends. With a backend, this may read from disk and should not
+        be called from an event loop thread.
+        """
+        shard = self._shard(session_id)
+        with shard.lock:
+            session = self._resume(shard, session_id)
+            if session is not None:
+                return session, False
+
+        # Not in memory: try the backend outside the shard lock
+        stored = self.backend.load(session_id, self.max_history) if self.backend is not None else None
+
+        with shard.lock:
+            # Another stream may have loaded or created it meanwhile
+            session = self._resume(shard, session_id)
+            if session is not None:
+                return session, False
+            if stored is not None:
+                stored_user_id, created_at, summary, messages = stored
+                session = self._new_session(session_id, stored_user_id, system_prompt, shard, created_at, messages,
+                                            summary)
+                created = False
+            else:
+                session = self._new_session(session_id, user_id, system_prompt, shard)
+                if self.backend is not None:
+                    self.backend.create(session_id, user_id, session.created_at)
+                created = True
+            session.streams += 1
+            shard.sessions[session_id] = session
+            # Capacity eviction only drops sessions from memory; a backend keeps them. Sessions
+            # open in a stream are skipped, so a shard of only open sessions can go over capacity
+            for evicted_id in shard.evict_over(self._max_per_shard):
+                logging.info("Evicting least recently used session %s", evicted_id)
+            return session, created
+
+    def _new_session(self, session_id, user_id, system_prompt, shard, created_at=None, messages=(), summary=None):
+        return Session(session_id, user_id, system_prompt, shard, self.backend, created_at, messages,
+                       max_history=self.max_history, token_budget=self.token_budget,
+                       count_tokens=self.count_tokens, rolling_summary=self.rolling_summary, summary=summary)
+
+    def _resume(self, shard, session_id):
+        """Return the in-memory session opened for one more stream and mark it active; call with shard.lock held"""
+        session = shard.sessions.get(session_id)
+        if session is not None and self.shared and not session.streams:
+            # Another process may have added to it since; reload it from the backend
+            del shard.sessions[session_id]
+            return None
+        if session is not None:
+            # Resuming counts as activity
+            session.last_active = time.monotonic()
+            session.streams += 1
+            shard.sessions.move_to_end(session_id)
+        return session
+
+    def release(self, session):
+        """Close one stream's use of a session returned by get_or_create.
+
+        With a shared backend, the last release flushes queued writes, so a
+        stream opening the session in another process sees them, and drops
+        the session from memory. This may block and should not be called
+        from an event loop thread.
+        """
+        shard = self._shard(session.session_id)
+        with shard.lock:
+            session.streams -= 1
+            if not self.shared or session.streams:
+                return
+            if shard.sessions.get(session.session_id) is session:
+                del shard.sessions[session.session_id]
+        self.backend.flush()
+
+    def remove(self, session_id):
+        shard = self._shard(session_id)
+        with shard.lock:
+            session = shard.sessions.pop(session_id, None)
+        if self.backend is not None:
+            self.backend.delete(session_id)
+        return session
+
+    def remove_idle(self, max_idle=None):
+        """Remove sessions idle for more than max_idle seconds, returning their ids.
+
+        Only expired sessions are visited, so the cost is proportional to the
+        number of evictions rather than the number of stored sessions.
+        """
+        max_idle = self.max_idle if max_idle is None else max_idle
+        cutoff = time.monotonic() - max_idle
+        removed = []
+        for shard in self._shards:
+            removed.extend(shard.pop_expired(cutoff))
+        if self.backend is not None and not self.shared:
+            for session_id in removed:
+                self.backend.delete(session_id)
+        return removed
+
+    def start_eviction(self, interval=DEFAULT_EVICTION_INTERVAL):
+        """Start a daemon thread that evicts idle sessions every interval seconds"""
+        if self._eviction_thread is not None:
+            return
+        self._stop_eviction.clear()
+        self._eviction_thread = threading.Thread(
+            target=self._eviction_loop, args=(interval,), name="session-eviction", daemon=True)
+        self._eviction_thread.start()
+
+    def stop_eviction(self):
+        if self._eviction_thread is None:
+            return
+        self._stop_eviction.set()
+        self._eviction_thread.join()
+        self._eviction_thread = None
+
+    def close(self):
+        """Stop eviction and commit queued backend writes"""
+        self.stop_eviction()
+        if self.backend is not None:
+            self.backend.close()
+
+    def _eviction_loop(self, interval):
+        while not self._stop_eviction.wait(interval):
+            for session_id in self.remove_idle():
+                logging.info("Cleaning up inactive session %s", session_id)
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def __len__(self):
+        return sum(len(shard.sessions) for shard in self._shards)
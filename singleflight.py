@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+from concurrent import futures
+
+
+class SharedCallAbandoned(Exception):
+    """Raised to callers that shared a call which failed for a reason of the caller that started it"""
+
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one execution.
+
+    The first caller for a key runs the function; callers arriving while it is
+    still running wait for and share its result (or exception). Once the call
+    finishes the key is forgotten, so later calls run again. Exceptions of
+    the types in leader_errors only concern the caller that ran the call
+    (say, its own cancellation); the others get SharedCallAbandoned instead
+    and can start a call of their own.
+    """
+
+    def __init__(self, leader_errors=()):
+        self.leader_errors = tuple(leader_errors)
+        self._lock = threading.Lock()
+        self._in_flight = {}  # key -> Future of the running call
+        self.calls = 0        # executions of the wrapped function
+        self.coalesced = 0    # callers that shared an in-flight execution
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = futures.Future()
+                self._in_flight[key] = future
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            try:
+                return future.result()
+            except self.leader_errors as e:
+                raise SharedCallAbandoned(f"Shared call abandoned: {e}") from e
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._in_flight)}
+
+
+class AsyncSingleFlight:
+    """asyncio counterpart of SingleFlight.
+
+    The shared call runs in its own task, so a caller that is cancelled does
+    not cancel the work other callers are waiting on. Once every caller has
+    been cancelled, nobody needs the result and the shared task is cancelled
+    as well. leader_errors are handled as in SingleFlight: only the caller
+    that started the task gets them.
+    """
+
+    def __init__(self, leader_errors=()):
+        self.leader_errors = tuple(leader_errors)
+        self._in_flight = {}  # key -> Task of the running call
+        self._waiters = {}    # key -> callers awaiting that task
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self._in_flight.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._in_flight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except self.leader_errors as e:
+            if leader:
+                raise
+            raise SharedCallAbandoned(f"Shared call abandoned: {e}") from e
+        except asyncio.CancelledError:
+            if not task.done():
+                self._waiters[key] -= 1
+                if not self._waiters[key]:
+                    task.cancel()
+            raise
+
+    def _forget(self, key, task):
+        del self._in_flight[key]
+        del self._waiters[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved; waiters re-raise it themselves
+            task.exception()
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._in_flight)}
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# How user messages and model output appear in logs: in full, cut to
+# PAYLOAD_CHARS characters, or replaced by their length and a short hash
+PAYLOAD_MODES = ("full", "truncate", "redact")
+DEFAULT_PAYLOAD_MODE = "truncate"
+DEFAULT_PAYLOAD_CHARS = 200
+
+# Attributes every LogRecord has; anything else was passed with extra= and
+# becomes a field of its own in JSON output
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_payload_mode = DEFAULT_PAYLOAD_MODE
+_payload_chars = DEFAULT_PAYLOAD_CHARS
+_sample_rates = {}       # RPC method name -> fraction of calls whose INFO lines are logged
+_default_sample_rate = 1.0
+_listener = None
+_rpc_loggers = {}        # RPC method name -> (logger, errors-only wrapper)
+
+
+class _Payload:
+    """A message body to log, rendered by the payload policy only if the line is emitted"""
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        text = self.text
+        if _payload_mode == "full":
+            return text
+        if _payload_mode == "redact":
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+            return f"<{len(text)} chars sha256:{digest}>"
+        if len(text) <= _payload_chars:
+            return text
+        return f"{text[:_payload_chars]}... (+{len(text) - _payload_chars} chars)"
+
+
+def payload(text):
+    """Wrap user or model text for lazy, policy-controlled logging: log.info("Got %s", payload(text))"""
+    return _Payload(text)
+
+
+class _ErrorsOnly:
+    """Logger stand-in for calls that were not sampled: drops debug and info lines, keeps problems"""
+
+    __slots__ = ("logger",)
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    def info(self, *args, **kwargs):
+        pass
+
+    def warning(self, *args, **kwargs):
+        self.logger.warning(*args, **kwargs)
+
+    def error(self, *args, **kwargs):
+        self.logger.error(*args, **kwargs)
+
+    def exception(self, *args, **kwargs):
+        self.logger.exception(*args, **kwargs)
+
+    def isEnabledFor(self, level):
+        return level >= logging.WARNING and self.logger.isEnabledFor(level)
+
+
+def rpc_log(method):
+    """Return the logger for one call of an RPC method.
+
+    Sampling is decided once per call, so a sampled call logs all of its
+    lines and an unsampled one only its warnings and errors.
+    """
+    loggers = _rpc_loggers.get(method)
+    if loggers is None:
+        # getLogger takes the logging module lock, so look each method up once
+        logger = logging.getLogger(f"rpc.{method}")
+        loggers = _rpc_loggers[method] = (logger, _ErrorsOnly(logger))
+    rate = _sample_rates.get(method, _default_sample_rate)
+    if rate >= 1.0 or random.random() < rate:
+        return loggers[0]
+    return loggers[1]
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with time, level, logger, message and any extra= fields"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock handler formats every record before queueing it so it can be
+    pickled; within one process the record can be passed as is, which keeps
+    message formatting and payload rendering off the RPC threads.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def parse_sample_rates(specs):
+    """Parse METHOD=RATE strings ("*" sets the default) into (rates dict, default rate)"""
+    rates = {}
+    default = 1.0
+    for spec in specs or ():
+        method, _, rate = spec.partition("=")
+        try:
+            value = float(rate)
+        except ValueError:
+            raise ValueError(f"Invalid log sample rate {spec!r}, expected METHOD=RATE") from None
+        if method == "*":
+            default = value
+        else:
+            rates[method] = value
+    return rates, default
+
+
+def configure_logging(level=logging.INFO, json_format=False, payload_mode=DEFAULT_PAYLOAD_MODE,
+                      payload_chars=DEFAULT_PAYLOAD_CHARS, sample_rates=None, default_sample_rate=1.0,
+                      use_queue=True, stream=None):
+    """Replace the root logging handlers.
+
+    With use_queue, records go through an in-memory queue to a listener
+    thread that formats and writes them, so RPC threads never wait on the
+    log stream or its lock.
+    """
+    global _payload_mode, _payload_chars, _sample_rates, _default_sample_rate, _listener
+    if payload_mode not in PAYLOAD_MODES:
+        raise ValueError(f"Unknown payload mode: {payload_mode}")
+    _payload_mode = payload_mode
+    _payload_chars = payload_chars
+    _sample_rates = dict(sample_rates or {})
+    _default_sample_rate = default_sample_rate
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else logging.Formatter(logging.BASIC_FORMAT))
+
+    stop_logging()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level)
+    if use_queue:
+        records = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(records, output)
+        _listener.start()
+        root.addHandler(_LocalQueueHandler(records))
+    else:
+        root.addHandler(output)
+
+
+def stop_logging():
+    """Flush and stop the queue listener, if one is running"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
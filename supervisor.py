@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+
+# Seconds in-flight RPCs get to finish when a server is stopped
+DEFAULT_SHUTDOWN_GRACE = 10.0
+
+# Seconds a new worker has to start serving before it counts as failed
+DEFAULT_READY_TIMEOUT = 30.0
+
+# Extra seconds a stopping worker gets beyond its grace period before it is killed
+STOP_MARGIN = 5.0
+
+# Seconds between checks for workers that exited, and before replacing one that keeps failing
+POLL_INTERVAL = 0.5
+RESPAWN_DELAY = 1.0
+
+
+def notify_ready(fd):
+    """Tell the supervisor that started this worker that it is serving"""
+    os.write(fd, b"1")
+    os.close(fd)
+
+
+class Worker:
+    """One server process in a supervisor slot.
+
+    The process is started with the write end of a pipe (--ready-fd) and
+    its slot number (--worker-index); it writes to the pipe once it serves.
+    """
+
+    def __init__(self, slot, command):
+        self.slot = slot
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                [*command, "--worker-index", str(slot), "--ready-fd", str(write_fd)], pass_fds=(write_fd,))
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        self._ready_fd = read_fd
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def wait_ready(self, timeout):
+        """Return True once the worker reports it is serving, False if it exits or times out first"""
+        try:
+            readable, _, _ = select.select([self._ready_fd], [], [], timeout)
+            # A worker that exits closes the pipe, which reads as empty
+            return bool(readable) and os.read(self._ready_fd, 1) == b"1"
+        finally:
+            os.close(self._ready_fd)
+
+    def terminate(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+
+    def wait_stopped(self, grace):
+        """Wait for the worker to exit after terminate(), killing it if it outlives grace"""
+        try:
+            self.process.wait(grace + STOP_MARGIN)
+        except subprocess.TimeoutExpired:
+            logging.warning("Worker %d (pid %d) did not stop in time, killing it", self.slot, self.pid)
+            self.process.kill()
+            self.process.wait()
+
+
+class Supervisor:
+    """Runs several server processes on one port, sharing it through SO_REUSEPORT.
+
+    The kernel spreads new connections across the workers' listening
+    sockets, so each worker's GIL only carries its share of the load. Each
+    connection (a client channel) stays with one worker. Workers that exit
+    are replaced. SIGHUP restarts them one at a time: a replacement is
+    started and waited for before the worker it replaces is stopped, so the
+    port keeps accepting and capacity never drops. SIGTERM or SIGINT stops
+    every worker, giving in-flight RPCs grace seconds to finish.
+    """
+
+    def __init__(self, command, workers, grace=DEFAULT_SHUTDOWN_GRACE, ready_timeout=DEFAULT_READY_TIMEOUT):
+        self.command = list(command)
+        self.worker_count = workers
+        self.grace = grace
+        self.ready_timeout = ready_timeout
+        self.workers = {}  # slot -> Worker
+        self._restart = threading.Event()
+        self._stop = threading.Event()
+
+    def _start(self, slot):
+        worker = Worker(slot, self.command)
+        if not worker.wait_ready(self.ready_timeout):
+            worker.terminate()
+            worker.wait_stopped(0)
+            raise RuntimeError(f"Worker {slot} exited or did not start serving within {self.ready_timeout}s")
+        logging.info("Worker %d serving (pid %d)", slot, worker.pid)
+        return worker
+
+    def run(self):
+        """Start the workers and supervise them until SIGTERM or SIGINT"""
+        signal.signal(signal.SIGHUP, lambda signum, frame: self._restart.set())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stop.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: self._stop.set())
+        try:
+            for slot in range(self.worker_count):
+                self.workers[slot] = self._start(slot)
+            logging.info("Supervisor (pid %d) running %d workers; send SIGHUP for a rolling restart",
+                         os.getpid(), self.worker_count)
+            while not self._stop.wait(POLL_INTERVAL):
+                if self._restart.is_set():
+                    self._restart.clear()
+                    self.rolling_restart()
+                self._replace_exited()
+        finally:
+            self.stop()
+
+    def rolling_restart(self):
+        """Replace every worker in turn, starting each replacement before stopping the old worker"""
+        logging.info("Rolling restart of %d workers", len(self.workers))
+        for slot in sorted(self.workers):
+            if self._stop.is_set():
+                return
+            old = self.workers[slot]
+            try:
+                self.workers[slot] = self._start(slot)
+            except RuntimeError as e:
+                logging.error("%s; keeping the remaining workers and abandoning the restart", e)
+                return
+            old.terminate()
+            old.wait_stopped(self.grace)
+        logging.info("Rolling restart complete")
+
+    def _replace_exited(self):
+        for slot, worker in list(self.workers.items()):
+            status = worker.process.poll()
+            if status is None:
+                continue
+            logging.warning("Worker %d (pid %d) exited with status %s, replacing it", slot, worker.pid, status)
+            try:
+                self.workers[slot] = self._start(slot)
+            except RuntimeError as e:
+                logging.error(str(e))
+                self._stop.wait(RESPAWN_DELAY)
+
+    def stop(self):
+        """Stop every worker, giving each grace seconds to finish in-flight RPCs"""
+        for worker in self.workers.values():
+            worker.terminate()
+        for worker in self.workers.values():
+            worker.wait_stopped(self.grace)
+        self.workers.clear()
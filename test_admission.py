@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+import time
+from concurrent import futures
+
+import grpc
+import pytest
+
+import chatbot_pb2
+import chatbot_pb2_grpc
+from admission import (TokenBucket, KeyedTokenBuckets, AdmissionController, AdmissionInterceptor,
+                       AsyncAdmissionInterceptor, parse_limits, RETRY_AFTER_KEY)
+from backends import FakeBackend
+from chat_client import ChatClient, RateLimited
+from resilience import RetryPolicy
+from scheduler import USER_ID_KEY
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_refills_at_rate_up_to_burst():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    clock.now = 0.5
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    clock.now = 100
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.try_acquire() > 0
+
+
+def test_keyed_buckets_are_independent():
+    clock = FakeClock()
+    buckets = KeyedTokenBuckets(rate=1, burst=1, clock=clock)
+    assert buckets.try_acquire("alice") == 0.0
+    assert buckets.try_acquire("alice") == pytest.approx(1.0)
+    assert buckets.try_acquire("bob") == 0.0
+    assert len(buckets) == 2
+
+
+def test_keyed_buckets_drop_the_least_recently_used():
+    buckets = KeyedTokenBuckets(rate=1, burst=1, max_keys=2, clock=FakeClock())
+    buckets.try_acquire("alice")
+    buckets.try_acquire("bob")
+    buckets.try_acquire("alice")
+    buckets.try_acquire("carol")
+    assert len(buckets) == 2
+    # alice was kept and is still empty; bob was dropped and starts again with a full bucket
+    assert buckets.try_acquire("alice") > 0
+    assert buckets.try_acquire("bob") == 0.0
+
+
+def test_in_flight_limit_per_method():
+    admission = AdmissionController(max_in_flight={"GetReply": 1}, default_max_in_flight=2)
+    assert admission.start_call("GetReply") is None
+    rejection = admission.start_call("GetReply")
+    assert rejection.reason == "in_flight"
+    assert admission.start_call("StreamResponse") is None
+    assert admission.start_call("StreamResponse") is None
+    assert admission.start_call("StreamResponse").reason == "in_flight"
+    admission.finish_call("GetReply")
+    assert admission.start_call("GetReply") is None
+
+
+def test_rate_rejection_does_not_hold_a_slot():
+    admission = AdmissionController(rate=0.001, burst=1, default_max_in_flight=5)
+    assert admission.start_call("GetReply") is None
+    rejection = admission.start_call("GetReply")
+    assert rejection.reason == "rate" and rejection.retry_after > 0
+    assert admission._in_flight_counts() == {("GetReply",): 1}
+    assert dict(rejection.metadata())[RETRY_AFTER_KEY] == str(rejection.retry_after_ms())
+
+
+def test_turns_are_limited_per_user():
+    admission = AdmissionController(user_rate=0.001, user_burst=1)
+    assert admission.admit_turn("alice") is None
+    assert admission.admit_turn("alice").reason == "user_rate"
+    assert admission.admit_turn("bob") is None
+    assert AdmissionController().admit_turn("alice") is None
+
+
+def test_parse_limits():
+    assert parse_limits(["GetReply=8", "*=4"]) == ({"GetReply": 8}, 4)
+    assert parse_limits(None) == ({}, None)
+    with pytest.raises(ValueError):
+        parse_limits(["GetReply"])
+
+
+def echo_handler(started=None, release=None):
+    """Generic handler for /test.Echo/Say (unary) and /test.Echo/Repeat (server streaming) on raw bytes"""
+
+    def say(request, context):
+        if started is not None:
+            started.set()
+            release.wait()
+        return request
+
+    def repeat(request, context):
+        yield request
+        yield request
+
+    return grpc.method_handlers_generic_handler("test.Echo", {
+        "Say": grpc.unary_unary_rpc_method_handler(say),
+        "Repeat": grpc.unary_stream_rpc_method_handler(repeat),
+    })
+
+
+@pytest.fixture
+def echo_server():
+    """Start a threaded echo server behind an AdmissionInterceptor; yields a function returning its channel"""
+    servers = []
+
+    def start(admission, started=None, release=None):
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=[AdmissionInterceptor(admission)])
+        server.add_generic_rpc_handlers((echo_handler(started, release),))
+        port = server.add_insecure_port("127.0.0.1:0")
+        server.start()
+        servers.append(server)
+        return grpc.insecure_channel(f"127.0.0.1:{port}")
+
+    yield start
+    for server in servers:
+        server.stop(None)
+
+
+def test_interceptor_rejects_with_retry_after(echo_server):
+    channel = echo_server(AdmissionController(rate=0.001, burst=1))
+    say = channel.unary_unary("/test.Echo/Say")
+    assert say(b"hi") == b"hi"
+    with pytest.raises(grpc.RpcError) as error:
+        say(b"hi")
+    assert error.value.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+    assert int(dict(error.value.trailing_metadata())[RETRY_AFTER_KEY]) > 0
+
+
+def test_interceptor_releases_slots_of_finished_calls(echo_server):
+    started, release = threading.Event(), threading.Event()
+    admission = AdmissionController(max_in_flight={"Say": 1, "Repeat": 1})
+    channel = echo_server(admission, started, release)
+    say = channel.unary_unary("/test.Echo/Say")
+    repeat = channel.unary_stream("/test.Echo/Repeat")
+    first = say.future(b"first")
+    started.wait()
+    with pytest.raises(grpc.RpcError) as error:
+        say(b"second")
+    assert error.value.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+    assert list(repeat(b"x")) == [b"x", b"x"]
+    assert list(repeat(b"y")) == [b"y", b"y"]
+    release.set()
+    assert first.result() == b"first"
+    assert admission._in_flight_counts() == {("Say",): 0, ("Repeat",): 0}
+
+
+def test_async_interceptor_rejects_with_retry_after():
+    async def main():
+        server = grpc.aio.server(interceptors=[AsyncAdmissionInterceptor(AdmissionController(rate=0.001, burst=1))])
+
+        async def repeat(request, context):
+            yield request
+
+        server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler("test.Echo", {
+            "Repeat": grpc.unary_stream_rpc_method_handler(repeat)}),))
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+            repeat_call = channel.unary_stream("/test.Echo/Repeat")
+            assert [response async for response in repeat_call(b"hi")] == [b"hi"]
+            call = repeat_call(b"hi")
+            with pytest.raises(grpc.RpcError) as error:
+                async for _ in call:
+                    pass
+            assert error.value.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+            assert int(dict(await call.trailing_metadata())[RETRY_AFTER_KEY]) > 0
+        await server.stop(None)
+
+    asyncio.run(main())
+
+
+@pytest.fixture
+def chat_server():
+    """Threaded server whose ChatSession allows one message per user every half second, answered by a fast
+    FakeBackend"""
+    from server import ChatServicer
+    servicer = ChatServicer(backend=FakeBackend(latency=0.001, tokens_per_second=100000),
+                            admission=AdmissionController(user_rate=2, user_burst=1))
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    chatbot_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    yield f"127.0.0.1:{port}"
+    server.stop(None)
+
+
+def chat(target, texts, metadata=None):
+    messages = [chatbot_pb2.ChatMessage(text=text, sender="user", message_id=str(i)) for i, text in enumerate(texts)]
+    with grpc.insecure_channel(target) as channel:
+        return list(chatbot_pb2_grpc.ChatServiceStub(channel).ChatSession(iter(messages), metadata=metadata))
+
+
+def test_rate_limited_turn_is_a_system_message(chat_server):
+    first, second = chat(chat_server, ["hello", "again"], ((USER_ID_KEY, "alice"),))
+    assert first.sender == "ai" and not first.retry_after_ms
+    assert second.sender == "system" and second.reply_to == "1" and second.retry_after_ms > 0
+
+
+def test_anonymous_users_do_not_share_a_rate_limit(chat_server):
+    # Neither sets user_id; they are told apart by their metadata
+    [alice] = chat(chat_server, ["hello"], ((USER_ID_KEY, "alice"),))
+    [bob] = chat(chat_server, ["hello"], ((USER_ID_KEY, "bob"),))
+    assert alice.sender == bob.sender == "ai"
+
+
+def test_chat_client_sends_rate_limited_messages_again(chat_server):
+    async def main():
+        reconnect = RetryPolicy(retries=2, base_delay=0.01, max_delay=0.01)
+        async with ChatClient(chat_server, reconnect=reconnect) as client:
+            conversation = client.conversation(user_id="alice")
+            assert (await conversation.send("hello")).sender == "ai"
+            start = time.monotonic()
+            assert (await conversation.send("again", timeout=30)).sender == "ai"
+            assert time.monotonic() - start > 0.2
+            assert conversation._turned_away == {}
+
+    asyncio.run(main())
+
+
+def test_chat_client_gives_up_on_rate_limited_messages(chat_server):
+    async def main():
+        async with ChatClient(chat_server, reconnect=RetryPolicy(retries=0)) as client:
+            conversation = client.conversation(user_id="alice")
+            await conversation.send("hello")
+            with pytest.raises(RateLimited) as error:
+                await conversation.send("again", timeout=30)
+            assert error.value.retry_after > 0
+
+    asyncio.run(main())
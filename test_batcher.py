@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+import time
+
+import pytest
+
+from backends import BackendError, LLMBackend
+from batcher import MicroBatcher
+from resilience import Deadline
+from scheduler import UpstreamScheduler, INTERACTIVE, UNARY
+
+
+class Recorder:
+    """batch() stand-in answering each prompt with its text, recording the batches it was sent"""
+
+    def __init__(self, error=None, seconds=0.0):
+        self.error = error
+        self.seconds = seconds
+        self.batches = []
+        self.timeouts = []
+
+    def __call__(self, model, message_lists, timeout=None):
+        self.batches.append(len(message_lists))
+        self.timeouts.append(timeout)
+        time.sleep(self.seconds)
+        if self.error is not None:
+            raise self.error
+        return [messages[-1]["content"] for messages in message_lists]
+
+    async def abatch(self, model, message_lists, timeout=None):
+        self.batches.append(len(message_lists))
+        await asyncio.sleep(self.seconds)
+        return [messages[-1]["content"] for messages in message_lists]
+
+
+def prompt(text):
+    return [{"role": "user", "content": text}]
+
+
+def complete_concurrently(batcher, fn, texts, timeout=None):
+    results = {}
+
+    def call(text):
+        try:
+            results[text] = batcher.complete(fn, "model", prompt(text), timeout)
+        except Exception as e:
+            results[text] = e
+
+    threads = [threading.Thread(target=call, args=(text,)) for text in texts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_completions_share_one_batch():
+    batcher = MicroBatcher(max_wait=0.1, max_size=8)
+    upstream = Recorder()
+    texts = ["a", "b", "c"]
+    assert complete_concurrently(batcher, upstream, texts) == {text: text for text in texts}
+    assert upstream.batches == [3]
+    assert batcher.stats() == {"batches": 1, "items": 3, "open": 0}
+
+
+def test_full_batch_is_sent_without_waiting():
+    batcher = MicroBatcher(max_wait=10, max_size=2)
+    upstream = Recorder()
+    start = time.monotonic()
+    assert complete_concurrently(batcher, upstream, ["a", "b"]) == {"a": "a", "b": "b"}
+    assert time.monotonic() - start < 1
+    assert upstream.batches == [2]
+
+
+def test_failed_batch_fails_every_caller():
+    batcher = MicroBatcher(max_wait=0.1)
+    upstream = Recorder(error=BackendError("upstream 503", retryable=True))
+    results = complete_concurrently(batcher, upstream, ["a", "b"])
+    assert all(isinstance(result, BackendError) for result in results.values())
+    assert upstream.batches == [2]
+
+
+def test_caller_out_of_time_gets_a_retryable_error():
+    batcher = MicroBatcher(max_wait=0.05)
+    upstream = Recorder(seconds=0.5)
+    # The first caller opens the batch and makes the slow backend call; the second runs out of time waiting
+    leader = threading.Thread(target=batcher.complete, args=(upstream, "model", prompt("a")))
+    leader.start()
+    time.sleep(0.01)
+    with pytest.raises(BackendError) as error:
+        batcher.complete(upstream, "model", prompt("b"), timeout=0.1)
+    assert error.value.retryable
+    leader.join()
+    assert upstream.batches == [2]
+
+
+def test_batch_gets_the_earliest_deadline():
+    batcher = MicroBatcher(max_wait=0.05)
+    upstream = Recorder()
+    results = {}
+
+    def call(text, timeout):
+        results[text] = batcher.complete(upstream, "model", prompt(text), timeout)
+
+    threads = [threading.Thread(target=call, args=(text, timeout))
+               for text, timeout in (("a", 30), ("b", 1), ("c", None))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {"a": "a", "b": "b", "c": "c"}
+    assert upstream.batches == [3]
+    assert 0 < upstream.timeouts[0] <= 1
+
+
+def test_groups_are_batched_separately():
+    batcher = MicroBatcher(max_wait=0.1)
+    upstream = Recorder()
+    threads = [threading.Thread(target=batcher.complete, args=(upstream, "model", prompt(text)),
+                                kwargs={"group": group})
+               for text, group in (("a", UNARY), ("b", INTERACTIVE), ("c", UNARY))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(upstream.batches) == [1, 2]
+
+
+class BatchBackend(LLMBackend):
+    """Backend answering each prompt with its text, recording the size of every batch() call"""
+
+    def __init__(self):
+        self.upstream = Recorder(seconds=0.05)
+
+    def complete(self, model, messages, timeout=None):
+        return self.batch(model, [messages], timeout)[0]
+
+    def stream(self, model, messages, timeout=None):
+        yield self.complete(model, messages, timeout)
+
+    def batch(self, model, message_lists, timeout=None):
+        return self.upstream(model, message_lists, timeout)
+
+
+def test_batch_holds_one_upstream_slot():
+    from server import ChatServicer
+    backend = BatchBackend()
+    scheduler = UpstreamScheduler(1)
+    chat = ChatServicer(backend=backend, batcher=MicroBatcher(max_wait=0.1), scheduler=scheduler)
+    results = {}
+
+    def call(text, method):
+        results[text] = chat._complete(prompt(text), method, Deadline(5), user=text)
+
+    threads = [threading.Thread(target=call, args=(text, method))
+               for text, method in (("a", "GetReply"), ("b", "GetReply"), ("c", "GetReply"), ("d", "ChatSession"))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {text: text for text in "abcd"}
+    # The three GetReply completions shared one slot; the chat turn was batched on its own
+    assert sorted(backend.upstream.batches) == [1, 3]
+    assert scheduler.in_flight == 0
+
+
+def test_async_completions_share_one_batch():
+    async def main():
+        batcher = MicroBatcher(max_wait=0.05)
+        upstream = Recorder()
+        answers = await asyncio.gather(*(batcher.acomplete(upstream.abatch, "model", prompt(text))
+                                         for text in ("a", "b", "c")))
+        assert answers == ["a", "b", "c"]
+        assert upstream.batches == [3]
+
+    asyncio.run(main())
+
+
+def test_async_batch_cancelled_once_every_caller_left():
+    async def main():
+        batcher = MicroBatcher(max_wait=0.01)
+        upstream = Recorder(seconds=1)
+        call = asyncio.ensure_future(batcher.acomplete(upstream.abatch, "model", prompt("a")))
+        await asyncio.sleep(0.05)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        await asyncio.sleep(0)
+        assert not batcher._tasks
+
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+from cache import ResponseCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = ResponseCache(ttl=10, clock=clock)
+    cache.put("key", "answer")
+    clock.now = 9.9
+    assert cache.get("key") == "answer"
+    clock.now = 10
+    assert cache.get("key") is None
+    assert len(cache) == 0
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 0}
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2, clock=FakeClock())
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
+
+
+def test_put_refreshes_an_existing_entry():
+    clock = FakeClock()
+    cache = ResponseCache(max_entries=2, ttl=10, clock=clock)
+    cache.put("a", "old")
+    cache.put("b", "2")
+    clock.now = 5
+    cache.put("a", "new")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    clock.now = 12
+    assert cache.get("a") == "new"
+
+
+def test_keys_depend_on_model_prompt_and_message():
+    key = ResponseCache.make_key("llama3", "Be brief.", "What is gRPC?")
+    assert ResponseCache.make_key("llama3", "Be brief.", "  what IS\ngRPC? ") == key
+    assert ResponseCache.make_key("mixtral", "Be brief.", "What is gRPC?") != key
+    assert ResponseCache.make_key("llama3", "Be thorough.", "What is gRPC?") != key
+    assert ResponseCache.make_key("llama3", "Be brief.", "What is HTTP/2?") != key
+
+    cache = ResponseCache()
+    cache.put(key, "answer")
+    assert cache.get(ResponseCache.make_key("llama3", "Be brief.", "what is grpc?")) == "answer"
+    assert cache.get(ResponseCache.make_key("mixtral", "Be brief.", "What is gRPC?")) is None
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+from concurrent import futures
+
+import grpc
+
+import chatbot_pb2_grpc
+from backends import LLMBackend
+from chat_client import ChatClient
+from resilience import RetryPolicy
+from session_store import SessionStore
+
+
+class TranscriptBackend(LLMBackend):
+    """Backend answering with every user message of the prompt, after gate is set"""
+
+    def __init__(self, gate=None):
+        self.gate = gate
+
+    def complete(self, model, messages, timeout=None):
+        if self.gate is not None:
+            self.gate.wait(5)
+        return " | ".join(message["content"] for message in messages if message["role"] == "user")
+
+    def stream(self, model, messages, timeout=None):
+        yield self.complete(model, messages, timeout)
+
+
+def start_server(backend, sessions, address="127.0.0.1:0"):
+    from server import ChatServicer
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    chatbot_pb2_grpc.add_ChatServiceServicer_to_server(ChatServicer(backend=backend, sessions=sessions), server)
+    port = server.add_insecure_port(address)
+    server.start()
+    return server, port
+
+
+def test_conversation_reconnects_and_resumes_its_session():
+    # Both servers share one store, standing in for --session-db across a restart
+    sessions = SessionStore()
+    gate = threading.Event()
+    first, port = start_server(TranscriptBackend(gate), sessions)
+    second = None
+
+    async def main():
+        nonlocal second
+        reconnect = RetryPolicy(retries=5, base_delay=0.05, max_delay=0.05)
+        # Let the channel reconnect as quickly as the conversation retries
+        options = [("grpc.initial_reconnect_backoff_ms", 20), ("grpc.min_reconnect_backoff_ms", 20),
+                   ("grpc.max_reconnect_backoff_ms", 50)]
+        async with ChatClient(f"127.0.0.1:{port}", options=options, reconnect=reconnect) as client:
+            conversation = client.conversation(user_id="alice")
+            reply = asyncio.ensure_future(conversation.send("hello", timeout=30))
+            # Wait until the first server has appended the message and is waiting on the backend
+            while sessions.get(conversation.session_id) is None or not len(sessions.get(conversation.session_id)):
+                await asyncio.sleep(0.01)
+            # The server goes away while the reply is outstanding, and comes back on the same port
+            await asyncio.to_thread(first.stop, None)
+            second, _ = start_server(TranscriptBackend(), sessions, f"127.0.0.1:{port}")
+            assert (await reply).sender == "ai"
+            assert conversation.reconnects >= 1
+            again = await conversation.send("again", timeout=30)
+            # The resent message was appended to the same session, so the history carries it
+            assert again.text.startswith("hello") and again.text.endswith("again")
+
+    try:
+        asyncio.run(main())
+    finally:
+        gate.set()
+        first.stop(None)
+        if second is not None:
+            second.stop(None)
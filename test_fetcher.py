@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import pytest
+
+from benchmarks.page_server import start_page_server, render_page
+from fetcher import Fetcher, FetchCache, ConnectionPool, FetchError, TextExtractor, MAX_REDIRECTS
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def pages():
+    server, base_url = start_page_server()
+    yield server, base_url
+    server.shutdown()
+    server.server_close()
+
+
+def extract(path):
+    extractor = TextExtractor()
+    extractor.feed(render_page(path).decode("utf-8"))
+    extractor.close()
+    return extractor.text()
+
+
+def fetcher(**options):
+    return Fetcher(ConnectionPool(allow_private=True), **options)
+
+
+def test_fetches_the_visible_text(pages):
+    server, base_url = pages
+    page = fetcher().fetch(f"{base_url}/articles/one")
+    assert page.title == "Page /articles/one"
+    assert page.text == extract("/articles/one")
+    assert "Notes on /articles/one" in page.text and "tracking" not in page.text
+    assert not page.truncated
+
+
+def test_stale_pages_are_revalidated(pages):
+    server, base_url = pages
+    clock = FakeClock()
+    fetch = fetcher(cache=FetchCache(ttl=10, clock=clock)).fetch
+    url = f"{base_url}/articles/one"
+    first = fetch(url)
+    assert fetch(url) is not first
+    assert server.counts["requests"] == 1
+    clock.now = 10
+    again = fetch(url)
+    assert again.text == first.text and again.digest == first.digest
+    assert server.counts["requests"] == 2
+    assert server.counts["not_modified"] == 1
+    # A 304 makes the cached copy fresh again
+    fetch(url)
+    assert server.counts["requests"] == 2
+
+
+def test_body_is_cut_off_at_max_bytes(pages):
+    server, base_url = pages
+    page = fetcher(max_bytes=1000).fetch(f"{base_url}/articles/one")
+    assert page.truncated
+    full = extract("/articles/one")
+    assert 0 < len(page.text) < len(full)
+    assert full.startswith(page.text)
+
+
+def test_gzip_bodies_are_decoded(pages):
+    server, base_url = pages
+    page = fetcher().fetch(f"{base_url}/gzip/articles/one")
+    assert page.title == "Page /gzip/articles/one"
+    assert page.text == extract("/gzip/articles/one")
+    assert not page.truncated
+    # max_bytes bounds the decompressed size
+    assert fetcher(max_bytes=1000).fetch(f"{base_url}/gzip/articles/one").truncated
+
+
+def test_redirects_are_followed_up_to_the_limit(pages):
+    server, base_url = pages
+    page = fetcher().fetch(base_url + "/redirect" * MAX_REDIRECTS + "/articles/one")
+    assert page.title == "Page /articles/one"
+    with pytest.raises(FetchError, match="Too many redirects"):
+        fetcher().fetch(base_url + "/redirect" * (MAX_REDIRECTS + 1) + "/articles/one")
+
+
+def test_error_status_is_a_fetch_error(pages):
+    server, base_url = pages
+    with pytest.raises(FetchError, match="HTTP 404"):
+        fetcher().fetch(f"{base_url}/missing/page")
+
+
+def test_private_addresses_are_refused_unless_allowed(pages):
+    server, base_url = pages
+    with pytest.raises(FetchError, match="not a public address"):
+        Fetcher().fetch(f"{base_url}/articles/one")
+    with pytest.raises(FetchError, match="not a public address"):
+        Fetcher().fetch(base_url.replace("127.0.0.1", "localhost") + "/articles/one")
+    assert server.counts["requests"] == 0
+    assert fetcher().fetch(f"{base_url}/articles/one").text
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+import urllib.error
+import urllib.request
+from concurrent import futures
+
+import grpc
+import pytest
+
+from backends import BackendError, LLMBackend
+from metrics import (MetricsRegistry, ServerMetrics, MetricsInterceptor, AsyncMetricsInterceptor, InstrumentedBackend,
+                     start_http_server)
+
+
+class EchoBackend(LLMBackend):
+    """Backend answering with the last message, or failing with error"""
+
+    def __init__(self, error=None):
+        self.error = error
+
+    def complete(self, model, messages, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return messages[-1]["content"]
+
+    def stream(self, model, messages, timeout=None):
+        for word in messages[-1]["content"].split(" "):
+            yield word + " "
+        if self.error is not None:
+            raise self.error
+
+    async def acomplete(self, model, messages, timeout=None):
+        return self.complete(model, messages, timeout)
+
+    async def astream(self, model, messages, timeout=None):
+        for piece in self.stream(model, messages, timeout):
+            yield piece
+
+
+def prompt(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency", ("method",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, "GetReply")
+    assert histogram.value("GetReply") == (4, 6.05)
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{method="GetReply",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{method="GetReply",le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{method="GetReply",le="+Inf"} 4' in lines
+    assert 'latency_seconds_count{method="GetReply"} 4' in lines
+    assert "# TYPE latency_seconds histogram" in lines
+
+
+def test_labels_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter("calls_total", "Calls", ("user",)).inc('a "quoted"\nname')
+    assert 'calls_total{user="a \\"quoted\\"\\nname"} 1' in registry.render()
+
+
+def test_failing_callback_is_left_out():
+    registry = MetricsRegistry()
+    registry.callback_gauge("broken", "Raises", lambda: 1 / 0)
+    registry.callback_gauge("queue_depth", "Depth by pool", lambda: {("fetch",): 3}, ("pool",))
+    rendered = registry.render()
+    assert 'queue_depth{pool="fetch"} 3' in rendered
+    assert "# TYPE broken gauge" in rendered and "\nbroken " not in rendered
+
+
+def test_names_are_registered_once():
+    registry = MetricsRegistry()
+    registry.counter("calls_total", "Calls")
+    with pytest.raises(ValueError):
+        registry.gauge("calls_total", "Calls")
+
+
+def test_instrumented_backend_records_calls():
+    metrics = ServerMetrics()
+    backend = InstrumentedBackend(EchoBackend(), metrics)
+    assert backend.complete("model", prompt("four score and seven")) == "four score and seven"
+    assert "".join(backend.stream("model", prompt("a b c"))) == "a b c "
+    assert backend.batch("model", [prompt("x"), prompt("y")]) == ["x", "y"]
+    assert metrics.llm_latency.value("complete")[0] == 1
+    assert metrics.llm_latency.value("stream")[0] == 1
+    assert metrics.llm_latency.value("batch")[0] == 1
+    assert metrics.llm_first_token.value()[0] == 1
+    assert metrics.llm_prompt_tokens.value() > 0 and metrics.llm_completion_tokens.value() > 0
+
+
+def test_instrumented_backend_counts_errors():
+    metrics = ServerMetrics()
+    backend = InstrumentedBackend(EchoBackend(BackendError("upstream 503", retryable=True)), metrics)
+    with pytest.raises(BackendError):
+        backend.complete("model", prompt("hi"))
+    with pytest.raises(BackendError):
+        list(backend.stream("model", prompt("hi")))
+    assert metrics.llm_errors.value("complete") == 1
+    assert metrics.llm_errors.value("stream") == 1
+    # A stream that failed after its first token still timed that token, but not the call
+    assert metrics.llm_first_token.value()[0] == 1
+    assert metrics.llm_latency.value("stream")[0] == 0
+
+
+def test_instrumented_backend_async_calls():
+    async def main():
+        metrics = ServerMetrics()
+        backend = InstrumentedBackend(EchoBackend(), metrics)
+        assert await backend.acomplete("model", prompt("hi")) == "hi"
+        assert [piece async for piece in backend.astream("model", prompt("a b"))] == ["a ", "b "]
+        assert await backend.abatch("model", [prompt("x")]) == ["x"]
+        assert [metrics.llm_latency.value(operation)[0] for operation in ("complete", "stream", "batch")] == [1, 1, 1]
+
+    asyncio.run(main())
+
+
+def echo_handlers(started, release):
+    """Generic handlers for /test.Echo: Say echoes (after release is set), Fail aborts, Repeat streams twice"""
+
+    def say(request, context):
+        started.set()
+        release.wait()
+        return request
+
+    def fail(request, context):
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT, "no")
+
+    def repeat(request, context):
+        yield request
+        yield request
+
+    return grpc.method_handlers_generic_handler("test.Echo", {
+        "Say": grpc.unary_unary_rpc_method_handler(say),
+        "Fail": grpc.unary_unary_rpc_method_handler(fail),
+        "Repeat": grpc.unary_stream_rpc_method_handler(repeat),
+    })
+
+
+def test_interceptor_records_rpcs():
+    metrics = ServerMetrics()
+    started, release = threading.Event(), threading.Event()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=[MetricsInterceptor(metrics)])
+    server.add_generic_rpc_handlers((echo_handlers(started, release),))
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    try:
+        with grpc.insecure_channel(f"127.0.0.1:{port}") as channel:
+            say = channel.unary_unary("/test.Echo/Say").future(b"hi")
+            started.wait()
+            assert metrics.rpc_in_flight.value("Say") == 1
+            release.set()
+            assert say.result() == b"hi"
+            with pytest.raises(grpc.RpcError):
+                channel.unary_unary("/test.Echo/Fail")(b"hi")
+            assert list(channel.unary_stream("/test.Echo/Repeat")(b"hi")) == [b"hi", b"hi"]
+    finally:
+        server.stop(None)
+    assert metrics.rpc_handled.value("Say", "OK") == 1
+    assert metrics.rpc_handled.value("Fail", "INVALID_ARGUMENT") == 1
+    assert metrics.rpc_handled.value("Repeat", "OK") == 1
+    assert metrics.rpc_latency.value("Say")[0] == 1
+    assert [metrics.rpc_in_flight.value(method) for method in ("Say", "Fail", "Repeat")] == [0, 0, 0]
+
+
+def test_async_interceptor_records_rpcs():
+    async def main():
+        metrics = ServerMetrics()
+        server = grpc.aio.server(interceptors=[AsyncMetricsInterceptor(metrics)])
+
+        async def say(request, context):
+            return request
+
+        async def fail(request, context):
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "no")
+
+        async def repeat(request, context):
+            yield request
+            yield request
+
+        server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler("test.Echo", {
+            "Say": grpc.unary_unary_rpc_method_handler(say),
+            "Fail": grpc.unary_unary_rpc_method_handler(fail),
+            "Repeat": grpc.unary_stream_rpc_method_handler(repeat),
+        }),))
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+            assert await channel.unary_unary("/test.Echo/Say")(b"hi") == b"hi"
+            with pytest.raises(grpc.RpcError):
+                await channel.unary_unary("/test.Echo/Fail")(b"hi")
+            assert [response async for response in channel.unary_stream("/test.Echo/Repeat")(b"hi")] == [b"hi"] * 2
+        await server.stop(None)
+        assert metrics.rpc_handled.value("Say", "OK") == 1
+        assert metrics.rpc_handled.value("Fail", "INVALID_ARGUMENT") == 1
+        assert metrics.rpc_handled.value("Repeat", "OK") == 1
+        assert metrics.rpc_in_flight.value("Repeat") == 0
+
+    asyncio.run(main())
+
+
+def test_http_endpoint_listens_on_loopback():
+    metrics = ServerMetrics()
+    metrics.rpc_handled.inc("GetReply", "OK")
+    http_server = start_http_server(metrics, 0)
+    try:
+        host, port = http_server.server_address[:2]
+        assert host == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert 'grpc_server_handled_total{method="GetReply",code="OK"} 1' in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other", timeout=5)
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
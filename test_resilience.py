@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+import time
+
+import pytest
+
+from backends import BackendError
+from resilience import (Resilience, RetryPolicy, CircuitBreaker, CircuitOpenError, CallCancelled, Deadline,
+                        DeadlineExceeded, RetryBudgetExhausted, is_retryable)
+
+
+class FixedBackoff(RetryPolicy):
+    """RetryPolicy waiting delay seconds before every retry"""
+
+    def __init__(self, retries, delay=0.0, **options):
+        super().__init__(retries, **options)
+        self.delay = delay
+
+    def backoff(self, attempt):
+        return self.delay
+
+
+class Flaky:
+    """Upstream call failing with error for its first failures calls, then answering "ok" """
+
+    def __init__(self, failures, error=None, seconds=0.0):
+        self.failures = failures
+        self.error = error or BackendError("upstream 503", retryable=True)
+        self.seconds = seconds
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, timeout=None):
+        with self._lock:
+            self.calls += 1
+            failing = self.calls <= self.failures
+        time.sleep(self.seconds)
+        if failing:
+            raise self.error
+        return "ok"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_retries_retryable_errors():
+    resilience = Resilience(default_policy=FixedBackoff(2))
+    upstream = Flaky(2)
+    assert resilience.call("GetReply", upstream) == "ok"
+    assert upstream.calls == 3
+
+
+def test_gives_up_after_retries():
+    resilience = Resilience(default_policy=FixedBackoff(2))
+    upstream = Flaky(5)
+    with pytest.raises(BackendError):
+        resilience.call("GetReply", upstream)
+    assert upstream.calls == 3
+
+
+def test_does_not_retry_permanent_errors():
+    resilience = Resilience(default_policy=FixedBackoff(2))
+    upstream = Flaky(1, BackendError("bad request"))
+    with pytest.raises(BackendError):
+        resilience.call("GetReply", upstream)
+    assert upstream.calls == 1
+
+
+def test_retry_budget_exhausted_when_backoff_outlasts_deadline():
+    resilience = Resilience(default_policy=FixedBackoff(5, delay=1.0))
+    upstream = Flaky(5)
+    with pytest.raises(RetryBudgetExhausted):
+        resilience.call("GetReply", upstream, deadline=Deadline(0.5))
+    assert upstream.calls == 1
+    assert not is_retryable(RetryBudgetExhausted("no time left", retryable=True))
+
+
+def test_no_attempt_once_the_rpc_is_gone():
+    resilience = Resilience()
+    upstream = Flaky(0)
+    cancelled = Deadline(10)
+    cancelled.cancel()
+    with pytest.raises(CallCancelled):
+        resilience.call("GetReply", upstream, deadline=cancelled)
+    with pytest.raises(DeadlineExceeded):
+        resilience.call("GetReply", upstream, deadline=Deadline(0))
+    assert upstream.calls == 0
+
+
+def test_deadline_cancel_runs_callbacks_once():
+    deadline = Deadline()
+    calls = []
+    deadline.on_cancel(lambda: calls.append("before"))
+    deadline.cancel()
+    deadline.cancel()
+    deadline.on_cancel(lambda: calls.append("after"))
+    assert calls == ["before", "after"]
+    assert deadline.done() and isinstance(deadline.error(), CallCancelled)
+    assert Deadline().remaining() is None
+
+
+def test_circuit_breaker_opens_and_lets_one_trial_through():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now = 10
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+
+
+def test_open_circuit_fails_fast_without_calling_upstream():
+    breaker = CircuitBreaker(failure_threshold=1)
+    resilience = Resilience(default_policy=FixedBackoff(3), breaker=breaker)
+    upstream = Flaky(10)
+    with pytest.raises(CircuitOpenError):
+        resilience.call("GetReply", upstream)
+    assert upstream.calls == 1
+
+
+def hedging(workers):
+    """Resilience hedging every call, with recent latencies that put the hedge delay at its minimum"""
+    resilience = Resilience(default_policy=FixedBackoff(0, hedge=True, hedge_min_delay=0.02), hedge_workers=workers)
+    for _ in range(10):
+        resilience._tracker("GetReply").record(0.001)
+    return resilience
+
+
+def test_hedges_a_slow_attempt():
+    resilience = hedging(2)
+    upstream = Flaky(0, seconds=0.2)
+    assert resilience.call("GetReply", upstream) == "ok"
+    assert upstream.calls == 2
+
+
+def test_no_hedge_without_an_idle_worker():
+    resilience = hedging(1)
+    upstream = Flaky(0, seconds=0.2)
+    assert resilience.call("GetReply", upstream) == "ok"
+    assert upstream.calls == 1
+
+
+def test_busy_hedge_workers_do_not_queue_attempts():
+    resilience = hedging(2)
+    upstream = Flaky(0, seconds=0.2)
+    threads = [threading.Thread(target=resilience.call, args=("GetReply", upstream)) for _ in range(8)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Attempts beyond the two workers run on their callers' threads at once, unhedged
+    assert time.monotonic() - start < 0.4
+    assert upstream.calls == 8
+
+
+def broken_stream(*args, timeout=None):
+    yield "first"
+    raise BackendError("upstream reset", retryable=True)
+
+
+def test_streams_failing_after_the_first_piece_count_against_the_circuit():
+    breaker = CircuitBreaker(failure_threshold=2)
+    resilience = Resilience(default_policy=FixedBackoff(3), breaker=breaker)
+    for _ in range(2):
+        pieces = resilience.stream("StreamResponse", broken_stream)
+        assert next(pieces) == "first"
+        with pytest.raises(BackendError):
+            next(pieces)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_async_streams_failing_after_the_first_piece_count_against_the_circuit():
+    async def abroken_stream(*args, timeout=None):
+        for piece in broken_stream():
+            yield piece
+
+    async def main():
+        breaker = CircuitBreaker(failure_threshold=2)
+        resilience = Resilience(default_policy=FixedBackoff(3), breaker=breaker)
+        for _ in range(2):
+            with pytest.raises(BackendError):
+                assert [piece async for piece in resilience.astream("StreamResponse", abroken_stream)] == ["first"]
+        assert breaker.state == CircuitBreaker.OPEN
+
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import asyncio
+
+import pytest
+
+from resilience import CallCancelled, Deadline, DeadlineExceeded
+from scheduler import UpstreamScheduler, INTERACTIVE, UNARY, BULK, DEFAULT_BULK_SHARE
+
+
+def limits(scheduler):
+    return {priority: queue.limit for priority, queue in scheduler.classes.items()}
+
+
+def test_class_limits():
+    assert limits(UpstreamScheduler(8)) == {INTERACTIVE: 8, UNARY: 8, BULK: int(8 * DEFAULT_BULK_SHARE)}
+    assert limits(UpstreamScheduler(8, {BULK: 2, UNARY: 20})) == {INTERACTIVE: 8, UNARY: 8, BULK: 2}
+
+
+@pytest.mark.parametrize("class_limits", [{BULK: 0}, {INTERACTIVE: -1}])
+def test_class_limits_below_one_are_rejected(class_limits):
+    with pytest.raises(ValueError):
+        UpstreamScheduler(8, class_limits)
+
+
+def test_weights_must_be_positive():
+    with pytest.raises(ValueError):
+        UpstreamScheduler(8, weights={"batch-bot": 0})
+    with pytest.raises(ValueError):
+        UpstreamScheduler(8, default_weight=0)
+
+
+async def granted_in_order(scheduler, callers):
+    """Queue (priority, user) callers behind a held slot, release it, and return the order they were granted in"""
+    await scheduler.aacquire(UNARY, "holder")
+    order = []
+
+    async def call(priority, user):
+        await scheduler.aacquire(priority, user)
+        order.append((priority, user))
+        await asyncio.sleep(0)
+        scheduler.release(priority)
+
+    tasks = []
+    for priority, user in callers:
+        tasks.append(asyncio.ensure_future(call(priority, user)))
+        # Let the caller queue before the next one
+        await asyncio.sleep(0)
+    scheduler.release(UNARY)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_urgent_classes_go_first():
+    scheduler = UpstreamScheduler(1)
+    callers = [(BULK, "a"), (UNARY, "a"), (INTERACTIVE, "a")]
+    order = asyncio.run(granted_in_order(scheduler, callers))
+    assert order == [(INTERACTIVE, "a"), (UNARY, "a"), (BULK, "a")]
+
+
+def test_users_take_turns_within_a_class():
+    scheduler = UpstreamScheduler(1)
+    callers = [(BULK, "heavy")] * 3 + [(BULK, "light")]
+    order = asyncio.run(granted_in_order(scheduler, callers))
+    assert [user for _, user in order] == ["heavy", "light", "heavy", "heavy"]
+
+
+def test_weighted_users_get_more_turns():
+    scheduler = UpstreamScheduler(1, weights={"heavy": 2})
+    callers = [(BULK, "heavy")] * 4 + [(BULK, "light")] * 2
+    order = asyncio.run(granted_in_order(scheduler, callers))
+    assert [user for _, user in order] == ["heavy", "heavy", "light", "heavy", "heavy", "light"]
+
+
+def test_queued_call_leaves_on_deadline():
+    scheduler = UpstreamScheduler(1)
+    scheduler.acquire(UNARY, "holder")
+    with pytest.raises(DeadlineExceeded):
+        scheduler.acquire(UNARY, "late", Deadline(0.05))
+    assert scheduler.classes[UNARY].queued == 0
+    scheduler.release(UNARY)
+    scheduler.acquire(UNARY, "next", Deadline(0.05))
+    assert scheduler.in_flight == 1
+
+
+def test_cancelled_async_call_leaves_the_queue():
+    async def main():
+        scheduler = UpstreamScheduler(1)
+        await scheduler.aacquire(UNARY, "holder")
+        waiting = asyncio.ensure_future(scheduler.aacquire(UNARY, "gone"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert scheduler.classes[UNARY].queued == 0
+        scheduler.release(UNARY)
+        assert scheduler.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_scheduled_passes_the_remaining_deadline():
+    scheduler = UpstreamScheduler(1)
+    deadline = Deadline(10)
+    call = scheduler.scheduled(lambda timeout=None: timeout, INTERACTIVE, "a", deadline)
+    assert 9 < call(timeout=None) <= 10
+    assert scheduler.in_flight == 0
+    deadline.cancel()
+    scheduler.acquire(UNARY, "holder")
+    with pytest.raises(CallCancelled):
+        call(timeout=None)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import math
+
+import pytest
+
+from search_index import SearchIndex, build_index, tokenize, BM25_K1, BM25_B
+
+DOCUMENTS = [
+    ("Deadlines", "https://example.com/deadlines", "Every gRPC call should carry a deadline so servers can give up."),
+    ("Streaming", "https://example.com/streaming", "Streaming replies send tokens as the model produces them."),
+    ("Deadline propagation", "https://example.com/propagation",
+     "Propagate the deadline to upstream calls: the deadline of the call bounds every deadline below it."),
+    ("Caching", "https://example.com/caching", "A response cache keyed on the prompt skips repeated model calls."),
+    ("Long notes", "https://example.com/notes",
+     "Notes on many topics. " * 20 + "One mention of a deadline near the end."),
+]
+
+
+def bm25(query, documents=DOCUMENTS, k1=BM25_K1, b=BM25_B):
+    """Reference BM25 scores by document index, computed directly"""
+    terms = [tokenize(f"{title}\n{text}") for title, _, text in documents]
+    average_length = sum(map(len, terms)) / len(terms)
+    scores = {}
+    for term in set(tokenize(query)):
+        df = sum(term in doc for doc in terms)
+        idf = math.log(1 + (len(terms) - df + 0.5) / (df + 0.5))
+        for i, doc in enumerate(terms):
+            tf = doc.count(term)
+            if tf:
+                norm = k1 * (1 - b + b * len(doc) / average_length)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    path = str(tmp_path / "index")
+    assert build_index(DOCUMENTS, path) == len(DOCUMENTS)
+    return path
+
+
+def test_results_are_ranked_by_bm25(index_dir):
+    index = SearchIndex(index_dir)
+    results = index.search("deadline")
+    expected = bm25("deadline")[:3]
+    assert [result.url for result in results] == [DOCUMENTS[i][1] for i, _ in expected]
+    assert [result.title for result in results][0] == "Deadline propagation"
+    for result, (_, score) in zip(results, expected):
+        assert result.score == pytest.approx(score, rel=1e-5)
+    index.close()
+
+
+def test_scores_add_up_across_terms(index_dir):
+    index = SearchIndex(index_dir)
+    results = index.search("streaming model tokens", k=5)
+    expected = bm25("streaming model tokens")
+    assert [result.url for result in results] == [DOCUMENTS[i][1] for i, _ in expected]
+    assert [result.score for result in results] == pytest.approx([score for _, score in expected], rel=1e-5)
+    index.close()
+
+
+def test_cut_postings_are_rescored(tmp_path):
+    documents = [(f"Doc {i}", f"https://example.com/{i}", "deadline " * (1 + i % 5) + "cache " * (i % 3))
+                 for i in range(50)]
+    path = str(tmp_path / "index")
+    # Small blocks also exercise merging several runs
+    build_index(documents, path, block_postings=10)
+    exact = SearchIndex(path, cache_size=0, max_postings=0)
+    cut = SearchIndex(path, cache_size=0, max_postings=5)
+    assert ([result.url for result in cut.search("deadline cache", k=5)]
+            == [result.url for result in exact.search("deadline cache", k=5)])
+    exact.close()
+    cut.close()
+
+
+def test_unknown_terms_find_nothing(index_dir):
+    index = SearchIndex(index_dir)
+    assert index.search("kubernetes") == ()
+    assert index.search("the of and") == ()
+    assert [result.url for result in index.search("kubernetes caching")] == ["https://example.com/caching"]
+    index.close()
+
+
+def test_snippet_shows_the_query_terms(index_dir):
+    index = SearchIndex(index_dir)
+    [result] = [result for result in index.search("deadline", k=5) if result.title == "Long notes"]
+    assert "deadline" in result.snippet and result.snippet.startswith("...")
+    index.close()
+
+
+def test_existing_index_is_reopened(index_dir):
+    first = SearchIndex(index_dir)
+    before = [(result.url, result.score) for result in first.search("deadline call")]
+    first.close()
+    reopened = SearchIndex(index_dir)
+    assert len(reopened) == len(DOCUMENTS)
+    assert [(result.url, result.score) for result in reopened.search("deadline call")] == before
+    reopened.close()
+
+
+def test_rebuilding_replaces_the_index(index_dir):
+    build_index(DOCUMENTS[3:], index_dir)
+    index = SearchIndex(index_dir)
+    assert len(index) == 2
+    assert [result.url for result in index.search("deadline")] == ["https://example.com/notes"]
+    index.close()
+
+
+def test_directory_without_an_index_is_not_opened(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        SearchIndex(str(tmp_path))
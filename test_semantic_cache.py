@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import pytest
+
+from cache import ResponseCache
+from semantic_cache import SemanticCache, HashingVectorizer
+
+MODEL = "test-model"
+PROMPT = "You are mira, a helpful assistant."
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def key(text, system_prompt=PROMPT):
+    return ResponseCache.make_key(MODEL, system_prompt, text)
+
+
+@pytest.fixture(params=[True, False], ids=["numpy", "pure-python"])
+def use_numpy(request):
+    return request.param
+
+
+def test_paraphrases_share_an_answer(use_numpy):
+    cache = SemanticCache(use_numpy=use_numpy)
+    cache.put(key("What is the capital of France?"), "Paris")
+    assert cache.get(key("what's the capital of france")) == "Paris"
+    assert cache.get(key("Can you tell me the capital of France, please?")) == "Paris"
+    assert cache.stats() == {"hits": 2, "misses": 0, "size": 1}
+
+
+def test_different_questions_miss(use_numpy):
+    cache = SemanticCache(use_numpy=use_numpy)
+    cache.put(key("What is the capital of France?"), "Paris")
+    assert cache.get(key("What is the capital of Germany?")) is None
+    assert cache.get(key("What is the population of France?")) is None
+    assert cache.get(key("How do I bake bread?")) is None
+
+
+def test_prompts_only_match_within_model_and_system_prompt(use_numpy):
+    cache = SemanticCache(use_numpy=use_numpy)
+    cache.put(key("What is the capital of France?"), "Paris")
+    assert cache.get(key("What is the capital of France?", "You are a summarization assistant.")) is None
+    assert cache.get(ResponseCache.make_key("other-model", PROMPT, "What is the capital of France?")) is None
+
+
+def test_entries_expire(use_numpy):
+    clock = FakeClock()
+    cache = SemanticCache(ttl=10, clock=clock, use_numpy=use_numpy)
+    cache.put(key("What is the capital of France?"), "Paris")
+    clock.now = 9
+    assert cache.get(key("capital of France?")) == "Paris"
+    clock.now = 10
+    assert cache.get(key("capital of France?")) is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entries_are_evicted(use_numpy):
+    cache = SemanticCache(max_entries=2, use_numpy=use_numpy)
+    cache.put(key("What is the capital of France?"), "Paris")
+    cache.put(key("What is the capital of Germany?"), "Berlin")
+    assert cache.get(key("capital of France")) == "Paris"
+    cache.put(key("What is the capital of Italy?"), "Rome")
+    assert len(cache) == 2
+    assert cache.get(key("capital of Germany")) is None
+    assert cache.get(key("capital of France")) == "Paris"
+    assert cache.get(key("capital of Italy")) == "Rome"
+
+
+def test_replacing_an_entry_keeps_one_copy(use_numpy):
+    cache = SemanticCache(use_numpy=use_numpy)
+    cache.put(key("What is the capital of France?"), "Paris?")
+    cache.put(key("What is the capital of France?"), "Paris")
+    assert len(cache) == 1
+    assert cache.get(key("capital of France")) == "Paris"
+
+
+def test_prompts_without_words_are_not_cached(use_numpy):
+    cache = SemanticCache(use_numpy=use_numpy)
+    cache.put(key("What is it?"), "It depends")
+    assert len(cache) == 0
+    assert cache.get(key("What is it?")) is None
+
+
+def test_vectorizer_keeps_word_order():
+    embed = HashingVectorizer()
+    assert embed("dog bites man") != embed("man bites dog")
+    assert embed("Dog bites man!") == embed("dog bites man")
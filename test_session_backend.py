@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import sqlite3
+import time
+
+import pytest
+
+from session_backend import SQLiteSessionBackend
+from session_store import SessionStore
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Yield a function opening SQLiteSessionBackends on one database file, closing them afterwards"""
+    path = str(tmp_path / "sessions.db")
+    backends = []
+
+    def open_backend(**options):
+        options.setdefault("keep_messages", 100)
+        options.setdefault("max_idle", 3600)
+        backend = SQLiteSessionBackend(path, **options)
+        backends.append(backend)
+        return backend
+
+    open_backend.path = path
+    yield open_backend
+    for backend in backends:
+        backend.close()
+
+
+def set_last_active(path, session_id, last_active):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("UPDATE sessions SET last_active = ? WHERE session_id = ?", (last_active, session_id))
+    conn.close()
+
+
+def test_queued_writes_are_committed_together(database):
+    backend = database(flush_interval=1.0)
+    batches = []
+    apply = backend._apply
+    backend._apply = lambda conn, batch: (batches.append(len(batch)), apply(conn, batch))
+    backend.create("s1", "alice", "2024-01-01T00:00:00")
+    for i in range(9):
+        backend.append("s1", "user", f"message {i}")
+    backend.flush()
+    assert batches == [10]
+    user_id, created_at, summary, messages = backend.load("s1", 3)
+    assert (user_id, created_at, summary) == ("alice", "2024-01-01T00:00:00", None)
+    assert [message["content"] for message in messages] == ["message 6", "message 7", "message 8"]
+    assert backend.load("missing", 3) is None
+
+
+def test_a_failing_write_does_not_drop_its_batch(database):
+    backend = database(flush_interval=1.0)
+    backend.create("s1", "alice", "2024-01-01T00:00:00")
+    backend.append("s1", "user", "kept")
+    # content is NOT NULL, so this write fails
+    backend.append("s1", "user", None)
+    backend.append("s1", "assistant", "also kept")
+    backend.flush()
+    assert backend.failed_writes == 1
+    assert [message["content"] for message in backend.load("s1", 10)[3]] == ["kept", "also kept"]
+
+
+def test_sessions_are_reloaded_with_their_summary(database):
+    store = SessionStore(backend=database(), rolling_summary=True)
+    session, created = store.get_or_create("s1", "alice", "Be brief.")
+    assert created
+    session.append("user", "hello")
+    session.append("assistant", "hi")
+    session.finish_summary("They said hello.")
+    store.close()
+
+    reopened = SessionStore(backend=database())
+    session, created = reopened.get_or_create("s1", "bob", "Be brief.")
+    assert not created and session.user_id == "alice"
+    assert session.snapshot() == [
+        {"role": "system", "content": "Be brief."},
+        {"role": "system", "content": "Summary of the earlier conversation: They said hello."},
+        {"role": "user", "content": "hello"},
+        {"role": "assistant", "content": "hi"},
+    ]
+
+
+def test_compaction_trims_history_and_drops_idle_sessions(database):
+    backend = database(keep_messages=2, max_idle=100)
+    for session_id in ("read", "idle", "active"):
+        backend.create(session_id, "alice", "2024-01-01T00:00:00")
+        for i in range(4):
+            backend.append(session_id, "user", f"{session_id} {i}")
+    backend.flush()
+    old = time.time() - 1000
+    set_last_active(database.path, "read", old)
+    set_last_active(database.path, "idle", old)
+
+    # Reading a session counts as activity
+    backend.load("read", 10)
+    backend.flush()
+    backend.compact()
+    assert backend.load("idle", 10) is None
+    assert [message["content"] for message in backend.load("read", 10)[3]] == ["read 2", "read 3"]
+    assert [message["content"] for message in backend.load("active", 10)[3]] == ["active 2", "active 3"]
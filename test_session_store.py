@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+from session_store import SessionStore
+
+PROMPT = "You are mira, a helpful assistant."
+
+
+def test_get_or_create_resumes_session():
+    store = SessionStore()
+    session, created = store.get_or_create("s1", "alice", PROMPT)
+    store.release(session)
+    resumed, created_again = store.get_or_create("s1", "bob", PROMPT)
+    assert created and not created_again
+    assert resumed is session and resumed.user_id == "alice"
+
+
+def test_history_trimmed_to_max_history():
+    store = SessionStore(max_history=4)
+    session, _ = store.get_or_create("s1", "alice", PROMPT)
+    for i in range(10):
+        session.append("user", f"message {i}")
+    messages = session.snapshot()
+    assert messages[0]["role"] == "system"
+    assert [m["content"] for m in messages[1:]] == [f"message {i}" for i in range(6, 10)]
+
+
+def test_history_trimmed_to_token_budget():
+    store = SessionStore(token_budget=100, count_tokens=lambda text: 10)
+    session, _ = store.get_or_create("s1", "alice", PROMPT)
+    for i in range(20):
+        session.append("user", f"message {i}")
+    assert session.prompt_tokens() <= 100
+    assert session.snapshot()[-1]["content"] == "message 19"
+
+
+def test_capacity_eviction_drops_least_recently_active():
+    store = SessionStore(shards=1, max_sessions=2)
+    for session_id in ("a", "b", "c"):
+        session, _ = store.get_or_create(session_id, "alice", PROMPT)
+        store.release(session)
+    assert "a" not in store and "b" in store and "c" in store
+
+
+def test_capacity_eviction_skips_sessions_held_by_streams():
+    store = SessionStore(shards=1, max_sessions=2)
+    held, _ = store.get_or_create("a", "alice", PROMPT)
+    released, _ = store.get_or_create("b", "alice", PROMPT)
+    store.release(released)
+    store.get_or_create("c", "alice", PROMPT)
+    assert store.get("a") is held
+    assert "b" not in store
+
+
+def test_capacity_eviction_goes_over_capacity_when_every_session_is_held():
+    store = SessionStore(shards=1, max_sessions=1)
+    first, _ = store.get_or_create("a", "alice", PROMPT)
+    second, _ = store.get_or_create("b", "alice", PROMPT)
+    assert store.get("a") is first and store.get("b") is second
+    store.release(first)
+    store.get_or_create("c", "alice", PROMPT)
+    assert "a" not in store and "b" in store
+
+
+def test_remove_idle_keeps_sessions_held_by_streams():
+    store = SessionStore(shards=1)
+    held, _ = store.get_or_create("a", "alice", PROMPT)
+    released, _ = store.get_or_create("b", "alice", PROMPT)
+    store.release(released)
+    assert store.remove_idle(max_idle=-1) == ["b"]
+    assert store.get("a") is held
+    store.release(held)
+    assert store.remove_idle(max_idle=-1) == ["a"]
+    assert len(store) == 0
+
+
+def test_capacity_is_enforced_per_shard():
+    store = SessionStore(shards=2, max_sessions=3)
+    shard = store._shard("a")
+    same_shard = [f"s{i}" for i in range(100) if store._shard(f"s{i}") is shard][:3]
+    for session_id in same_shard:
+        session, _ = store.get_or_create(session_id, "alice", PROMPT)
+        store.release(session)
+    # Each shard holds ceil(3 / 2) = 2 sessions, so the third evicts the first while the other shard is empty
+    assert len(store) == 2 and same_shard[0] not in store
+    others = [f"t{i}" for i in range(100) if store._shard(f"t{i}") is not shard][:2]
+    for session_id in others:
+        session, _ = store.get_or_create(session_id, "alice", PROMPT)
+        store.release(session)
+    assert len(store) == 4
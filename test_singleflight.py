@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+import time
+
+import pytest
+
+from backends import BackendError, LLMBackend
+from resilience import Resilience, RetryPolicy, CallCancelled, Deadline, DeadlineExceeded, RetryBudgetExhausted
+from singleflight import SingleFlight, AsyncSingleFlight, SharedCallAbandoned
+
+
+def run_concurrently(callers, fn):
+    """Run fn() on callers threads at once; returns their results or exceptions"""
+    results = [None] * callers
+
+    def call(i):
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return "answer"
+
+    assert run_concurrently(4, lambda: flight.do("key", slow)) == ["answer"] * 4
+    assert len(calls) == 1
+    assert flight.stats() == {"calls": 1, "coalesced": 3, "in_flight": 0}
+
+
+def test_finished_calls_are_not_shared():
+    flight = SingleFlight()
+    assert flight.do("key", lambda: 1) == 1
+    assert flight.do("key", lambda: 2) == 2
+
+
+def test_errors_are_shared():
+    flight = SingleFlight()
+
+    def failing():
+        time.sleep(0.1)
+        raise BackendError("upstream 500")
+
+    results = run_concurrently(3, lambda: flight.do("key", failing))
+    assert all(isinstance(result, BackendError) for result in results)
+    assert flight.stats()["calls"] == 1
+
+
+def test_leader_errors_abandon_followers():
+    flight = SingleFlight(leader_errors=(CallCancelled,))
+    started = threading.Event()
+
+    def cancelled():
+        started.set()
+        time.sleep(0.1)
+        raise CallCancelled("Call cancelled by the client")
+
+    leader_errors = []
+
+    def lead():
+        try:
+            flight.do("key", cancelled)
+        except CallCancelled as e:
+            leader_errors.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait()
+    with pytest.raises(SharedCallAbandoned):
+        flight.do("key", cancelled)
+    leader.join()
+    assert len(leader_errors) == 1
+
+
+def test_async_cancelled_caller_does_not_cancel_shared_call():
+    async def main():
+        flight = AsyncSingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.1)
+            return "answer"
+
+        first = asyncio.ensure_future(flight.do("key", slow))
+        second = asyncio.ensure_future(flight.do("key", slow))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == "answer"
+        assert flight.stats() == {"calls": 1, "coalesced": 1, "in_flight": 0}
+
+    asyncio.run(main())
+
+
+def test_async_leader_errors_abandon_followers():
+    async def main():
+        flight = AsyncSingleFlight(leader_errors=(DeadlineExceeded,))
+
+        async def expiring():
+            await asyncio.sleep(0.05)
+            raise DeadlineExceeded("Deadline exceeded")
+
+        results = await asyncio.gather(flight.do("key", expiring), flight.do("key", expiring),
+                                       return_exceptions=True)
+        assert isinstance(results[0], DeadlineExceeded)
+        assert isinstance(results[1], SharedCallAbandoned)
+
+    asyncio.run(main())
+
+
+class FailingBackend(LLMBackend):
+    """Backend whose completions fail with a retryable error after seconds"""
+
+    def __init__(self, seconds=0.0):
+        self.seconds = seconds
+        self.calls = 0
+
+    def complete(self, model, messages, timeout=None):
+        self.calls += 1
+        time.sleep(self.seconds)
+        raise BackendError("upstream 503", retryable=True)
+
+    def stream(self, model, messages, timeout=None):
+        yield self.complete(model, messages, timeout)
+
+
+class SlowBackoff(RetryPolicy):
+    def backoff(self, attempt):
+        return 1.0
+
+
+def servicer(backend):
+    from server import ChatServicer
+    return ChatServicer(backend=backend, resilience=Resilience(default_policy=SlowBackoff(retries=5)))
+
+
+def test_shared_complete_does_not_restart_an_exhausted_retry_budget():
+    backend = FailingBackend()
+    chat = servicer(backend)
+    with pytest.raises(RetryBudgetExhausted):
+        chat._shared_complete("key", [], "GetReply", Deadline(0.5))
+    assert backend.calls == 1
+
+
+def test_shared_complete_followers_outlive_the_leaders_deadline():
+    backend = FailingBackend(seconds=0.1)
+    chat = servicer(backend)
+    deadlines = [Deadline(0.05)] + [Deadline(0.5) for _ in range(3)]
+    started = iter(deadlines)
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            deadline = next(started)
+        return chat._shared_complete("key", [], "GetReply", deadline)
+
+    results = run_concurrently(len(deadlines), call)
+    # Each caller gives up on its own deadline or retry budget, and every shared call is bounded by one
+    assert all(isinstance(result, (DeadlineExceeded, RetryBudgetExhausted)) for result in results)
+    assert backend.calls <= 2
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+
+import pytest
+
+from aio_server import acoalesce_tokens
+from backends import BackendError
+from server import coalesce_tokens
+
+
+def stalling_tokens(release):
+    """Yield a and b at once, then c after release is set"""
+    yield "a"
+    yield "b"
+    release.wait(5)
+    yield "c"
+
+
+def failing_tokens():
+    yield "a"
+    raise BackendError("upstream 503", retryable=True)
+
+
+def test_tokens_are_flushed_by_size():
+    pieces = coalesce_tokens(iter(["a", "bb", "cc", "d"]), max_bytes=4, max_delay=60)
+    # The first token goes out on its own, the rest once max_bytes have arrived or the stream ends
+    assert list(pieces) == ["a", "bbcc", "d"]
+
+
+def test_stalled_tokens_are_flushed_after_max_delay():
+    release = threading.Event()
+    pieces = coalesce_tokens(stalling_tokens(release), max_bytes=1000, max_delay=0.05)
+    assert next(pieces) == "a"
+    # b is sent while the upstream is still stalled
+    assert next(pieces) == "b"
+    release.set()
+    assert list(pieces) == ["c"]
+
+
+def test_upstream_errors_are_raised():
+    pieces = coalesce_tokens(failing_tokens(), max_bytes=1000, max_delay=60)
+    assert next(pieces) == "a"
+    with pytest.raises(BackendError, match="upstream 503"):
+        next(pieces)
+
+
+async def atokens(tokens):
+    for token in tokens:
+        yield token
+
+
+async def astalling_tokens(release):
+    yield "a"
+    yield "b"
+    await release.wait()
+    yield "c"
+
+
+async def afailing_tokens():
+    yield "a"
+    raise BackendError("upstream 503", retryable=True)
+
+
+def test_async_tokens_are_flushed_by_size():
+    async def main():
+        pieces = acoalesce_tokens(atokens(["a", "bb", "cc", "d"]), max_bytes=4, max_delay=60)
+        assert [piece async for piece in pieces] == ["a", "bbcc", "d"]
+
+    asyncio.run(main())
+
+
+def test_async_stalled_tokens_are_flushed_after_max_delay():
+    async def main():
+        release = asyncio.Event()
+        pieces = acoalesce_tokens(astalling_tokens(release), max_bytes=1000, max_delay=0.05)
+        assert await pieces.__anext__() == "a"
+        assert await asyncio.wait_for(pieces.__anext__(), 5) == "b"
+        release.set()
+        assert [piece async for piece in pieces] == ["c"]
+
+    asyncio.run(main())
+
+
+def test_async_upstream_errors_are_raised():
+    async def main():
+        pieces = acoalesce_tokens(afailing_tokens(), max_bytes=1000, max_delay=60)
+        assert await pieces.__anext__() == "a"
+        with pytest.raises(BackendError, match="upstream 503"):
+            await pieces.__anext__()
+
+    asyncio.run(main())
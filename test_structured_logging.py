@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import io
+import json
+import logging
+
+import pytest
+
+import structured_logging
+from structured_logging import configure_logging, parse_sample_rates, payload, rpc_log, stop_logging
+
+
+@pytest.fixture
+def output(monkeypatch):
+    """Configure logging into a StringIO for one test, restoring the root logger and policy afterwards"""
+    for name in ("_payload_mode", "_payload_chars", "_sample_rates", "_default_sample_rate"):
+        monkeypatch.setattr(structured_logging, name, getattr(structured_logging, name))
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    stream = io.StringIO()
+
+    def configure(**options):
+        configure_logging(stream=stream, use_queue=options.pop("use_queue", False), **options)
+        return stream
+
+    yield configure
+    stop_logging()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_payload_modes(output):
+    text = "x" * 50
+    output(payload_mode="full")
+    assert str(payload(text)) == text
+    output(payload_mode="truncate", payload_chars=10)
+    assert str(payload(text)) == "x" * 10 + "... (+40 chars)"
+    assert str(payload("short")) == "short"
+    output(payload_mode="redact")
+    assert str(payload(text)).startswith("<50 chars sha256:")
+    assert text not in str(payload(text))
+    with pytest.raises(ValueError):
+        output(payload_mode="shout")
+
+
+class Rendered:
+    """Payload stand-in recording whether it was rendered"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __str__(self):
+        self.calls += 1
+        return "body"
+
+
+def test_payload_is_only_rendered_for_emitted_lines(output):
+    stream = output(level=logging.WARNING)
+    body = Rendered()
+    logging.getLogger("rpc.GetReply").info("Received %s", body)
+    assert body.calls == 0
+    logging.getLogger("rpc.GetReply").warning("Received %s", body)
+    assert body.calls == 1
+    assert "Received body" in stream.getvalue()
+
+
+def test_unsampled_calls_keep_warnings_and_errors(output):
+    stream = output(sample_rates={"GetReply": 0.0})
+    log = rpc_log("GetReply")
+    log.info("routine")
+    log.warning("slow upstream")
+    try:
+        raise RuntimeError("boom")
+    except RuntimeError:
+        log.exception("failed")
+    lines = stream.getvalue()
+    assert "routine" not in lines
+    assert "slow upstream" in lines and "failed" in lines and "RuntimeError: boom" in lines
+    assert not log.isEnabledFor(logging.INFO) and log.isEnabledFor(logging.ERROR)
+    rpc_log("StreamResponse").info("other methods keep the default rate")
+    assert "other methods keep the default rate" in stream.getvalue()
+
+
+def test_sampling_is_decided_per_call(output, monkeypatch):
+    output(default_sample_rate=0.25)
+    draws = iter([0.1, 0.9, 0.2, 0.3])
+    monkeypatch.setattr(structured_logging.random, "random", lambda: next(draws))
+    sampled = [rpc_log("GetReply").isEnabledFor(logging.INFO) for _ in range(4)]
+    assert sampled == [True, False, True, False]
+
+
+def test_parse_sample_rates():
+    assert parse_sample_rates(["GetReply=0.01", "*=0.5"]) == ({"GetReply": 0.01}, 0.5)
+    assert parse_sample_rates([]) == ({}, 1.0)
+    with pytest.raises(ValueError):
+        parse_sample_rates(["GetReply=often"])
+
+
+def test_json_lines_carry_extra_fields_and_exceptions(output):
+    stream = output(json_format=True)
+    logging.getLogger("rpc.GetReply").info("Done in %dms", 12, extra={"session_id": "s1", "peer": object()})
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logging.getLogger("rpc.GetReply").exception("Failed")
+    first, second = map(json.loads, stream.getvalue().splitlines())
+    assert first["message"] == "Done in 12ms" and first["level"] == "INFO" and first["logger"] == "rpc.GetReply"
+    assert first["session_id"] == "s1" and first["peer"].startswith("<object")
+    assert "ZeroDivisionError" in second["exception"]
+
+
+def test_queued_records_are_written_by_the_listener(output):
+    stream = output(use_queue=True, payload_mode="redact")
+    logging.getLogger("rpc.ChatSession").info("Received %s", payload("secret text"))
+    stop_logging()
+    written = stream.getvalue()
+    assert "Received <11 chars sha256:" in written and "secret" not in written
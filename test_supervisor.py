@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import os
+import sys
+
+import pytest
+
+from supervisor import Supervisor
+
+# Stand-in worker: reports ready (unless told to fail) and serves until it is terminated
+WORKER = """
+import argparse, time
+from supervisor import notify_ready
+parser = argparse.ArgumentParser()
+parser.add_argument("--fail", action="store_true")
+parser.add_argument("--worker-index", type=int)
+parser.add_argument("--ready-fd", type=int)
+args = parser.parse_args()
+if args.fail:
+    raise SystemExit(1)
+notify_ready(args.ready_fd)
+while True:
+    time.sleep(1)
+"""
+
+
+def command(*args):
+    return [sys.executable, "-c", WORKER, *args]
+
+
+@pytest.fixture(autouse=True)
+def importable_supervisor(monkeypatch):
+    """Let worker processes import supervisor.py from this directory"""
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_all(supervisor):
+    for slot in range(supervisor.worker_count):
+        supervisor.workers[slot] = supervisor._start(slot)
+
+
+def test_workers_are_started_and_stopped():
+    supervisor = Supervisor(command(), workers=2, grace=1, ready_timeout=10)
+    start_all(supervisor)
+    workers = list(supervisor.workers.values())
+    assert [worker.slot for worker in workers] == [0, 1]
+    assert all(worker.process.poll() is None for worker in workers)
+    supervisor.stop()
+    assert supervisor.workers == {}
+    assert all(worker.process.poll() is not None for worker in workers)
+
+
+def test_worker_that_never_serves_is_an_error():
+    supervisor = Supervisor(command("--fail"), workers=1, grace=1, ready_timeout=10)
+    with pytest.raises(RuntimeError, match="Worker 0 exited or did not start serving"):
+        supervisor._start(0)
+
+
+def test_rolling_restart_replaces_every_worker():
+    supervisor = Supervisor(command(), workers=2, grace=1, ready_timeout=10)
+    start_all(supervisor)
+    old = dict(supervisor.workers)
+    try:
+        supervisor.rolling_restart()
+        assert sorted(supervisor.workers) == [0, 1]
+        for slot, worker in supervisor.workers.items():
+            assert worker.pid != old[slot].pid and worker.process.poll() is None
+            assert old[slot].process.poll() is not None
+    finally:
+        supervisor.stop()
+
+
+def test_exited_workers_are_replaced():
+    supervisor = Supervisor(command(), workers=2, grace=1, ready_timeout=10)
+    start_all(supervisor)
+    try:
+        crashed = supervisor.workers[1]
+        crashed.process.kill()
+        crashed.process.wait()
+        supervisor._replace_exited()
+        assert supervisor.workers[1] is not crashed and supervisor.workers[1].process.poll() is None
+    finally:
+        supervisor.stop()